@@ -0,0 +1,156 @@
+# encoding: utf-8
+#
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import unicode_literals
+
+import random
+
+import pytest
+
+from mo_dots import wrap
+from mo_logs import Log
+from mo_times import Timer
+from mo_hg.apply import Line, SourceFile, apply_diff, apply_diff_backwards
+from tuid.util import AnnotateFile, TuidLine, TuidMap
+
+
+def _make_diff(num_lines, num_changes, seed, filename='a/file.cpp'):
+    # Builds a random diff, with moves like `diff_to_moves` would
+    # produce them for an n-line file. Returns the diff
+    # and the expected length of the new file.
+    rand = random.Random(seed)
+    changes = []
+    new_line = 0
+    for old_line in range(num_lines):
+        if len(changes) < num_changes and rand.random() < 0.3:
+            if rand.random() < 0.5:
+                changes.append({"line": new_line, "action": "-"})
+                continue
+            for _ in range(rand.randint(1, 3)):
+                changes.append({"line": new_line, "action": "+"})
+                new_line += 1
+        new_line += 1
+    diff = wrap({
+        "merge": False,
+        "diffs": [{
+            "new": {"name": filename},
+            "old": {"name": filename},
+            "changes": changes
+        }]
+    })
+    return diff, new_line
+
+
+def _new_file(num_lines, filename='a/file.cpp'):
+    return SourceFile(filename, [Line(i + 1, filename=filename) for i in range(num_lines)])
+
+
+def _apply_diff_one_at_a_time(file, diff):
+    # The previous implementation of `apply_diff`, used as a reference.
+    for change in diff['diffs'][0]['changes']:
+        if change.action == '+':
+            file.add_one(Line(change.line + 1, is_new_line=True, filename=file.filename))
+        elif change.action == '-':
+            file.remove_one(change.line + 1)
+    return file
+
+
+def test_apply_diff_same_as_one_at_a_time():
+    for seed in range(20):
+        diff, expected_length = _make_diff(200, 60, seed)
+
+        expected = _apply_diff_one_at_a_time(_new_file(200), diff)
+        result = apply_diff(_new_file(200), diff)
+
+        assert len(result.lines) == expected_length
+        assert len(result.lines) == len(expected.lines)
+        for i, (line_obj, expected_obj) in enumerate(zip(result.lines, expected.lines)):
+            assert line_obj.line == i + 1
+            assert line_obj.line == expected_obj.line
+            assert line_obj.is_new_line == expected_obj.is_new_line
+
+
+def test_apply_diff_backwards_restores_file():
+    for seed in range(20):
+        diff, _ = _make_diff(200, 60, seed)
+
+        original = _new_file(200)
+        original_lines = list(original.lines)
+        forward = apply_diff(original, diff)
+        forward.reset_new_lines()
+        backward = apply_diff_backwards(forward, diff)
+
+        assert len(backward.lines) == len(original_lines)
+        for i, line_obj in enumerate(backward.lines):
+            assert line_obj.line == i + 1
+            if line_obj.is_new_line:
+                # A removed line that came back
+                continue
+            assert line_obj is original_lines[i]
+
+
+def test_apply_diff_to_removed_file():
+    diff = wrap({
+        "merge": False,
+        "diffs": [{
+            "new": {"name": "dev/null"},
+            "old": {"name": "a/file.cpp"},
+            "changes": [{"line": 0, "action": "-"}]
+        }]
+    })
+    result = apply_diff(_new_file(10), diff)
+    assert len(result.lines) == 0
+
+
+@pytest.mark.skip("Used for local performance testing.")
+def test_apply_diff_performance():
+    num_lines = 50000
+    diff, _ = _make_diff(num_lines, 5000, 0)
+
+    with Timer("apply diff one change at a time") as old_timer:
+        _apply_diff_one_at_a_time(_new_file(num_lines), diff)
+    with Timer("apply diff in a single pass") as new_timer:
+        apply_diff(_new_file(num_lines), diff)
+
+    Log.note(
+        "One change at a time: {{old}}, single pass: {{new}}",
+        old=old_timer.duration,
+        new=new_timer.duration
+    )
+    assert new_timer.duration < old_timer.duration
+
+
+def test_apply_diffs_keeps_origins():
+    filename = 'file.cpp'
+    file = AnnotateFile(filename, [TuidLine(TuidMap(tuid, i + 1), filename=filename) for i, tuid in enumerate([11, 0, 13])])
+
+    def diff(*changes):
+        return wrap({
+            "merge": False,
+            "diffs": [{
+                "new": {"name": filename},
+                "old": {"name": filename},
+                "changes": [{"line": line, "action": action} for line, action in changes]
+            }]
+        })
+
+    file.apply_diffs([
+        ("000000000001", diff((1, '+'))),
+        ("000000000002", diff((0, '+'), (2, '-'))),  # Removes the line added by the first
+        ("000000000003", wrap({"merge": False, "diffs": []}))
+    ])
+
+    # The line without a tuid gets one at the first revision, where it was line 3
+    assert [getattr(line, 'origin', None) for line in file.lines] == [
+        (filename, "000000000002", 1),
+        None,
+        (filename, "000000000001", 3),
+        None
+    ]
+    assert [getattr(line, 'tuid', None) for line in file.lines] == [None, 11, 0, 13]
+    assert [line.line for line in file.lines] == [1, 2, 3, 4]
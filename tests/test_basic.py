@@ -12,15 +12,16 @@ import json
 
 import pytest
 
-from mo_dots import Null
+from mo_dots import Null, wrap
 from mo_logs import Log, Except
 from mo_threads import Thread, Till
 from mo_times import Timer
 from pyLibrary.env import http
 from pyLibrary.sql import sql_list, quote_set
 from pyLibrary.sql.sqlite import quote_value, DOUBLE_TRANSACTION_ERROR, quote_list
+from tuid.encoding import annotation_hash, encode_tuids
 from tuid.service import TUIDService
-from tuid.util import map_to_array
+from tuid.util import TuidMap, map_to_array
 
 _service = None
 
@@ -55,7 +56,7 @@ def test_transactions(service):
                 tmp_inserts = listed_inserts[count:count + 50]
                 count += 50
                 t.execute(
-                    "INSERT OR REPLACE INTO latestFileMod (file, revision) VALUES " +
+                    "INSERT OR REPLACE INTO csetFiles (file, revision) VALUES " +
                     sql_list(quote_list(i) for i in tmp_inserts)
                 )
         assert False  # SHOULD NOT GET HERE
@@ -64,7 +65,7 @@ def test_transactions(service):
         assert "11 values for 2 columns" in e
 
     # Check that the transaction was undone
-    latestTestMods = service.conn.get_one("SELECT revision FROM latestFileMod WHERE file=?", ('test1',))
+    latestTestMods = service.conn.get_one("SELECT revision FROM csetFiles WHERE file=?", ('test1',))
 
     assert not latestTestMods
 
@@ -76,23 +77,179 @@ def test_transactions2(service):
     with service.conn.transaction() as t:
         # Make a change
         t.execute(
-            "INSERT OR REPLACE INTO latestFileMod (file, revision) VALUES " +
+            "INSERT OR REPLACE INTO csetFiles (file, revision) VALUES " +
             sql_list(quote_list(i) for i in inserting)
         )
 
         try:
             # Query for one change
-            query_res1 = service.conn.get("SELECT revision FROM latestFileMod WHERE file=?", ('testing_transaction2_1',))
+            query_res1 = service.conn.get("SELECT revision FROM csetFiles WHERE file=?", ('testing_transaction2_1',))
             assert False
         except Exception as e:
             assert DOUBLE_TRANSACTION_ERROR in e
 
         # Query for the other change
-        query_res2 = t.get("SELECT revision FROM latestFileMod WHERE file=?", ('testing_transaction2_2',))
+        query_res2 = t.get("SELECT revision FROM csetFiles WHERE file=?", ('testing_transaction2_2',))
 
     assert query_res2[0][0] == '2'
 
 
+@pytest.mark.first_run
+def test_reserve_tuids(service):
+    with service.conn.transaction() as t:
+        first = service.reserve_tuids(t, 10)
+        second = service.reserve_tuids(t, 5)
+    assert second == first + 10
+
+    # Tuids reserved in a failed transaction are reserved again
+    try:
+        with service.conn.transaction() as t:
+            third = service.reserve_tuids(t, 3)
+            raise Exception("expected failure")
+    except Exception:
+        pass
+    with service.conn.transaction() as t:
+        assert service.reserve_tuids(t, 1) == third == second + 5
+
+
+@pytest.mark.skip("Used for local performance testing.")
+def test_get_new_lines_performance(service):
+    # A 10k line file, annotated across 500 revisions that
+    # each added 1000 lines somewhere in the file
+    file = "performance/get_new_lines.cpp"
+    num_lines = 10000
+    revisions = ["%012x" % r for r in range(500)]
+    line_origins = [
+        (file, revisions[i % len(revisions)], (i // len(revisions)) * 50 + i % 50 + 1)
+        for i in range(num_lines)
+    ]
+
+    with service.conn.transaction() as t:
+        t.execute("DELETE FROM temporal WHERE file_id IN (SELECT file_id FROM files WHERE file=?)", (file,))
+        first_tuid = service.reserve_tuids(t, len(revisions) * 1000)
+        service.insert_tuids(
+            t,
+            [
+                (first_tuid + r * 1000 + line - 1, rev, file, line)
+                for r, rev in enumerate(revisions)
+                for line in range(1, 1001)
+            ]
+        )
+
+    with Timer("cross product lookup of {{num}} lines", {"num": len(line_origins)}):
+        with service.conn.transaction() as t:
+            found = t.query(
+                "SELECT t.tuid, f.file, r.revision, t.line FROM temporal t"
+                " JOIN files f ON f.file_id=t.file_id"
+                " JOIN revisions r ON r.revision_id=t.revision_id"
+                " WHERE f.file IN " + quote_set(set(f for f, _, _ in line_origins)) +
+                " AND r.revision IN " + quote_set(set(r for _, r, _ in line_origins)) +
+                " AND t.line IN " + quote_set(set(l for _, _, l in line_origins))
+            ).data
+    Log.note("cross product returned {{num}} rows", num=len(found))
+
+    with Timer("exact lookup of {{num}} lines", {"num": len(line_origins)}):
+        with service.conn.transaction() as t:
+            new_lines, existing_tuids = service.get_new_lines(t, line_origins)
+
+    assert not new_lines
+    assert len(existing_tuids) == len(line_origins)
+
+
+def test_insert_tuids_with_duplicates(service):
+    # Issue #58: hg annotate can give the same origin to more than one line
+    file = "issue58/duplicates.txt"
+    line_origins = [
+        (file, "000000000058", 1),
+        (file, "000000000058", 2),
+        (file, "000000000058", 1),
+        (file, "000000000058", 3),
+        (file, "000000000058", 2)
+    ]
+
+    with service.conn.transaction() as t:
+        t.execute("DELETE FROM temporal WHERE file_id IN (SELECT file_id FROM files WHERE file=?)", (file,))
+        new_lines, existing_tuids = service.get_new_lines(t, line_origins)
+        assert new_lines == {1, 2, 3, 4, 5}
+        assert not existing_tuids
+
+        new_line_origins = service.insert_tuids_with_duplicates(t, file, "000000000058", new_lines, line_origins)
+        tuids = {line_num: origin[0] for line_num, origin in new_line_origins.items()}
+        # Every line gets its own tuid
+        assert sorted(tuids.keys()) == [1, 2, 3, 4, 5]
+        assert len(set(tuids.values())) == 5
+
+        # Only the first line with each origin is inserted
+        inserted = [tuple(r) for r in t.get(
+            "SELECT t.line, t.tuid FROM temporal t JOIN files f ON f.file_id=t.file_id WHERE f.file=? ORDER BY t.line",
+            (file,)
+        )]
+        assert inserted == [(1, tuids[1]), (2, tuids[2]), (3, tuids[4])]
+
+        # Later, the duplicates get the tuid of the first line
+        new_lines, existing_tuids = service.get_new_lines(t, line_origins)
+        assert not new_lines
+        assert existing_tuids == {1: tuids[1], 2: tuids[2], 3: tuids[1], 4: tuids[4], 5: tuids[2]}
+
+
+def test_changed_files_index(service, monkeypatch):
+    revision = "c0ffee000017"
+    diff = wrap({
+        "merge": False,
+        "diffs": [
+            {"new": {"name": "/dom/a.cpp"}, "old": {"name": "/dom/a.cpp"}, "changes": [{"line": 0, "action": "+"}]},
+            {"new": {"name": "/dom/b.cpp"}, "old": {"name": "/dev/null"}, "changes": [{"line": 0, "action": "+"}]},
+            {"new": {"name": "/dom/d.cpp"}, "old": {"name": "/dom/c.cpp"}, "changes": []}
+        ]
+    })
+    monkeypatch.setattr(service, "_get_hg_diff", lambda cset, repo=None: diff)
+    with service.conn.transaction() as t:
+        t.execute("DELETE FROM diffs WHERE revision=?", (revision,))
+        t.execute("DELETE FROM csetFiles WHERE revision=?", (revision,))
+
+    service.get_diffs([revision])
+    indexed, changes = service._get_changed_files(
+        [revision, "000000000000"],
+        ["dom/a.cpp", "dom/b.cpp", "dom/c.cpp", "dom/d.cpp", "dom/e.cpp"]
+    )
+    assert indexed == {revision}
+    assert sorted(tuple(c) for c in changes) == [
+        (revision, "dom/a.cpp", "M"),
+        (revision, "dom/b.cpp", "A"),
+        (revision, "dom/c.cpp", "F"),
+        (revision, "dom/d.cpp", "T")
+    ]
+
+
+def test_annotation_blobs(service):
+    file = "blobs/unchanged.cpp"
+    revisions = ["b10b00000001", "b10b00000002"]
+    annotation = encode_tuids([TuidMap(1, 1), TuidMap(2, 2)])
+    hash = annotation_hash(annotation)
+    delete = (
+        "DELETE FROM annotations WHERE file_id IN (SELECT file_id FROM files WHERE file=?)"
+        " AND revision_id IN (SELECT revision_id FROM revisions WHERE revision=?)"
+    )
+
+    with service.conn.transaction() as t:
+        for rev in revisions:
+            t.execute(delete, (file, rev))
+        # An unchanged file is stored once for both revisions
+        service.insert_annotations(t, [(rev, file, annotation) for rev in revisions])
+    assert service.conn.get_one("SELECT refs FROM annotationBlobs WHERE hash=?", (hash,))[0] == 2
+    service.annotation_cache.clear()
+    assert service._get_annotations(revisions[1], [file])[file] == [TuidMap(1, 1), TuidMap(2, 2)]
+
+    # The blob is deleted with the last annotation using it
+    with service.conn.transaction() as t:
+        t.execute(delete, (file, revisions[0]))
+    assert service.conn.get_one("SELECT refs FROM annotationBlobs WHERE hash=?", (hash,))[0] == 1
+    with service.conn.transaction() as t:
+        t.execute(delete, (file, revisions[1]))
+    assert not service.conn.get_one("SELECT refs FROM annotationBlobs WHERE hash=?", (hash,))
+    service.annotation_cache.clear()
+
+
 @pytest.mark.first_run
 def test_duplicate_ann_node_entries(service):
     # This test ensures that we can handle duplicate annotation
@@ -333,13 +490,14 @@ def test_many_files_one_revision(service):
 
     with service.conn.transaction() as t:
         t.execute(
-            "DELETE FROM latestFileMod WHERE file IN " +
-            quote_set(test_file)
+            "DELETE FROM latestFileMod WHERE file_id IN (SELECT file_id FROM files WHERE file IN " +
+            quote_set(test_file) + ")"
         )
         t.execute(
-            "DELETE FROM annotations WHERE file IN " +
-            quote_set(test_file)
+            "DELETE FROM annotations WHERE file_id IN (SELECT file_id FROM files WHERE file IN " +
+            quote_set(test_file) + ")"
         )
+    service.annotation_cache.clear()
 
     Log.note("Total files: {{total}}", total=str(len(test_file)))
 
@@ -373,13 +531,14 @@ def test_one_addition_many_files(service):
 
     with service.conn.transaction() as t:
         t.execute(
-            "DELETE FROM latestFileMod WHERE file IN " +
-            quote_set(test_file)
+            "DELETE FROM latestFileMod WHERE file_id IN (SELECT file_id FROM files WHERE file IN " +
+            quote_set(test_file) + ")"
         )
         t.execute(
-            "DELETE FROM annotations WHERE file IN " +
-            quote_set(test_file)
+            "DELETE FROM annotations WHERE file_id IN (SELECT file_id FROM files WHERE file IN " +
+            quote_set(test_file) + ")"
         )
+    service.annotation_cache.clear()
 
     # Get current annotation
     result, _ = service.get_tuids_from_files(test_file_change, old_rev)
@@ -558,13 +717,14 @@ def test_one_http_call_required(service):
 
     with service.conn.transaction() as t:
         t.execute(
-            "DELETE FROM latestFileMod WHERE file IN " +
-            quote_set(proc_files)
+            "DELETE FROM latestFileMod WHERE file_id IN (SELECT file_id FROM files WHERE file IN " +
+            quote_set(proc_files) + ")"
         )
         t.execute(
-            "DELETE FROM annotations WHERE file IN " +
-            quote_set(proc_files)
+            "DELETE FROM annotations WHERE file_id IN (SELECT file_id FROM files WHERE file IN " +
+            quote_set(proc_files) + ")"
         )
+    service.annotation_cache.clear()
 
     Log.note("Number of files to process: {{flen}}", flen=len(files))
     first_f_n_tuids, _ = service.get_tuids_from_files(
@@ -646,8 +806,9 @@ def test_out_of_order_get_tuids_from_files(service):
     service.clogger.initialize_to_range(rev_initial, rev_latest)
     test_file = ["dom/base/nsWrapperCache.cpp"]
     with service.conn.transaction() as t:
-        t.execute("DELETE FROM latestFileMod WHERE file=" + quote_value(test_file[0]))
-        t.execute("DELETE FROM annotations WHERE file=" + quote_value(test_file[0]))
+        t.execute("DELETE FROM latestFileMod WHERE file_id IN (SELECT file_id FROM files WHERE file=" + quote_value(test_file[0]) + ")")
+        t.execute("DELETE FROM annotations WHERE file_id IN (SELECT file_id FROM files WHERE file=" + quote_value(test_file[0]) + ")")
+    service.annotation_cache.clear()
 
     check_lines = [41]
 
@@ -683,8 +844,9 @@ def test_out_of_order_going_forward_get_tuids_from_files(service):
     service.clogger.initialize_to_range(rev_initial, rev_latest2)
     test_file = ["dom/base/nsWrapperCache.cpp"]
     with service.conn.transaction() as t:
-        t.execute("DELETE FROM latestFileMod WHERE file=" + quote_value(test_file[0]))
-        t.execute("DELETE FROM annotations WHERE file=" + quote_value(test_file[0]))
+        t.execute("DELETE FROM latestFileMod WHERE file_id IN (SELECT file_id FROM files WHERE file=" + quote_value(test_file[0]) + ")")
+        t.execute("DELETE FROM annotations WHERE file_id IN (SELECT file_id FROM files WHERE file=" + quote_value(test_file[0]) + ")")
+    service.annotation_cache.clear()
 
     check_lines = [41]
 
@@ -772,8 +934,9 @@ def test_merged_changes(service):
     service.clogger.disable_all()
     service.clogger.initialize_to_range(old_rev, new_rev)
     with service.conn.transaction() as t:
-        t.execute("DELETE FROM latestFileMod WHERE file=" + quote_value(test_files[0]))
-        t.execute("DELETE FROM annotations WHERE file=" + quote_value(test_files[0]))
+        t.execute("DELETE FROM latestFileMod WHERE file_id IN (SELECT file_id FROM files WHERE file=" + quote_value(test_files[0]) + ")")
+        t.execute("DELETE FROM annotations WHERE file_id IN (SELECT file_id FROM files WHERE file=" + quote_value(test_files[0]) + ")")
+    service.annotation_cache.clear()
 
     old_tuids, _ = service.get_tuids_from_files(test_files, old_rev, use_thread=False)
     new_tuids, _ = service.get_tuids_from_files(test_files, new_rev, use_thread=False)
@@ -817,12 +980,12 @@ def test_very_distant_files(service):
     service.clogger.initialize_to_range(old_rev, new_rev)
 
     with service.conn.transaction() as t:
-        t.execute("DELETE FROM annotations WHERE revision = " + quote_value(new_rev))
-        for file in test_files:
-            t.execute(
-                "UPDATE latestFileMod SET revision = " + quote_value(old_rev) +
-                " WHERE file = " + quote_value(file)
-            )
+        t.execute(
+            "DELETE FROM annotations WHERE revision_id IN"
+            " (SELECT revision_id FROM revisions WHERE revision = " + quote_value(new_rev) + ")"
+        )
+        service.insert_latest_revisions(t, [(file, old_rev) for file in test_files])
+    service.annotation_cache.clear()
 
     old_tuids, _ = service.get_tuids_from_files(test_files, old_rev, use_thread=False, max_csets_proc=10000)
     new_tuids, _ = service.get_tuids_from_files(test_files, new_rev, use_thread=False, max_csets_proc=10000)
@@ -20,6 +20,7 @@ from pyLibrary.env import http
 from pyLibrary.sql import sql_list, sql_iso
 from pyLibrary.sql.sqlite import quote_value, DOUBLE_TRANSACTION_ERROR
 from tuid.clogger import Clogger
+from tuid.encoding import encode_tuids
 from tuid import sql
 
 _clogger = None
@@ -27,6 +28,12 @@ _conn = None
 
 DEBUG = False
 HG_URL = "https://hg.mozilla.org/"
+LATEST_REVISION_EXISTS = (
+    "SELECT 1 FROM latestFileMod l JOIN revisions r ON r.revision_id=l.revision_id WHERE r.revision=?"
+)
+ANNOTATION_EXISTS = (
+    "SELECT 1 FROM annotations a JOIN revisions r ON r.revision_id=a.revision_id WHERE r.revision=?"
+)
 
 @pytest.fixture
 def clogger(config, new_db):
@@ -113,11 +120,13 @@ def test_backfilling_to_revision(clogger):
     assert num_trys > 0
     assert new_old_rev == new_ending
 
-    # Check that revnum's were properly handled
-    expected_revnum = oldest_revnum + num_to_go_back
+    # Check that revnum's were properly handled, existing
+    # entries keep their revnum
     with clogger.conn.transaction() as t:
         new_revnum = t.get_one("SELECT revnum FROM csetLog WHERE revision=?", (oldest_rev,))[0]
-    assert expected_revnum == new_revnum
+        new_ending_revnum = t.get_one("SELECT revnum FROM csetLog WHERE revision=?", (new_old_rev,))[0]
+    assert oldest_revnum == new_revnum
+    assert oldest_revnum - num_to_go_back == new_ending_revnum
 
 
 def test_backfilling_by_count(clogger):
@@ -143,10 +152,11 @@ def test_backfilling_by_count(clogger):
     clogger.csets_todo_backwards.add((num_to_go_back, True))
 
     new_ending = None
+    new_ending_revnum = None
     new_revnum = None
     while num_trys > 0:
         with clogger.conn.transaction() as t:
-            new_ending = t.get_one("SELECT min(revnum) AS revnum, revision FROM csetLog")[1]
+            new_ending_revnum, new_ending = t.get_one("SELECT min(revnum) AS revnum, revision FROM csetLog")
             DEBUG and Log.note("{{data}}", data=(oldest_rev, new_old_rev, new_ending))
             if new_ending == new_old_rev:
                 new_revnum = t.get_one("SELECT revnum FROM csetLog WHERE revision=?", (oldest_rev,))[0]
@@ -158,9 +168,10 @@ def test_backfilling_by_count(clogger):
     assert num_trys > 0
     assert new_old_rev == new_ending
 
-    # Check that revnum's were properly handled
-    expected_revnum = oldest_revnum + num_to_go_back
-    assert expected_revnum == new_revnum
+    # Check that revnum's were properly handled, existing
+    # entries keep their revnum
+    assert oldest_revnum == new_revnum
+    assert oldest_revnum - num_to_go_back == new_ending_revnum
 
 
 def test_maintenance_and_deletion(clogger):
@@ -203,24 +214,12 @@ def test_maintenance_and_deletion(clogger):
         ('file2', new_tail)
     ]
     inserts_list_annotations = [
-        ('file1', new_tail, ''),
-        ('file2', new_tail, '')
+        (new_tail, 'file1', encode_tuids([])),
+        (new_tail, 'file2', encode_tuids([]))
     ]
     with clogger.conn.transaction() as t:
-        t.execute(
-            "INSERT OR REPLACE INTO latestFileMod (file, revision) VALUES " +
-            sql_list(
-                sql_iso(sql_list(map(quote_value, i)))
-                for i in inserts_list_latestFileMod
-            )
-        )
-        t.execute(
-            "INSERT OR REPLACE INTO annotations (file, revision, annotation) VALUES " +
-            sql_list(
-                sql_iso(sql_list(map(quote_value, i)))
-                for i in inserts_list_annotations
-            )
-        )
+        clogger.tuid_service.insert_latest_revisions(t, inserts_list_latestFileMod)
+        clogger.tuid_service.insert_annotations(t, inserts_list_annotations)
 
         revnums_in_db = t.get_one("SELECT count(revnum) as revnum FROM csetLog")[0]
     if revnums_in_db <= max_revs:
@@ -244,11 +243,11 @@ def test_maintenance_and_deletion(clogger):
     assert tmp_num_trys < num_trys
 
     # Check that latestFileMods entries were deleted.
-    latest_rev = clogger.conn.get_one("SELECT 1 FROM latestFileMod WHERE revision=?", (new_tail,))
+    latest_rev = clogger.conn.get_one(LATEST_REVISION_EXISTS, (new_tail,))
     assert not latest_rev
 
     # Check that annotations were deleted.
-    annotates = clogger.conn.get_one("SELECT 1 FROM annotations WHERE revision=?", (new_tail,))
+    annotates = clogger.conn.get_one(ANNOTATION_EXISTS, (new_tail,))
     assert not annotates
 
 
@@ -288,25 +287,13 @@ def test_deleting_old_annotations(clogger):
         ('file2', tail_cset)
     ]
     inserts_list_annotations = [
-        ('file1', tail_cset, ''),
-        ('file2', tail_cset, '')
+        (tail_cset, 'file1', encode_tuids([])),
+        (tail_cset, 'file2', encode_tuids([]))
     ]
 
     with clogger.conn.transaction() as t:
-        t.execute(
-            "INSERT OR REPLACE INTO latestFileMod (file, revision) VALUES " +
-            sql_list(
-                sql_iso(sql_list(map(quote_value, i)))
-                for i in inserts_list_latestFileMod
-            )
-        )
-        t.execute(
-            "INSERT OR REPLACE INTO annotations (file, revision, annotation) VALUES " +
-            sql_list(
-                sql_iso(sql_list(map(quote_value, i)))
-                for i in inserts_list_annotations
-            )
-        )
+        clogger.tuid_service.insert_latest_revisions(t, inserts_list_latestFileMod)
+        clogger.tuid_service.insert_annotations(t, inserts_list_annotations)
         t.execute(
             "INSERT OR REPLACE INTO csetLog (revnum, revision, timestamp) VALUES " +
             sql_iso(sql_list(map(quote_value, (tail_tipnum, tail_cset, new_timestamp))))
@@ -319,8 +306,8 @@ def test_deleting_old_annotations(clogger):
     tmp_num_trys = 0
     while tmp_num_trys < num_trys:
         Till(seconds=wait_time).wait()
-        latest_rev = clogger.conn.get_one("SELECT 1 FROM latestFileMod WHERE revision=?", (tail_cset,))
-        annotates = clogger.conn.get_one("SELECT 1 FROM annotations WHERE revision=?", (tail_cset,))
+        latest_rev = clogger.conn.get_one(LATEST_REVISION_EXISTS, (tail_cset,))
+        annotates = clogger.conn.get_one(ANNOTATION_EXISTS, (tail_cset,))
         if not annotates and not latest_rev:
             break
         tmp_num_trys += 1
@@ -342,9 +329,6 @@ def test_partial_tipfilling(clogger):
             "DELETE FROM csetLog WHERE revnum >= " + str(max_tip_num) + " - 5"
         )
 
-    with clogger.working_locker:
-        clogger.recompute_table_revnums()
-
     clogger.disable_tipfilling = False
     tmp_num_trys = 0
     while tmp_num_trys < num_trys:
@@ -383,10 +367,10 @@ def test_get_revnum_range_backfill(clogger):
 
     assert len(revnums) == 11
 
-    curr_revnum = -1
+    curr_revnum = None
     for revnum, revision in revnums:
         assert revision
-        assert revnum > curr_revnum
+        assert curr_revnum is None or revnum > curr_revnum
         curr_revnum = revnum
 
 
@@ -412,10 +396,10 @@ def test_get_revnum_range_tipfill(clogger):
 
     assert len(revnums) == 7
 
-    curr_revnum = -1
+    curr_revnum = None
     for revnum, revision in revnums:
         assert revision
-        assert revnum > curr_revnum
+        assert curr_revnum is None or revnum > curr_revnum
         curr_revnum = revnum
 
 
@@ -464,8 +448,8 @@ def test_get_revnum_range_tipnback(clogger):
 
         assert len(revnums) == expected_total_revs
 
-        curr_revnum = -1
+        curr_revnum = None
         for revnum, revision in revnums:
             assert revision
-            assert revnum > curr_revnum
+            assert curr_revnum is None or revnum > curr_revnum
             curr_revnum = revnum
@@ -0,0 +1,128 @@
+# encoding: utf-8
+#
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import unicode_literals
+
+import os
+import tempfile
+from array import array
+
+from mo_times.durations import SECOND
+
+import tuid.compactor
+from tuid.compactor import Compactor
+from tuid.encoding import TUID_TYPECODE, encode_tuids
+from tuid.sql import Sql
+
+
+class _FakeStats(object):
+    def __init__(self):
+        self.compactions = []
+
+    def update_compaction(self, rows=0, pages=0, seconds=0):
+        self.compactions.append((rows, pages))
+
+
+class _FakeShards(object):
+    def __init__(self, conns):
+        self.conns = conns
+
+
+class _FakeService(object):
+    def __init__(self, sharded=False):
+        directory = tempfile.mkdtemp()
+        self.conn = Sql(os.path.join(directory, "compactor.sqlite"))
+        # The annotations are in a separate database when sharded
+        self.shard = Sql(os.path.join(directory, "compactor.shard0.sqlite")) if sharded else self.conn
+        self.shards = _FakeShards([self.conn, self.shard] if sharded else [self.conn])
+        self.statsdaemon = _FakeStats()
+        with self.conn.transaction() as t:
+            t.execute("CREATE TABLE sequences (name TEXT, next INTEGER NOT NULL, PRIMARY KEY(name))")
+            t.execute("CREATE TABLE temporal (tuid INTEGER, revision_id INTEGER, file_id INTEGER, line INTEGER)")
+            t.execute("INSERT INTO sequences (name, next) VALUES ('tuid', 31)")
+            t.executemany(
+                "INSERT INTO temporal (tuid, revision_id, file_id, line) VALUES (?, 1, 1, ?)",
+                [(tuid, tuid) for tuid in range(1, 41)]
+            )
+        for conn in self.shards.conns:
+            with conn.transaction() as t:
+                t.execute("CREATE TABLE annotationBlobs (hash CHAR(40), annotation BLOB, refs INTEGER, PRIMARY KEY(hash))")
+        self.insert_annotation('a', [1, 2, 3])
+
+    def insert_annotation(self, hash, tuids):
+        with self.shard.transaction() as t:
+            t.execute(
+                "INSERT INTO annotationBlobs (hash, annotation, refs) VALUES (?, ?, 1)",
+                (hash, encode_tuids(array(TUID_TYPECODE, tuids)))
+            )
+
+    def get_thread_count(self):
+        return 0
+
+    def tuids(self):
+        return [tuid for tuid, in self.conn.get("SELECT tuid FROM temporal ORDER BY tuid")]
+
+
+def test_compact(monkeypatch):
+    monkeypatch.setattr(tuid.compactor, "COMPACT_BATCH_SIZE", 7)
+    monkeypatch.setattr(tuid.compactor, "COMPACT_BATCH_PAUSE", 0 * SECOND)
+    service = _FakeService()
+    compactor = Compactor(service, start_workers=False)
+
+    rows, pages, _ = compactor.compact()
+
+    # Tuids in an annotation, and those reserved after the
+    # compaction started, are kept
+    assert service.tuids() == [1, 2, 3] + list(range(31, 41))
+    assert rows == 27
+    assert service.statsdaemon.compactions == [(27, 0)]
+    assert compactor.marks is None
+
+
+def test_keep_while_compacting(monkeypatch):
+    monkeypatch.setattr(tuid.compactor, "COMPACT_BATCH_PAUSE", 0 * SECOND)
+    service = _FakeService()
+    compactor = Compactor(service, start_workers=False)
+
+    # Annotations inserted while marking are kept too
+    mark_annotations = compactor._mark_annotations
+
+    def insert_annotation(please_stop):
+        mark_annotations(please_stop)
+        compactor.keep([encode_tuids(array(TUID_TYPECODE, [4, 5]))])
+    compactor._mark_annotations = insert_annotation
+
+    compactor.compact()
+    assert service.tuids() == [1, 2, 3, 4, 5] + list(range(31, 41))
+
+    # Nothing is marked between compactions
+    compactor.keep([encode_tuids(array(TUID_TYPECODE, [6]))])
+    compactor.compact()
+    assert service.tuids() == [1, 2, 3, 4, 5] + list(range(31, 41))
+
+
+def test_keep_looked_up_tuids(monkeypatch):
+    monkeypatch.setattr(tuid.compactor, "COMPACT_BATCH_PAUSE", 0 * SECOND)
+    service = _FakeService(sharded=True)
+    compactor = Compactor(service, start_workers=False)
+
+    # An annotation is inserted in its shard after the tuids of its
+    # lines are looked up in the main database, while compacting
+    mark_annotations = compactor._mark_annotations
+
+    def look_up_tuids(please_stop):
+        mark_annotations(please_stop)
+        with service.conn.transaction() as t:
+            tuids = [tuid for tuid, in t.get("SELECT tuid FROM temporal WHERE tuid IN (7, 8)")]
+            compactor.keep_tuids(tuids)
+    compactor._mark_annotations = look_up_tuids
+
+    rows, _, _ = compactor.compact()
+    service.insert_annotation('b', [7, 8])
+    assert service.tuids() == [1, 2, 3, 7, 8] + list(range(31, 41))
+    assert rows == 25
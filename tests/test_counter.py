@@ -0,0 +1,73 @@
+# encoding: utf-8
+#
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import unicode_literals
+
+import pytest
+from mo_threads import Thread, Signal, Till
+
+from tuid.counter import Semaphore, SingleFlight
+
+
+def test_semaphore():
+    limit = Semaphore(2)
+    release = Signal()
+    entered = []
+
+    def worker(please_stop=None):
+        with limit(10):
+            entered.append(1)
+            release.wait()
+
+    threads = [Thread.run("worker " + str(i), worker) for i in range(2)]
+    while len(entered) < 2:
+        Till(seconds=0.01).wait()
+    assert len(limit) == 2
+
+    # No room, so it times out
+    with pytest.raises(Exception):
+        with limit(0.1):
+            pass
+
+    # A thread leaving lets the next one in
+    release.go()
+    with limit(10):
+        for t in threads:
+            t.join()
+    assert len(limit) == 0
+
+
+def test_single_flight():
+    in_flight = SingleFlight()
+    led, followed = in_flight.claim([("central", "rev1", "a"), ("central", "rev1", "b")])
+    assert led == [("central", "rev1", "a"), ("central", "rev1", "b")]
+    assert followed == []
+
+    # Another thread asks for some of the same files
+    claimed = Signal()
+    waited = []
+
+    def follower(please_stop=None):
+        other_led, other_followed = in_flight.claim([("central", "rev1", "b"), ("central", "rev1", "c")])
+        waited.append(other_led)
+        in_flight.finish(other_led, {})
+        claimed.go()
+        for key, flight in other_followed:
+            waited.append((key, flight.wait()))
+
+    thread = Thread.run("follower", follower)
+    claimed.wait()
+    in_flight.finish(led, {("central", "rev1", "b"): [1, 2, 3]})
+    thread.join()
+
+    assert waited == [[("central", "rev1", "c")], (("central", "rev1", "b"), [1, 2, 3])]
+    assert len(in_flight) == 0
+
+    # A finished key can be claimed again
+    led, _ = in_flight.claim([("central", "rev1", "b")])
+    assert led == [("central", "rev1", "b")]
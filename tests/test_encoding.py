@@ -0,0 +1,114 @@
+# encoding: utf-8
+#
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import unicode_literals
+
+from array import array
+
+from mo_dots import wrap
+from mo_json import json2value
+from tuid.encoding import encode_tuids, decode_tuids, json_tuids, binary_tuids, binary_response_header, \
+    decode_binary_response, encode_diff, decode_diff
+from tuid.util import TuidMap, TuidArray, map_to_array
+
+
+def test_annotation_round_trip():
+    tuids = [TuidMap(tuid, line + 1) for line, tuid in enumerate([5, 3, 2000000000, 7, 1])]
+    annotation = encode_tuids(tuids)
+
+    assert len(annotation) == 1 + 4 * len(tuids)
+    decoded = TuidArray(decode_tuids(annotation))
+    assert list(decoded) == tuids
+    assert decoded == tuids
+    assert decoded[-1] == TuidMap(1, 5)
+    assert map_to_array(decoded) == [5, 3, 2000000000, 7, 1]
+
+    # Encoding a TuidArray gives the same result
+    assert encode_tuids(decoded) == annotation
+
+
+def test_removed_file_annotation():
+    annotation = encode_tuids([])
+    assert len(annotation) == 0
+
+    decoded = decode_tuids(annotation)
+    assert decoded is not None
+    assert len(decoded) == 0
+
+    # No annotation at all
+    assert decode_tuids(None) is None
+
+
+def test_text_annotation_is_readable():
+    # Annotations in the old format are still accepted
+    decoded = decode_tuids("12,1\n13,2\n20,3")
+    assert list(decoded) == [12, 13, 20]
+    assert len(decode_tuids("")) == 0
+
+
+def test_json_tuids():
+    tuids = TuidArray(array(str('i'), range(1, 25001)))
+    assert json2value(b''.join(json_tuids(tuids)).decode('utf8')) == list(range(1, 25001))
+
+    # Pairs with a missing line
+    pairs = [TuidMap(11, 1), TuidMap(13, 3)]
+    assert b''.join(json_tuids(pairs)) == b'[11,null,13]'
+
+    assert b''.join(json_tuids(TuidArray(array(str('i'))))) == b'null'
+    assert b''.join(json_tuids([])) == b'null'
+
+
+def test_binary_response_round_trip():
+    files = [
+        ("dom/base/nsDocument.cpp", TuidArray(array(str('i'), [5, 3, 2000000000]))),
+        ("removed.js", []),
+        ("gap.js", [TuidMap(11, 1), TuidMap(13, 3)])
+    ]
+    response = binary_response_header() + b''.join(binary_tuids(f, t) for f, t in files)
+
+    decoded = decode_binary_response(response)
+    assert [f for f, _ in decoded] == [f for f, _ in files]
+    assert list(decoded[0][1]) == [5, 3, 2000000000]
+    assert decoded[1][1] is None
+    assert list(decoded[2][1]) == [11, 0, 13]
+
+
+def test_diff_round_trip():
+    diff = wrap({
+        "merge": False,
+        "diffs": [
+            {
+                "new": {"name": "/dom/base/Document.cpp"},
+                "old": {"name": "/dom/base/Document.cpp"},
+                "changes": [
+                    {"line": 0, "action": "+"},
+                    {"line": 4, "action": "-"},
+                    {"line": 1000000, "action": "+"},
+                    {"line": 1000001, "action": "\\"}
+                ]
+            },
+            {
+                "new": {"name": "/dom/base/n\u00e9w.h"},
+                "old": {"name": "/dev/null"},
+                "changes": []
+            }
+        ]
+    })
+    encoded = encode_diff(diff)
+    # Header, then paths, change counts and 4 bytes per change
+    assert len(encoded) == 2 + (4 + 22) * 2 + 4 + 4 * 4 + (4 + 9) + (4 + 16) + 4
+
+    decoded = decode_diff(encoded)
+    assert decoded == diff
+    assert decoded['diffs'][0]['changes'][2].line == 1000000
+    assert decoded['diffs'][1]['new'].name == "/dom/base/n\u00e9w.h"
+
+    # Merges keep no moves
+    merge = decode_diff(encode_diff(wrap({"merge": True, "diffs": []})))
+    assert merge['merge'] is True
+    assert not merge['diffs']
@@ -0,0 +1,57 @@
+# encoding: utf-8
+#
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import unicode_literals
+
+import os
+import tempfile
+
+from tuid.intern import InternTable
+from tuid.sql import Sql
+
+
+def _setup():
+    conn = Sql(os.path.join(tempfile.mkdtemp(), "intern.sqlite"))
+    with conn.transaction() as t:
+        t.execute("CREATE TABLE files (file_id INTEGER PRIMARY KEY, file TEXT NOT NULL UNIQUE)")
+    return conn, InternTable(conn, "files", "file_id", "file")
+
+
+def test_add_and_get():
+    conn, file_ids = _setup()
+    with conn.transaction() as t:
+        ids = file_ids.add(t, ["a.cpp", "b.cpp", "a.cpp"])
+        assert sorted(ids) == ["a.cpp", "b.cpp"]
+        # Not cached until the transaction is committed
+        assert len(file_ids) == 0
+    assert len(file_ids) == 2
+
+    with conn.transaction() as t:
+        more = file_ids.add(t, ["b.cpp", "c.cpp"])
+    assert more["b.cpp"] == ids["b.cpp"]
+    assert len(set(more.values()) | set(ids.values())) == 3
+
+    assert file_ids.get(None, ["a.cpp", "d.cpp"]) == {"a.cpp": ids["a.cpp"]}
+
+
+def test_rollback_is_not_cached():
+    conn, file_ids = _setup()
+    try:
+        with conn.transaction() as t:
+            rolled_back = file_ids.add(t, ["a.cpp"])
+            raise Exception("rolling back")
+    except Exception:
+        pass
+    assert len(file_ids) == 0
+    assert file_ids.get(None, ["a.cpp"]) == {}
+
+    # The rolled back id is given to another file
+    with conn.transaction() as t:
+        ids = file_ids.add(t, ["b.cpp"])
+    assert ids["b.cpp"] == rolled_back["a.cpp"]
+    assert file_ids.get(None, ["a.cpp", "b.cpp"]) == ids
@@ -0,0 +1,74 @@
+# encoding: utf-8
+#
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import unicode_literals
+
+from mo_threads import Signal, Till
+
+from tuid.jobs import JobRegistry
+
+
+def _wait_for(job, timeout=10):
+    timer = Till(seconds=timeout)
+    while not job.done and not timer:
+        Till(seconds=0.01).wait()
+    assert job.done
+
+
+def test_job_results():
+    jobs = JobRegistry()
+    job = jobs.submit("rev1", ["a", "b", "c"], lambda files, please_stop: [(f, [1, 2]) for f in files], 2)
+    _wait_for(job)
+
+    assert jobs.get(job.id) is job
+    assert job.get_results() == [("a", [1, 2]), ("b", [1, 2]), ("c", [1, 2])]
+    status = job.status()
+    assert status['status'] == "done"
+    assert status['complete'] == 3
+    assert status['failed'] == 0
+    assert jobs.get("unknown") is None
+
+
+def test_in_flight_files_are_not_repeated():
+    jobs = JobRegistry()
+    release = Signal()
+    processed = []
+
+    def work(files, please_stop=None):
+        processed.extend(files)
+        release.wait()
+        return [(f, [len(f)]) for f in files]
+
+    first = jobs.submit("rev1", ["a", "bb"], work, 10)
+    second = jobs.submit("rev1", ["bb", "ccc"], work, 10)
+    # Same files, again, gives the same job
+    assert jobs.submit("rev1", ["bb", "a"], work, 10) is first
+    # Other revisions are separate
+    other = jobs.submit("rev2", ["a"], work, 10)
+
+    assert not second.done
+    assert second.status()['complete'] == 0
+    release.go()
+    _wait_for(second)
+    _wait_for(other)
+
+    assert sorted(processed) == ["a", "a", "bb", "ccc"]
+    assert second.get_results() == [("bb", [2]), ("ccc", [3])]
+
+
+def test_failed_job():
+    jobs = JobRegistry()
+
+    def work(files, please_stop=None):
+        raise Exception("hg is down")
+
+    job = jobs.submit("rev1", ["a"], work, 10)
+    _wait_for(job)
+    assert job.get_results() == [("a", [])]
+    assert job.status()['failed'] == 1
+    assert not jobs.in_flight
@@ -0,0 +1,47 @@
+# encoding: utf-8
+#
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import unicode_literals
+
+from tuid.lru import LRUCache
+
+
+def _sizeof(key, value):
+    return len(value)
+
+
+def test_lru_evicts_by_size():
+    cache = LRUCache(10, _sizeof)
+    assert cache.set(("rev1", "a"), "aaaa") == 0
+    assert cache.set(("rev1", "b"), "bbbb") == 0
+
+    # Using `a` makes `b` the least recently used
+    assert cache.get(("rev1", "a")) == "aaaa"
+    assert cache.set(("rev2", "c"), "cccc") == 1
+
+    assert cache.get(("rev1", "b")) is None
+    assert cache.get(("rev1", "a")) == "aaaa"
+    assert cache.get(("rev2", "c")) == "cccc"
+    assert cache.bytes == 8
+
+    # Too big to ever fit
+    assert cache.set(("rev2", "d"), "d" * 11) == 0
+    assert cache.get(("rev2", "d")) is None
+    assert len(cache) == 2
+
+
+def test_lru_remove_revisions():
+    cache = LRUCache(100, _sizeof)
+    cache.set(("rev1", "a"), "aaaa")
+    cache.set(("rev1", "b"), "bb")
+    cache.set(("rev2", "a"), "a")
+
+    assert cache.remove(lambda key: key[0] in {"rev1"}) == 2
+    assert cache.get(("rev1", "a")) is None
+    assert cache.get(("rev2", "a")) == "a"
+    assert cache.bytes == 1
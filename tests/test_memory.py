@@ -12,7 +12,7 @@ import json
 
 import pytest
 
-from mo_dots import Null
+from mo_dots import Null, wrap
 from mo_logs import Log, Except
 from mo_threads import Thread, Till
 from mo_times import Timer
@@ -63,9 +63,10 @@ def test_annotation_memory(service):
         #files_to_get = [random.choice(files) for _ in range(total_files)]
 
         with service.conn.transaction() as t:
-            t.execute("DELETE FROM temporal WHERE file IN " + quote_set(files_to_get))
-            t.execute("DELETE FROM annotations WHERE file IN " + quote_set(files_to_get))
-            t.execute("DELETE FROM latestFileMod WHERE file IN " + quote_set(files_to_get))
+            t.execute("DELETE FROM temporal WHERE file_id IN (SELECT file_id FROM files WHERE file IN " + quote_set(files_to_get) + ")")
+            t.execute("DELETE FROM annotations WHERE file_id IN (SELECT file_id FROM files WHERE file IN " + quote_set(files_to_get) + ")")
+            t.execute("DELETE FROM latestFileMod WHERE file_id IN (SELECT file_id FROM files WHERE file IN " + quote_set(files_to_get) + ")")
+        service.annotation_cache.clear()
 
         if start_mem == -1:
             start_mem = round(process.memory_info().rss / (1000 * 1000), 2)
@@ -108,4 +109,51 @@ def test_annotation_memory(service):
     plt.xlabel("Trial count")
     plt.ylabel("Memory usage (%)")
 
-    plt.show(block=True)
\ No newline at end of file
+    plt.show(block=True)
+
+
+@pytest.mark.skip("Used for local memory use testing.")
+def test_steady_state_memory(service):
+    # Annotates the same files over and over, from annotations shaped
+    # like hg's json-annotate so that hg is not needed. Once the tuids
+    # exist, memory use should stay flat without forcing collections.
+    import psutil
+    import os
+
+    total_trials = 200
+    warmup_trials = 20
+    max_growth = 5  # Mb
+    revision = "0badc0ffee00"
+    files = ["memory/test/file" + str(i) + ".cpp" for i in range(20)]
+    annotated_files = [
+        wrap({"annotate": [
+            {"abspath": file, "node": "%040x" % (line % 100), "targetline": line // 100 + 1}
+            for line in range(5000)
+        ]})
+        for file in files
+    ]
+
+    process = psutil.Process(os.getpid())
+    all_end_mems = []
+    for i in range(total_trials):
+        with service.conn.transaction() as t:
+            t.execute("DELETE FROM annotations WHERE file_id IN (SELECT file_id FROM files WHERE file IN " + quote_set(files) + ")")
+        service.annotation_cache.clear()
+
+        with service.conn.transaction() as t:
+            results = service._get_tuids(t, files, revision, annotated_files)
+        assert len(results) == len(files)
+        assert all(len(tuids) == 5000 for _, tuids in results)
+        del results
+
+        all_end_mems.append(round(process.memory_info().rss / (1000 * 1000), 2))
+
+    growth = all_end_mems[-1] - all_end_mems[warmup_trials]
+    Log.note(
+        "Memory after {{warmup}} trials: {{start}} Mb, after {{total}}: {{end}} Mb",
+        warmup=warmup_trials,
+        start=all_end_mems[warmup_trials],
+        total=total_trials,
+        end=all_end_mems[-1]
+    )
+    assert growth < max_growth
@@ -0,0 +1,46 @@
+# encoding: utf-8
+#
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import unicode_literals
+
+import pytest
+from mo_threads import Signal, Till
+
+from tuid.pool import WorkerPool
+
+
+def _square(value, please_stop=None):
+    return value * value
+
+
+def _fail(please_stop=None):
+    raise Exception("hg is down")
+
+
+def test_pool_results():
+    pool = WorkerPool("test", 3)
+    futures = [pool.submit(_square, i) for i in range(20)]
+    assert [f.result() for f in futures] == [i * i for i in range(20)]
+
+    with pytest.raises(Exception):
+        pool.submit(_fail).result()
+    pool.stop()
+
+
+def test_pool_timeout():
+    pool = WorkerPool("test", 1)
+    release = Signal()
+    blocked = pool.submit(lambda please_stop: release.wait())
+    waiting = pool.submit(_square, 3)
+
+    # The only worker is busy
+    assert not waiting.wait(till=Till(seconds=0.2))
+    release.go()
+    assert blocked.wait(till=Till(seconds=5))
+    assert waiting.result(till=Till(seconds=5)) == 9
+    pool.stop()
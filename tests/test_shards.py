@@ -0,0 +1,100 @@
+# encoding: utf-8
+#
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import unicode_literals
+
+import os
+import tempfile
+
+import pytest
+from mo_threads import Thread
+
+from tuid.intern import InternTable
+from tuid.shards import Shards
+from tuid.sql import Sql
+
+
+class _FakeService(object):
+    def __init__(self, directory):
+        self.conn = Sql(os.path.join(directory, "tuid.sqlite"))
+        self.file_ids = InternTable(self.conn, "files", "file_id", "file")
+        self.revision_ids = InternTable(self.conn, "revisions", "revision_id", "revision")
+        self.initialized = []
+
+    def init_shard(self, conn):
+        with conn.transaction() as t:
+            t.execute("CREATE TABLE files (file_id INTEGER PRIMARY KEY, file TEXT NOT NULL UNIQUE)")
+        self.initialized.append(conn)
+
+
+FILES = ["dom/base/Document.cpp", "js/src/jit/Ion.cpp", "layout/base/nsLayoutUtils.cpp", "README.txt"]
+
+
+def test_not_sharded():
+    directory = tempfile.mkdtemp()
+    service = _FakeService(directory)
+    shards = Shards(service, os.path.join(directory, "tuid.sqlite"))
+
+    assert len(shards) == 1
+    assert shards.of(FILES[0]).conn is service.conn
+    assert shards.of(FILES[0]).file_ids is service.file_ids
+    assert shards.conns == [service.conn]
+    assert shards.group(FILES) == [(shards.of(FILES[0]), FILES)]
+    assert shards.group([]) == []
+    assert shards.of_all(FILES) is shards.of(FILES[0])
+    assert service.initialized == []
+
+
+def test_sharded():
+    directory = tempfile.mkdtemp()
+    database = {"name": os.path.join(directory, "tuid.sqlite"), "shards": 3}
+    service = _FakeService(directory)
+    shards = Shards(service, database)
+
+    assert len(shards) == 3
+    assert sorted(os.listdir(directory)) == ["tuid.shard0.sqlite", "tuid.shard1.sqlite", "tuid.shard2.sqlite", "tuid.sqlite"]
+    assert len(service.initialized) == 3
+    assert shards.conns[0] is service.conn and len(shards.conns) == 4
+
+    # Each file is always in the same shard, and its items are grouped with it
+    groups = shards.group([(file, i) for i, file in enumerate(FILES)], key=lambda item: item[0])
+    assert sorted(item for _, items in groups for item in items) == sorted((file, i) for i, file in enumerate(FILES))
+    for shard, items in groups:
+        assert all(shards.of(file) is shard for file, _ in items)
+
+    # Work on one shard is refused files of another
+    shard, items = groups[0]
+    assert shards.of_all([file for file, _ in items]) is shard
+    other = [file for file in FILES if shards.of(file) is not shard][0]
+    with pytest.raises(Exception):
+        shards.of_all([items[0][0], other])
+
+    # Shards are not initialized again on restart
+    reopened = Shards(_FakeService(directory), database)
+    assert [shard.number for shard in reopened] == [0, 1, 2]
+    assert [reopened.of(file).number for file in FILES] == [shards.of(file).number for file in FILES]
+    assert len(service.initialized) == 3
+
+
+def test_map():
+    directory = tempfile.mkdtemp()
+    shards = Shards(_FakeService(directory), {"name": os.path.join(directory, "tuid.sqlite"), "shards": 4})
+    files = ["file" + str(i) + ".cpp" for i in range(40)]
+
+    def count(shard, shard_files):
+        with shard.conn.transaction() as t:
+            shard.file_ids.add(t, shard_files)
+        return shard.number, sorted(shard_files), Thread.current().name
+
+    results = shards.map(count, files)
+    assert sorted(file for _, shard_files, _ in results for file in shard_files) == sorted(files)
+    assert [number for number, _, _ in results] == [shard.number for shard, _ in shards.group(files)]
+    # The first shard is done by the calling thread, the others at the same time
+    assert [name for _, _, name in results[1:]] == ["shard " + str(number) for number, _, _ in results[1:]]
+    for number, shard_files, _ in results:
+        assert sorted(shards.of(shard_files[0]).file_ids.get(None, shard_files)) == shard_files
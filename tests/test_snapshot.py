@@ -0,0 +1,94 @@
+# encoding: utf-8
+#
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import unicode_literals
+
+import os
+import tempfile
+from array import array
+
+from tuid.encoding import TUID_TYPECODE, annotation_hash, encode_tuids
+from tuid.intern import InternTable
+from tuid.shards import Shards
+from tuid.snapshot import Snapshot, Snapshots, write_snapshot
+from tuid.sql import Sql
+
+
+class _FakeService(object):
+    def __init__(self):
+        filename = os.path.join(tempfile.mkdtemp(), "snapshot.sqlite")
+        self.conn = Sql(filename)
+        with self.conn.transaction() as t:
+            t.execute("CREATE TABLE files (file_id INTEGER PRIMARY KEY, file TEXT NOT NULL UNIQUE)")
+            t.execute("CREATE TABLE revisions (revision_id INTEGER PRIMARY KEY, revision CHAR(12) NOT NULL UNIQUE)")
+            t.execute("CREATE TABLE annotationBlobs (hash CHAR(40), annotation BLOB, refs INTEGER, PRIMARY KEY(hash))")
+            t.execute("CREATE TABLE annotations (revision_id INTEGER, file_id INTEGER, hash CHAR(40))")
+        self.file_ids = InternTable(self.conn, "files", "file_id", "file")
+        self.revision_ids = InternTable(self.conn, "revisions", "revision_id", "revision")
+        self.shards = Shards(self, filename)
+
+    def insert_annotations(self, data):
+        with self.conn.transaction() as t:
+            revision_ids = self.revision_ids.add(t, [rev for rev, _, _ in data])
+            file_ids = self.file_ids.add(t, [file for _, file, _ in data])
+            for rev, file, annotation in data:
+                hash = annotation_hash(annotation)
+                t.execute("INSERT OR IGNORE INTO annotationBlobs (hash, annotation, refs) VALUES (?, ?, 0)", (hash, annotation))
+                t.execute("INSERT INTO annotations (revision_id, file_id, hash) VALUES (?, ?, ?)", (revision_ids[rev], file_ids[file], hash))
+
+
+def _annotation(tuids):
+    return encode_tuids(array(TUID_TYPECODE, tuids))
+
+
+def test_write_and_read():
+    filename = os.path.join(tempfile.mkdtemp(), "000000000001.snapshot")
+    num_files = write_snapshot(filename, "000000000001", [
+        (["a.cpp", "c.cpp"], _annotation([1, 2, 3])),
+        (["b.cpp"], _annotation([])),
+    ])
+    assert num_files == 3
+
+    snapshot = Snapshot(filename)
+    assert snapshot.revision == "000000000001"
+    assert len(snapshot) == 3
+    assert list(snapshot.get("a.cpp").tuids) == [1, 2, 3]
+    assert list(snapshot.get("c.cpp").tuids) == [1, 2, 3]
+    # The file does not exist at this revision
+    assert len(snapshot.get("b.cpp")) == 0
+    assert snapshot.get("d.cpp") is None
+
+
+def test_build():
+    service = _FakeService()
+    service.insert_annotations([
+        ("000000000001", "a.cpp", _annotation([1, 2])),
+        ("000000000001", "b.cpp", _annotation([3])),
+        ("000000000002", "a.cpp", _annotation([1, 4, 2])),
+    ])
+    directory = os.path.join(tempfile.mkdtemp(), "snapshots")
+    snapshots = Snapshots(service, directory, max_snapshots=1)
+
+    snapshots.build("000000000001")
+    found = dict(snapshots.get_tuids("000000000001", ["a.cpp", "b.cpp", "c.cpp"]))
+    assert sorted(found) == ["a.cpp", "b.cpp"]
+    assert list(found["a.cpp"].tuids) == [1, 2]
+    assert snapshots.get_tuids("000000000002", ["a.cpp"]) == []
+
+    # Only the newest snapshot is kept
+    snapshots.build("000000000002")
+    assert snapshots.get_tuids("000000000001", ["a.cpp"]) == []
+    assert os.listdir(directory) == ["000000000002.snapshot"]
+
+    # Snapshots are opened again on restart
+    reopened = Snapshots(service, directory)
+    assert [list(tuids.tuids) for _, tuids in reopened.get_tuids("000000000002", ["a.cpp"])] == [[1, 4, 2]]
+
+    reopened.remove(["000000000002"])
+    assert reopened.get_tuids("000000000002", ["a.cpp"]) == []
+    assert os.listdir(directory) == []
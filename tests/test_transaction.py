@@ -8,10 +8,18 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import unicode_literals
 
+import os
+import tempfile
+
+import pytest
+
+from jx_python import jx
 from mo_dots import Data
+from mo_logs import Log
 from mo_threads import Signal, Thread
-from pyLibrary.sql import sqlite, sql_iso
-from pyLibrary.sql.sqlite import Sqlite, quote_value, DOUBLE_TRANSACTION_ERROR
+from mo_times import Timer
+from pyLibrary.sql import sqlite, sql_iso, sql_list
+from pyLibrary.sql.sqlite import Sqlite, quote_value, quote_list, DOUBLE_TRANSACTION_ERROR
 
 sqlite.DEBUG = True
 
@@ -92,6 +100,78 @@ def test_nested_transaction2():
     _teardown(db, {})
 
 
+def test_bound_parameters():
+    db = Sqlite()
+    db.query("CREATE TABLE my_table (name TEXT, value INTEGER, data BLOB)")
+
+    with db.transaction() as t:
+        t.execute("INSERT INTO my_table VALUES (?, ?, ?)", ("it's", 1, None))
+        t.executemany(
+            "INSERT INTO my_table VALUES (?, ?, ?)",
+            [("b", i, bytearray([i])) for i in range(2, 5)]
+        )
+        result = t.query("SELECT value FROM my_table WHERE name=?", ("it's",))
+        assert result.data[0][0] == 1
+
+    result = db.query("SELECT name, value, typeof(data), data FROM my_table WHERE value >= ? ORDER BY value", (3,))
+    assert [(name, value, type) for name, value, type, _ in result.data] == [("b", 3, "blob"), ("b", 4, "blob")]
+    assert bytearray(result.data[0][3]) == bytearray([3])
+
+
+def test_reader_connections():
+    filename = os.path.join(tempfile.mkdtemp(), "readers.sqlite")
+    db = Sqlite(filename=filename, wal=True, readers=2)
+    db.query("CREATE TABLE my_table (value TEXT)")
+    with db.transaction() as t:
+        t.execute("INSERT INTO my_table VALUES (?)", ("a",))
+
+    # Selects are served by the reader connections
+    num_reads = db.wait_stats['readers']['count']
+    result = db.query("SELECT value FROM my_table")
+    assert result.data[0][0] == 'a'
+    assert db.wait_stats['readers']['count'] == num_reads + 1
+
+    with db.read_transaction() as t:
+        assert t.query("SELECT count(1) FROM my_table").data[0][0] == 1
+        try:
+            t.execute("INSERT INTO my_table VALUES ('b')")
+            assert False
+        except Exception as e:
+            assert "read transaction" in e
+
+    db.close()
+
+
+@pytest.mark.skip("Used for local performance testing.")
+def test_insert_performance():
+    num_rows = 1000 * 1000
+    rows = [(i, "0123456789ab", "dom/base/file" + str(i % 1000) + ".cpp", i % 5000) for i in range(num_rows)]
+    create = "CREATE TABLE temporal (tuid INTEGER, revision CHAR(12) NOT NULL, file TEXT, line INTEGER)"
+
+    db = Sqlite()
+    db.query(create)
+    with Timer("insert rows as literal VALUES") as literal_timer:
+        with db.transaction() as t:
+            for _, inserts_list in jx.groupby(rows, size=500):
+                t.execute(
+                    "INSERT INTO temporal (tuid, revision, file, line) VALUES " +
+                    sql_list(quote_list(row) for row in inserts_list)
+                )
+
+    db = Sqlite()
+    db.query(create)
+    with Timer("insert rows with executemany") as bound_timer:
+        with db.transaction() as t:
+            t.executemany("INSERT INTO temporal (tuid, revision, file, line) VALUES (?, ?, ?, ?)", rows)
+
+    assert db.query("SELECT count(1) FROM temporal").data[0][0] == num_rows
+    Log.note(
+        "Literal VALUES: {{literal}}, executemany: {{bound}}",
+        literal=literal_timer.duration,
+        bound=bound_timer.duration
+    )
+
+
 # # def test_all_combinations():
 # #     # ALL 8bit NUMBERS WITH 4 ONES (AND 4 ZEROS), NOT INCLUDING PALINDROMES
 # #     for sequence in SEQUENCE_COMBOS:
@@ -0,0 +1,81 @@
+# encoding: utf-8
+#
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import unicode_literals
+
+from mo_dots import wrap
+from mo_threads import Signal, Till
+
+from tuid.warmer import FileRequests, Warmer
+
+
+class _FakeSnapshots(object):
+    def __init__(self):
+        self.built = []
+        self.done = Signal()
+
+    def build(self, revision):
+        self.built.append(revision)
+        self.done.go()
+
+
+class _FakeService(object):
+    def __init__(self):
+        self.config = wrap({"hg": {"branch": "mozilla-central"}})
+        self.prefetched = []
+        self.requested = []
+        self.snapshots = _FakeSnapshots()
+
+    def get_thread_count(self):
+        return 0
+
+    def prefetch_diffs(self, csets, repo=None, please_stop=None):
+        self.prefetched.append(csets)
+
+    def get_tuids_from_files(self, files, revision, going_forward=False, repo=None, use_thread=True):
+        self.requested.append((files, revision))
+        return [(file, []) for file in files], True
+
+
+def test_most_requested():
+    requests = FileRequests(max_files=4)
+    requests.add(["a", "b", "c"])
+    requests.add(["b", "c"])
+    requests.add(["c"])
+    assert requests.most_requested(2) == ["c", "b"]
+
+    # Tracking too many files decays the counts, and
+    # drops those that were requested once
+    requests.add(["d", "e"])
+    assert len(requests) == 2
+    assert requests.most_requested(10) == ["b", "c"]
+
+
+def test_warm_newest_tip():
+    service = _FakeService()
+    warmer = Warmer(service, num_files=2)
+    warmer.add_requests(["/dom/a.cpp", "dom/b.cpp", "dom/c.cpp"])
+    warmer.add_requests(["dom/b.cpp", "dom/c.cpp"])
+
+    warmer.add_tip(["000000000002", "000000000001"])
+    (service.snapshots.done | Till(seconds=10)).wait()
+    warmer.thread.stop()
+    warmer.thread.join()
+
+    assert service.prefetched == [["000000000002", "000000000001"]]
+    assert service.requested == [(["dom/b.cpp", "dom/c.cpp"], "000000000002")]
+    assert service.snapshots.built == ["000000000002"]
+
+
+def test_requests_only():
+    service = _FakeService()
+    warmer = Warmer(service, start_workers=False)
+    warmer.add_requests(["dom/a.cpp"])
+    warmer.add_tip(["000000000001"])
+    assert warmer.requests.most_requested(1) == ["dom/a.cpp"]
+    assert len(warmer.todo) == 0
@@ -25,14 +25,17 @@ from mo_threads.threads import RegisterThread
 from mo_times import Timer
 from pyLibrary.env import http
 from pyLibrary.env.flask_wrappers import cors_wrapper
+from tuid.encoding import json_tuids, binary_tuids, binary_response_header
 from tuid.service import TUIDService
-from tuid.util import map_to_array
 
 OVERVIEW = None
 QUERY_SIZE_LIMIT = 10 * 1000 * 1000
 EXPECTING_QUERY = b"expecting query\r\n"
 TOO_BUSY = 10
 TOO_MANY_THREADS = 4
+RESPONSE_BUFFER_BYTES = 64 * 1024  # Response is sent in pieces of at least this size
+BINARY_CONTENT_TYPE = "application/x-tuid-binary"
+JOBS_PATH = "/tuid/jobs/"
 
 
 class TUIDApp(Flask):
@@ -104,9 +107,10 @@ def tuid_endpoint(path):
                 branch_name = coalesce(branch_name, a.eq.branch)
             paths = listwrap(paths)
 
+            job = None
             if len(paths) == 0:
                 response, completed = [], True
-            elif service.conn.pending_transactions > TOO_BUSY:  # CHECK IF service IS VERY BUSY
+            elif service.shards.pending_transactions > TOO_BUSY:  # CHECK IF service IS VERY BUSY
                 # TODO:  BE SURE TO UPDATE STATS TOO
                 Log.note("Too many open transactions")
                 response, completed = [], False
@@ -115,8 +119,10 @@ def tuid_endpoint(path):
                 response, completed = [], False
             else:
                 # RETURN TUIDS
+                if branch_name == service.config.hg.branch:
+                    service.warmer.add_requests(paths)
                 with Timer("tuid internal response time for {{num}} files", {"num": len(paths)}):
-                    response, completed = service.get_tuids_from_files(
+                    response, completed, job = service.get_tuids_and_job(
                         revision=rev, files=paths, going_forward=True, repo=branch_name
                     )
 
@@ -126,10 +132,11 @@ def tuid_endpoint(path):
                         num=len(paths), rev=rev
                     )
 
-            if query.meta.format == 'list':
-                formatter = _stream_list
-            else:
-                formatter = _stream_table
+            formatter, content_type = _get_formatter(query.meta.format)
+            headers = {"Content-Type": content_type}
+            if job:
+                # THE CLIENT CAN GET THE REMAINING FILES FROM THE JOB
+                headers["Location"] = JOBS_PATH + job.id
 
             service.statsdaemon.update_requests(
                 requests_complete=1 if completed else 0,
@@ -138,11 +145,9 @@ def tuid_endpoint(path):
             )
 
             return Response(
-                formatter(response),
+                _buffered(formatter(response, job)),
                 status=200 if completed else 202,
-                headers={
-                    "Content-Type": "application/json"
-                }
+                headers=headers
             )
         except Exception as e:
             e = Except.wrap(e)
@@ -157,26 +162,105 @@ def tuid_endpoint(path):
             )
 
 
-def _stream_table(files):
-    yield b'{"format":"table", "header":["path", "tuids"], "data":['
+@cors_wrapper
+def job_endpoint(job_id):
+    with RegisterThread():
+        job = service.jobs.get(job_id)
+        if job is None:
+            return Response(
+                unicode2utf8("unknown job (results are kept for a while after the job is done)"),
+                status=404,
+                headers={
+                    "Content-Type": "text/html"
+                }
+            )
+
+        status = job.status()
+        if status['status'] != "done":
+            return Response(
+                unicode2utf8(value2json(status)),
+                status=202,
+                headers={
+                    "Content-Type": "application/json"
+                }
+            )
+
+        formatter, content_type = _get_formatter(flask.request.args.get("format"))
+        return Response(
+            _buffered(formatter(job.get_results())),
+            status=200,
+            headers={
+                "Content-Type": content_type
+            }
+        )
+
+
+def _get_formatter(format):
+    if format == 'list':
+        return _stream_list, "application/json"
+    elif format == 'binary':
+        return _stream_binary, BINARY_CONTENT_TYPE
+    else:
+        return _stream_table, "application/json"
+
+
+def _job_property(job):
+    if not job:
+        return b''
+    return b'"job":' + value2json(job.id).encode('utf8') + b', '
+
+
+def _stream_table(files, job=None):
+    sep = b'{"format":"table", ' + _job_property(job) + b'"header":["path", "tuids"], "data":['
     for f, pairs in files:
-        yield value2json([f, map_to_array(pairs)]).encode('utf8')
+        yield sep
+        yield b'[' + value2json(f).encode('utf8') + b','
+        for chunk in json_tuids(pairs):
+            yield chunk
+        yield b']'
+        sep = b","
+    if sep != b",":
+        yield sep
     yield b']}'
 
 
-def _stream_list(files):
+def _stream_list(files, job=None):
     if not files:
-        yield b'{"format":"list", "data":[]}'
+        yield b'{"format":"list", ' + _job_property(job) + b'"data":[]}'
         return
 
-    sep = b'{"format":"list", "data":['
+    sep = b'{"format":"list", ' + _job_property(job) + b'"data":['
     for f, pairs in files:
         yield sep
-        yield value2json({"path": f, "tuids": map_to_array(pairs)}).encode('utf8')
+        yield b'{"path":' + value2json(f).encode('utf8') + b',"tuids":'
+        for chunk in json_tuids(pairs):
+            yield chunk
+        yield b'}'
         sep = b","
     yield b']}'
 
 
+def _stream_binary(files, job=None):
+    yield binary_response_header()
+    for f, pairs in files:
+        yield binary_tuids(f, pairs)
+
+
+def _buffered(chunks):
+    # Join the small pieces, so the server writes fewer, larger, blocks
+    buffer = []
+    size = 0
+    for chunk in chunks:
+        buffer.append(chunk)
+        size += len(chunk)
+        if size >= RESPONSE_BUFFER_BYTES:
+            yield b''.join(buffer)
+            buffer = []
+            size = 0
+    if buffer:
+        yield b''.join(buffer)
+
+
 @cors_wrapper
 def _head(path):
     return Response(b'', status=200)
@@ -198,6 +282,7 @@ if __name__ in ("__main__",):
     flask_app = TUIDApp(__name__)
     flask_app.add_url_rule(str('/'), None, tuid_endpoint, defaults={'path': ''}, methods=[str('GET'), str('POST')])
     flask_app.add_url_rule(str('/<path:path>'), None, tuid_endpoint, methods=[str('GET'), str('POST')])
+    flask_app.add_url_rule(str(JOBS_PATH + '<job_id>'), None, job_endpoint, methods=[str('GET')])
 
 
     try:
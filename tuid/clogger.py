@@ -23,7 +23,7 @@ from mo_threads import Till, Thread, Lock, Queue, Signal
 from mo_threads.threads import ALL
 from mo_times.durations import DAY
 from pyLibrary.env import http
-from pyLibrary.sql import sql_list, quote_set
+from pyLibrary.sql import quote_set
 from tuid import sql
 from tuid.util import HG_URL, insert_into_db_chunked
 
@@ -59,7 +59,7 @@ class Clogger:
     def __init__(self, conn=None, tuid_service=None, start_workers=True, new_table=False, kwargs=None):
         try:
             self.config = kwargs
-            self.conn = conn if conn else sql.Sql(self.config.database.name)
+            self.conn = conn if conn else sql.Sql(self.config.database)
             self.hg_cache = HgMozillaOrg(kwargs=self.config.hg_cache, use_cache=True) if self.config.hg_cache else Null
 
             self.tuid_service = tuid_service if tuid_service else tuid.service.TUIDService(
@@ -73,7 +73,6 @@ class Clogger:
                     t.execute("DROP TABLE IF EXISTS csetLog")
 
             self.init_db()
-            self.next_revnum = coalesce(self.conn.get_one("SELECT max(revnum)+1 FROM csetLog")[0], 1)
             self.csets_todo_backwards = Queue(name="Clogger.csets_todo_backwards")
             self.deletions_todo = Queue(name="Clogger.deletions_todo")
             self.maintenance_signal = Signal(name="Clogger.maintenance_signal")
@@ -146,6 +145,14 @@ class Clogger:
 
 
     def init_db(self):
+        '''
+        Creates the csetLog table. Revnums order the changesets, they
+        are never recomputed: new tips get numbers above the maximum,
+        backfilled changesets get numbers below the minimum (going
+        negative if needed), and deletions leave gaps.
+
+        :return:
+        '''
         with self.conn.transaction() as t:
             t.execute('''
             CREATE TABLE IF NOT EXISTS csetLog (
@@ -153,6 +160,7 @@ class Clogger:
                 revision       CHAR(12) NOT NULL,
                 timestamp      INTEGER
             );''')
+            t.execute("CREATE INDEX IF NOT EXISTS csetLog_revision ON csetLog(revision)")
 
 
     def disable_all(self):
@@ -205,6 +213,19 @@ class Clogger:
         return transaction.get_one("SELECT revnum FROM csetLog WHERE revision=?", (rev,))
 
 
+    def _get_existing_revisions(self, transaction, revisions):
+        # Returns the set of the given revisions that are in the table
+        existing = set()
+        for _, revisions_chunk in jx.groupby(revisions, size=SQL_CSET_BATCH_SIZE):
+            existing.update(
+                rev
+                for rev, in transaction.get(
+                    "SELECT revision FROM csetLog WHERE revision IN " + quote_set(revisions_chunk)
+                )
+            )
+        return existing
+
+
     def _get_revnum_range(self, transaction, revnum1, revnum2):
         # Returns a range of revision numbers (that is inclusive)
         high_num = max(revnum1, revnum2)
@@ -216,34 +237,6 @@ class Clogger:
         ).data
 
 
-    def recompute_table_revnums(self):
-        '''
-        Recomputes the revnums for the csetLog table
-        by creating a new table, and copying csetLog to
-        it. The INTEGER PRIMARY KEY in the temp table auto increments
-        as rows are added.
-
-        IMPORTANT: Only call this after acquiring the
-                   lock `self.working_locker`.
-        :return:
-        '''
-        with self.conn.transaction() as t:
-            t.execute('''
-            CREATE TABLE temp (
-                revnum         INTEGER PRIMARY KEY,
-                revision       CHAR(12) NOT NULL,
-                timestamp      INTEGER
-            );''')
-
-            t.execute(
-                "INSERT INTO temp (revision, timestamp) "
-                "SELECT revision, timestamp FROM csetlog ORDER BY revnum ASC"
-            )
-
-            t.execute("DROP TABLE csetLog;")
-            t.execute("ALTER TABLE temp RENAME TO csetLog;")
-
-
     def check_for_maintenance(self):
         '''
         Returns True if the maintenance worker should be run now,
@@ -267,16 +260,14 @@ class Clogger:
                           but if holes exist: (delete, None, delete, None)
                           those delete's with None's around them
                           will not be deleted.
-        :param numbered: If True, this function will number the revision list
-                         by going forward from max(revNum), else it'll go backwards
-                         from revNum, then add X to all revnums and self.next_revnum
-                         where X is the length of ordered_rev_list
+        :param number_forward: If True, this function will number the revision list
+                               by going forward from max(revnum), else it'll go backwards
+                               from min(revnum). The existing entries are never renumbered.
         :return:
         '''
         with self.conn.transaction() as t:
-            current_min = t.get_one("SELECT min(revnum) FROM csetlog")[0]
-            current_max = t.get_one("SELECT max(revnum) FROM csetlog")[0]
-            if not current_min or not current_max:
+            current_min, current_max = t.get_one("SELECT min(revnum), max(revnum) FROM csetLog")
+            if current_min == None or current_max == None:
                 current_min = 0
                 current_max = 0
 
@@ -287,34 +278,23 @@ class Clogger:
                 start = current_max + 1
                 ordered_rev_list = ordered_rev_list[::-1]
 
+            # In case of overlapping requests
+            existing_revisions = self._get_existing_revisions(t, ordered_rev_list)
             insert_list = [
                 (
                     start + direction * count,
                     rev,
                     int(time.time()) if timestamp else -1
                 )
-                for count, rev in enumerate(ordered_rev_list)
-            ]
-
-            # In case of overlapping requests
-            fmt_insert_list = []
-            for cset_entry in insert_list:
-                tmp = self._get_one_revision(t, cset_entry)
-                if not tmp:
-                    fmt_insert_list.append(cset_entry)
-
-            for _, tmp_insert_list in jx.groupby(fmt_insert_list, size=SQL_CSET_BATCH_SIZE):
-                t.execute(
-                    "INSERT INTO csetLog (revnum, revision, timestamp)" +
-                    " VALUES " +
-                    sql_list(
-                        quote_set((revnum, revision, timestamp))
-                        for revnum, revision, timestamp in tmp_insert_list
-                    )
+                for count, rev in enumerate(
+                    rev for rev in ordered_rev_list if rev not in existing_revisions
                 )
+            ]
 
-            # Move the revision numbers forward if needed
-            self.recompute_table_revnums()
+            t.executemany(
+                "INSERT INTO csetLog (revnum, revision, timestamp) VALUES (?, ?, ?)",
+                insert_list
+            )
 
         # Start a maintenance run if needed
         if self.check_for_maintenance():
@@ -556,6 +536,10 @@ class Clogger:
         with self.working_locker:
             Log.note("Adding {{csets}}", csets=csets_to_add)
             self.add_cset_entries(csets_to_add, timestamp=False)
+
+        # New changesets are soon requested, get their diffs and
+        # move the frontiers of the most requested files to them
+        self.tuid_service.warmer.add_tip(csets_to_add)
         return True
 
 
@@ -646,15 +630,7 @@ class Clogger:
                             oldest=TIME_TO_KEEP_ANNOTATIONS,
                             revisions=annrevs_to_del
                         )
-                        with self.conn.transaction() as t:
-                            t.execute(
-                                "DELETE FROM latestFileMod WHERE revision IN " +
-                                quote_set(annrevs_to_del)
-                            )
-                            t.execute(
-                                "DELETE FROM annotations WHERE revision IN " +
-                                quote_set(annrevs_to_del)
-                            )
+                        self.tuid_service.delete_annotations(annrevs_to_del)
 
                     # Delete any overflowing entries
                     new_data2 = new_data1
@@ -671,11 +647,7 @@ class Clogger:
                         if UPDATE_VERY_OLD_FRONTIERS:
                             _, max_revision, _ = all_data[-1]
                             for _, revision, _ in deleted_data:
-                                with self.conn.transaction() as t:
-                                    old_files = t.get(
-                                        "SELECT file FROM latestFileMod WHERE revision=?",
-                                        (revision,)
-                                    )
+                                old_files = self.tuid_service.get_frontier_files(revision)
                                 if old_files is None or len(old_files) <= 0:
                                     continue
 
@@ -688,11 +660,7 @@ class Clogger:
                                 still_exist = True
                                 while still_exist and not please_stop:
                                     Till(seconds=TUID_EXISTENCE_WAIT_TIME).wait()
-                                    with self.conn.transaction() as t:
-                                        old_files = t.get(
-                                            "SELECT file FROM latestFileMod WHERE revision=?",
-                                            (revision,)
-                                        )
+                                    old_files = self.tuid_service.get_frontier_files(revision)
                                     if old_files is None or len(old_files) <= 0:
                                         still_exist = False
 
@@ -738,41 +706,32 @@ class Clogger:
                 with self.working_locker:
                     first_cset = request
 
-                    # Since we are deleting and moving stuff around in the
-                    # TUID tables, we need everything to be contained in
-                    # one transaction with no interruptions.
                     with self.conn.transaction() as t:
                         revnum = self._get_one_revnum(t, first_cset)[0]
                         csets_to_del = t.get(
                             "SELECT revnum, revision FROM csetLog WHERE revnum <= ?", (revnum,)
                         )
-                        csets_to_del = [cset for _, cset in csets_to_del]
-                        existing_frontiers = t.query(
-                            "SELECT revision FROM latestFileMod WHERE revision IN " +
-                            quote_set(csets_to_del)
-                        ).data
-
-                        existing_frontiers = [existing_frontiers[i][0] for i, _ in enumerate(existing_frontiers)]
-                        Log.note(
-                            "Deleting all annotations and changeset log entries with revisions in the list: {{csets}}",
-                            csets=csets_to_del
-                        )
+                    csets_to_del = [cset for _, cset in csets_to_del]
+                    Log.note(
+                        "Deleting all annotations and changeset log entries with revisions in the list: {{csets}}",
+                        csets=csets_to_del
+                    )
 
-                        if len(existing_frontiers) > 0:
-                            # This handles files which no longer exist anymore in
-                            # the main branch.
-                            Log.note(
-                                "Deleting existing frontiers for revisions: {{revisions}}",
-                                revisions=existing_frontiers
-                            )
-                            t.execute(
-                                "DELETE FROM latestFileMod WHERE revision IN " +
-                                quote_set(existing_frontiers)
-                            )
+                    # The annotations, and the frontiers of files which no
+                    # longer exist in the main branch, are in the shards. They
+                    # are deleted first, the changesets are only removed from
+                    # the csetLog once nothing refers to them.
+                    Log.note("Deleting annotations and frontiers...")
+                    self.tuid_service.delete_annotations(csets_to_del)
 
-                        Log.note("Deleting annotations...")
+                    with self.conn.transaction() as t:
+                        Log.note("Deleting diffs...")
+                        t.execute(
+                            "DELETE FROM diffs WHERE revision IN " +
+                            quote_set(csets_to_del)
+                        )
                         t.execute(
-                            "DELETE FROM annotations WHERE revision IN " +
+                            "DELETE FROM csetFiles WHERE revision IN " +
                             quote_set(csets_to_del)
                         )
 
@@ -784,9 +743,6 @@ class Clogger:
                             "DELETE FROM csetLog WHERE revision IN " +
                             quote_set(csets_to_del)
                         )
-
-                    # Recalculate the revnums
-                    self.recompute_table_revnums()
             except Exception as e:
                 Log.warning("Unexpected error occured while deleting from csetLog:", cause=e)
                 Till(seconds=CSET_DELETION_WAIT_TIME).wait()
@@ -802,12 +758,9 @@ class Clogger:
             with self.conn.transaction() as t:
                 revnum = self._get_one_revnum(t, revision)
 
-            if revnum and revnum[0] >= 0:
+            if revnum:
                 break
-            elif revnum[0] < 0:
-                Log.note("Waiting for table to recompute...")
-            else:
-                Log.note("Waiting for backfill to complete...")
+            Log.note("Waiting for backfill to complete...")
             Till(seconds=CSET_BACKFILL_WAIT_TIME).wait()
 
         if timeout:
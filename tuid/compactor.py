@@ -0,0 +1,226 @@
+# encoding: utf-8
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+
+from __future__ import division
+from __future__ import unicode_literals
+
+from mo_future import text_type
+from mo_logs import Log
+from mo_threads import Lock, Thread, Till
+from mo_times import Timer
+from mo_times.durations import DAY, SECOND
+from pyLibrary.sql import quote_set
+from tuid.encoding import decode_tuids
+
+COMPACT_INTERVAL = 1 * DAY  # Time between compactions.
+COMPACT_BATCH_SIZE = 1000  # Temporal rows checked, and deleted, in each transaction.
+COMPACT_BATCH_PAUSE = 1 * SECOND  # Pause between batches, leaving the database to requests.
+COMPACT_BUSY_THREADS = 2  # Requests running that make the compactor wait.
+MARK_BATCH_SIZE = 100  # Annotations read at a time while marking the tuids in use.
+VACUUM_PAGES = 1000  # Free pages given back to the file system in each transaction.
+INCREMENTAL_VACUUM = 2  # Value of `PRAGMA auto_vacuum` when pages can be freed with `PRAGMA incremental_vacuum`.
+
+GET_NEXT_TUID = "SELECT next FROM sequences WHERE name='tuid'"
+
+
+class Compactor(object):
+    """
+    Deletes the `temporal` rows of tuids that are in no annotation
+    anymore, once the clogger has deleted the annotations of old
+    changesets. The frontiers are rebuilt from the annotations at
+    their `latestFileMod` revision, so these tuids are not needed.
+
+    The tuids in use are marked from the annotations, then `temporal`
+    is swept a batch at a time, waiting while the service is busy
+    with requests. The annotations inserted while compacting are
+    marked too, and each batch checks the marks again in the
+    transaction deleting it, so tuids put in a new annotation are
+    never deleted. Tuids reserved after the compaction started are
+    left for the next one.
+
+    When the database is sharded, the annotations of every shard are
+    marked, the `temporal` table is only in the main database. An
+    annotation is inserted in its shard after the tuids of its lines
+    are looked up, and reserved, in a main database transaction. That
+    transaction marks them with `keep_tuids`, so the sweep does not
+    delete them before the annotation is inserted.
+
+    Free pages are given back with `PRAGMA incremental_vacuum`, this
+    needs a database created with `PRAGMA auto_vacuum = INCREMENTAL`.
+    """
+
+    def __init__(self, tuid_service, start_workers=True, interval=COMPACT_INTERVAL):
+        """
+        :param tuid_service: TUIDService whose database is compacted
+        :param start_workers: False to only compact when `compact()` is called
+        :param interval: Time between compactions
+        """
+        self.tuid_service = tuid_service
+        self.conn = tuid_service.conn
+        self.conns = tuid_service.shards.conns  # All the databases, the main one first
+        self.interval = interval
+        self.locker = Lock()
+        self.marks = None  # bytearray with a bit for each tuid in use, while compacting
+        self.thread = Thread.run("tuid compactor", self._worker) if start_workers else None
+
+    def keep(self, annotations):
+        """
+        Marks the tuids of annotations being inserted, so a
+        compaction that is running does not delete them.
+        :param annotations: annotations packed by `encode_tuids`
+        """
+        with self.locker:
+            if self.marks is None:
+                return
+        for annotation in annotations:
+            self._mark(decode_tuids(annotation))
+
+    def keep_tuids(self, tuids):
+        """
+        Marks tuids that will be put in an annotation, called in the
+        main database transaction that looks them up or reserves them.
+        :param tuids: tuids of the annotation's lines
+        """
+        self._mark(tuids)
+
+    def compact(self, please_stop=None):
+        """
+        :return: (temporal rows deleted, pages freed, seconds spent)
+        """
+        with Timer("compact temporal", silent=True) as timer:
+            with self.locker:
+                self.marks = bytearray()
+            try:
+                # Waits for the transactions in progress, on every
+                # database, the tuids they reserved are below the limit
+                # and their annotations are committed before the
+                # marking starts
+                with self.conn.transaction() as t:
+                    limit = t.get_one(GET_NEXT_TUID)[0]
+                for conn in self.conns[1:]:
+                    with conn.transaction() as t:
+                        t.get_one("SELECT 1")
+                self._mark_annotations(please_stop)
+                rows = self._sweep(limit, please_stop)
+            finally:
+                with self.locker:
+                    self.marks = None
+            pages = sum(self._vacuum(conn, please_stop) for conn in self.conns)
+
+        self.tuid_service.statsdaemon.update_compaction(rows=rows, pages=pages, seconds=timer.interval)
+        Log.note(
+            "Compacted temporal: {{rows}} rows deleted, {{pages}} pages freed in {{seconds|round(places=1)}} seconds",
+            rows=rows,
+            pages=pages,
+            seconds=timer.interval
+        )
+        return rows, pages, timer.interval
+
+    def _worker(self, please_stop):
+        while not please_stop:
+            (please_stop | Till(seconds=self.interval.seconds)).wait()
+            if please_stop:
+                break
+            try:
+                self.compact(please_stop)
+            except Exception as e:
+                Log.warning("Could not compact the temporal table", cause=e)
+
+    def _wait_for_requests(self, please_stop):
+        while not please_stop and self.tuid_service.get_thread_count() > COMPACT_BUSY_THREADS:
+            (please_stop | Till(seconds=COMPACT_BATCH_PAUSE.seconds)).wait()
+
+    def _mark(self, tuids):
+        with self.locker:
+            marks = self.marks
+            if marks is None:
+                return
+            for tuid in tuids:
+                if tuid is None or tuid <= 0:
+                    continue
+                byte = tuid >> 3
+                if byte >= len(marks):
+                    marks.extend(bytearray(byte + 1 - len(marks)))
+                marks[byte] |= 1 << (tuid & 7)
+
+    def _is_marked(self, tuid):
+        byte = tuid >> 3
+        with self.locker:
+            return byte < len(self.marks) and bool(self.marks[byte] & (1 << (tuid & 7)))
+
+    def _mark_annotations(self, please_stop):
+        for conn in self.conns:
+            last = 0
+            while not please_stop:
+                with conn.read_transaction() as t:
+                    blobs = t.get(
+                        "SELECT rowid, annotation FROM annotationBlobs WHERE rowid > ? ORDER BY rowid LIMIT ?",
+                        (last, MARK_BATCH_SIZE)
+                    )
+                if not blobs:
+                    break
+                for _, annotation in blobs:
+                    self._mark(decode_tuids(annotation))
+                last = max(rowid for rowid, _ in blobs)
+
+    def _sweep(self, limit, please_stop):
+        deleted = 0
+        last = 0
+        while not please_stop:
+            self._wait_for_requests(please_stop)
+            with self.conn.read_transaction() as t:
+                rows = t.get(
+                    "SELECT rowid, tuid FROM temporal WHERE rowid > ? ORDER BY rowid LIMIT ?",
+                    (last, COMPACT_BATCH_SIZE)
+                )
+            if not rows:
+                break
+            last = max(rowid for rowid, _ in rows)
+            candidates = [rowid for rowid, tuid in rows if 0 < tuid < limit and not self._is_marked(tuid)]
+            if not candidates:
+                continue
+
+            with self.conn.transaction() as t:
+                # The query waits for the other transactions, the
+                # annotations they inserted are marked by now
+                garbage = [
+                    rowid
+                    for rowid, tuid in t.get("SELECT rowid, tuid FROM temporal WHERE rowid IN " + quote_set(candidates))
+                    if 0 < tuid < limit and not self._is_marked(tuid)
+                ]
+                if garbage:
+                    t.execute("DELETE FROM temporal WHERE rowid IN " + quote_set(garbage))
+            deleted += len(garbage)
+            (please_stop | Till(seconds=COMPACT_BATCH_PAUSE.seconds)).wait()
+        return deleted
+
+    def _vacuum(self, conn, please_stop):
+        if conn.get_one("PRAGMA auto_vacuum")[0] != INCREMENTAL_VACUUM:
+            Log.note("Free pages are kept, the database needs a VACUUM after `PRAGMA auto_vacuum = INCREMENTAL`")
+            return 0
+
+        freed = 0
+        while not please_stop:
+            self._wait_for_requests(please_stop)
+            with conn.transaction() as t:
+                free = t.get_one("PRAGMA freelist_count")[0]
+                pages = min(free, VACUUM_PAGES)
+                if pages:
+                    # The pragma frees a page at each step, reading its
+                    # results runs it to the end. The Python sqlite3
+                    # module only steps a statement without result
+                    # columns once, the pages it left are freed one at
+                    # a time, never more than the batch.
+                    t.get("PRAGMA incremental_vacuum(" + text_type(pages) + ")")
+                    left = pages - (free - t.get_one("PRAGMA freelist_count")[0])
+                    for _ in range(left):
+                        t.execute("PRAGMA incremental_vacuum(1)")
+            if not pages:
+                break
+            freed += pages
+            (please_stop | Till(seconds=COMPACT_BATCH_PAUSE.seconds)).wait()
+        return freed
@@ -10,7 +10,7 @@ from __future__ import division
 from __future__ import unicode_literals
 
 from mo_logs import Log
-from mo_threads import Lock
+from mo_threads import Lock, Signal, Till
 
 
 class Counter(object):
@@ -90,11 +90,18 @@ class Semaphore(object):
             # Only three concurent threads allowed in this block
             # Other threads will wait up to 10sec before timeout
 
-        :param timeout: Seconds to wait
+        :param timeout: Seconds to wait, or a Signal to stop waiting
         :return:  context manager for `with` clause
         """
         return SemaphoreContext(self, timeout)
 
+    def __len__(self):
+        """
+        :return: Number of threads in the block
+        """
+        with self.lock:
+            return self.max - self.remaining
+
 
 class SemaphoreContext(object):
     """
@@ -106,14 +113,89 @@ class SemaphoreContext(object):
         self.timeout = timeout
 
     def __enter__(self):
+        if isinstance(self.timeout, Signal):
+            timeout = self.timeout
+        else:
+            timeout = Till(seconds=self.timeout)
+
         with self.parent.lock:
-            while not self.timeout:
+            while not timeout:
                 if self.parent.remaining:
                     self.parent.remaining -= 1
                     return self
-                self.parent.lock.wait(self.timeout)
+                # Woken when a thread leaves the block
+                self.parent.lock.wait(till=timeout)
         Log.error("Timeout")
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         with self.parent.lock:
             self.parent.remaining += 1
+
+
+class SingleFlight(object):
+    """
+    Makes sure only one thread does the work for a key, while
+    other threads asking for the same key wait for its result
+
+    in_flight = SingleFlight()
+
+    led, followed = in_flight.claim(keys)
+    try:
+        # Do the work for the `led` keys
+    finally:
+        in_flight.finish(led, {key: value})
+    for key, flight in followed:
+        value = flight.wait()  # None if the leader found no value
+    """
+
+    def __init__(self):
+        self.locker = Lock()
+        self.flights = {}  # key -> Flight of the thread doing the work
+
+    def __len__(self):
+        with self.locker:
+            return len(self.flights)
+
+    def claim(self, keys):
+        """
+        :param keys: keys to do the work for
+        :return: (list of keys this thread must do, list of (key, Flight) done by other threads)
+        """
+        led = []
+        followed = []
+        with self.locker:
+            for key in keys:
+                flight = self.flights.get(key)
+                if flight is None:
+                    self.flights[key] = Flight()
+                    led.append(key)
+                else:
+                    followed.append((key, flight))
+        return led, followed
+
+    def finish(self, keys, values):
+        """
+        Gives the waiting threads their values, must be called for all the
+        keys claimed, even if the work failed
+        :param keys: keys claimed by this thread
+        :param values: dict of results, keys that are missing give None
+        """
+        with self.locker:
+            flights = [(self.flights.pop(key), values.get(key)) for key in keys]
+        for flight, value in flights:
+            flight.value = value
+            flight.done.go()
+
+
+class Flight(object):
+    """
+    Not meant for external use
+    """
+
+    def __init__(self):
+        self.done = Signal()
+        self.value = None
+
+    def wait(self):
+        self.done.wait()
+        return self.value
@@ -0,0 +1,320 @@
+# encoding: utf-8
+#
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import unicode_literals
+
+import hashlib
+import struct
+import sys
+from array import array
+
+from mo_dots import wrap
+from mo_future import PY2, text_type
+from mo_logs import Log
+from tuid.util import map_to_array
+
+# Binary annotation format (stored as a BLOB in the `annotationBlobs` table):
+#
+#   1 byte          ANNOTATION_VERSION
+#   4 bytes/line    little-endian int32 tuid of line 1, 2, ..., n
+#
+# Line numbers are implicit. A zero-length value is a file that
+# does not exist at the revision (it used to be the empty string).
+ANNOTATION_VERSION = 1
+TUID_TYPECODE = str('i')
+BIG_ENDIAN = sys.byteorder == 'big'
+
+# Binary `/tuid` response format (`"meta": {"format": "binary"}`):
+#
+#   1 byte          RESPONSE_VERSION
+#   then, for each file:
+#   4 bytes         little-endian uint32 length of the utf8 path
+#   n bytes         utf8 path
+#   4 bytes         little-endian int32 number of lines, -1 if there are no tuids
+#   4 bytes/line    little-endian int32 tuid of line 1, 2, ..., n (0 if unknown)
+RESPONSE_VERSION = 1
+JSON_TUIDS_PER_CHUNK = 10 * 1000  # Tuids converted to JSON at a time
+NO_TUIDS = -1
+
+# Binary diff format (stored as a BLOB in the `diffs` table), the
+# moves of all the files changed by one changeset:
+#
+#   1 byte          DIFF_VERSION
+#   1 byte          1 if the changeset is a merge, 0 if not
+#   then, for each file:
+#   4 bytes         little-endian uint32 length of the utf8 old path
+#   n bytes         utf8 old path
+#   4 bytes         little-endian uint32 length of the utf8 new path
+#   n bytes         utf8 new path
+#   4 bytes         little-endian uint32 number of changes
+#   4 bytes/change  little-endian int32 4 * line + action, the action
+#                   being its index in DIFF_ACTIONS
+DIFF_VERSION = 1
+DIFF_ACTIONS = ['+', '-', '\\']
+
+if array(TUID_TYPECODE).itemsize != 4:
+    Log.error("Expecting 4 byte integers for the {{code}} array typecode", code=TUID_TYPECODE)
+
+if PY2:
+    def _to_blob(data):
+        return buffer(data)
+
+    def _array_from_bytes(tuids, data):
+        tuids.fromstring(bytes(data))
+
+    def _array_to_bytes(tuids):
+        return tuids.tostring()
+else:
+    def _to_blob(data):
+        return bytes(data)
+
+    def _array_from_bytes(tuids, data):
+        tuids.frombytes(data)
+
+    def _array_to_bytes(tuids):
+        return tuids.tobytes()
+
+
+def encode_tuids(tuids):
+    """
+    Packs tuids into the binary annotation format.
+    :param tuids: array of tuids, TuidArray, or list of TuidMap ordered by line
+    :return: bytes to store in the `annotationBlobs` table
+    """
+    if isinstance(tuids, array):
+        packed = tuids
+    elif hasattr(tuids, 'tuids'):
+        # TuidArray
+        packed = tuids.tuids
+    else:
+        packed = array(TUID_TYPECODE)
+        for linenum, tmap in enumerate(tuids):
+            if tmap.line != linenum + 1:
+                Log.error(
+                    "Expecting contiguous line numbers, found line {{line}} at position {{pos}}",
+                    line=tmap.line,
+                    pos=linenum + 1
+                )
+            packed.append(tmap.tuid)
+
+    if not packed:
+        # File does not exist at this revision
+        return _to_blob(b'')
+
+    if BIG_ENDIAN:
+        packed = array(TUID_TYPECODE, packed)
+        packed.byteswap()
+    return _to_blob(bytearray([ANNOTATION_VERSION]) + _array_to_bytes(packed))
+
+
+def decode_tuids(value):
+    """
+    Unpacks an annotation into an array of tuids, one for each line.
+    Annotations still in the old text format ("tuid,line" lines)
+    are accepted too.
+    :param value: annotation from the `annotationBlobs` table
+    :return: array of tuids, or None if there is no annotation
+    """
+    if value == None:
+        return None
+
+    tuids = array(TUID_TYPECODE)
+    if isinstance(value, text_type):
+        return _decode_text_tuids(value)
+    if not len(value):
+        return tuids
+
+    version = bytearray(value[:1])[0]
+    if version != ANNOTATION_VERSION:
+        Log.error("Unknown annotation version {{version}}", version=version)
+
+    _array_from_bytes(tuids, memoryview(value)[1:] if not PY2 else buffer(value, 1))
+    if BIG_ENDIAN:
+        tuids.byteswap()
+    return tuids
+
+
+def annotation_hash(value):
+    """
+    :param value: annotation packed by `encode_tuids`
+    :return: hex digest of its content, the key of the `annotationBlobs` table
+    """
+    return hashlib.sha1(bytes(value)).hexdigest()
+
+
+def _decode_text_tuids(value):
+    # The original text format, one "tuid,line" pair per line
+    try:
+        pairs = []
+        for entry in value.splitlines():
+            if not entry:
+                continue
+            tuid, line = entry.split(',')
+            pairs.append((int(line), int(tuid)))
+        pairs.sort()
+        return array(TUID_TYPECODE, [tuid for _, tuid in pairs])
+    except Exception as e:
+        Log.error("Invalid entry in tuids list:\n{{list}}", list=value, cause=e)
+
+
+def json_tuids(tuids):
+    """
+    Writes the tuids of one file as a JSON array, straight from the
+    array of integers, without making an object for each line.
+    :param tuids: TuidArray, or list of TuidMap, from the service
+    :return: generator of utf8 JSON bytes
+    """
+    values = _response_tuids(tuids)
+    if values is None:
+        yield b'null'
+        return
+
+    to_json = text_type if isinstance(values, array) else _json_tuid
+    sep = b'['
+    for start in range(0, len(values), JSON_TUIDS_PER_CHUNK):
+        yield sep + ','.join(map(to_json, values[start:start + JSON_TUIDS_PER_CHUNK])).encode('ascii')
+        sep = b','
+    yield b']' if sep == b',' else b'[]'
+
+
+def binary_response_header():
+    return bytes(bytearray([RESPONSE_VERSION]))
+
+
+def binary_tuids(path, tuids):
+    """
+    :param path: file the tuids are for
+    :param tuids: TuidArray, or list of TuidMap, from the service
+    :return: bytes of the file's record in the binary response format
+    """
+    path = path.encode('utf8')
+    values = _response_tuids(tuids)
+    if values is None:
+        return struct.pack(str('<I'), len(path)) + path + struct.pack(str('<i'), NO_TUIDS)
+
+    if not isinstance(values, array):
+        values = array(TUID_TYPECODE, [0 if t is None else t for t in values])
+    elif BIG_ENDIAN:
+        values = array(TUID_TYPECODE, values)
+    if BIG_ENDIAN:
+        values.byteswap()
+    return (
+        struct.pack(str('<I'), len(path)) + path +
+        struct.pack(str('<i'), len(values)) + _array_to_bytes(values)
+    )
+
+
+def decode_binary_response(data):
+    """
+    :param data: body of a binary `/tuid` response
+    :return: list of (path, array of tuids) pairs; the array is None if the file has no tuids
+    """
+    data = bytes(data)
+    if not data:
+        return []
+    version = bytearray(data[:1])[0]
+    if version != RESPONSE_VERSION:
+        Log.error("Unknown response version {{version}}", version=version)
+
+    output = []
+    position = 1
+    while position < len(data):
+        path_length, = struct.unpack_from(str('<I'), data, position)
+        position += 4
+        path = data[position:position + path_length].decode('utf8')
+        position += path_length
+        num_lines, = struct.unpack_from(str('<i'), data, position)
+        position += 4
+        if num_lines == NO_TUIDS:
+            output.append((path, None))
+            continue
+        tuids = array(TUID_TYPECODE)
+        _array_from_bytes(tuids, data[position:position + 4 * num_lines])
+        if BIG_ENDIAN:
+            tuids.byteswap()
+        position += 4 * num_lines
+        output.append((path, tuids))
+    return output
+
+
+def encode_diff(diff):
+    """
+    Packs the moves of a changeset into the binary diff format.
+    :param diff: {"merge": bool, "diffs": moves} as given by `TUIDService._get_hg_diff`
+    :return: bytes to store in the `diffs` table
+    """
+    output = [bytes(bytearray([DIFF_VERSION, 1 if diff['merge'] else 0]))]
+    for f_diff in diff['diffs']:
+        changes = array(TUID_TYPECODE, [
+            4 * change.line + DIFF_ACTIONS.index(change.action)
+            for change in f_diff['changes']
+        ])
+        if BIG_ENDIAN:
+            changes.byteswap()
+        output.append(_pack_path(f_diff['old'].name))
+        output.append(_pack_path(f_diff['new'].name))
+        output.append(struct.pack(str('<I'), len(changes)))
+        output.append(_array_to_bytes(changes))
+    return _to_blob(b''.join(output))
+
+
+def decode_diff(value):
+    """
+    Unpacks a diff stored by `encode_diff`.
+    :param value: diff from the `diffs` table
+    :return: {"merge": bool, "diffs": moves}, like `TUIDService._get_hg_diff`
+    """
+    data = bytes(value)
+    version, merge = bytearray(data[:2])
+    if version != DIFF_VERSION:
+        Log.error("Unknown diff version {{version}}", version=version)
+
+    moves = []
+    position = 2
+    while position < len(data):
+        old_name, position = _unpack_path(data, position)
+        new_name, position = _unpack_path(data, position)
+        num_changes, = struct.unpack_from(str('<I'), data, position)
+        position += 4
+        changes = array(TUID_TYPECODE)
+        _array_from_bytes(changes, data[position:position + 4 * num_changes])
+        if BIG_ENDIAN:
+            changes.byteswap()
+        position += 4 * num_changes
+        moves.append({
+            "new": {"name": new_name},
+            "old": {"name": old_name},
+            "changes": [
+                {"line": change >> 2, "action": DIFF_ACTIONS[change & 3]}
+                for change in changes
+            ]
+        })
+    return wrap({"merge": bool(merge), "diffs": moves})
+
+
+def _pack_path(path):
+    path = path.encode('utf8')
+    return struct.pack(str('<I'), len(path)) + path
+
+
+def _unpack_path(data, position):
+    length, = struct.unpack_from(str('<I'), data, position)
+    position += 4
+    return data[position:position + length].decode('utf8'), position + length
+
+
+def _response_tuids(tuids):
+    # Array of tuids (a TuidArray is used as-is), or list with None
+    # for unknown lines, or None if the file has no tuids
+    if hasattr(tuids, 'tuids'):
+        return tuids.tuids if tuids else None
+    return map_to_array(tuids)
+
+
+def _json_tuid(tuid):
+    return 'null' if tuid is None else text_type(tuid)
@@ -0,0 +1,103 @@
+# encoding: utf-8
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+
+from __future__ import division
+from __future__ import unicode_literals
+
+from jx_python import jx
+from mo_threads import Lock
+from pyLibrary.sql import quote_set
+
+LOOKUP_BATCH_SIZE = 500  # Values looked up with each query.
+
+
+class InternTable(object):
+    """
+    Integer ids of the values kept in a dictionary table, like the
+    `files` table which gives an id to each file path. The other
+    tables hold the ids instead of repeating the values.
+
+    Rows of a dictionary table are never deleted, so the ids are cached
+    for the life of the service. Ids read or inserted in a transaction
+    are only cached once it is committed, because the ids inserted by
+    a transaction that is rolled back are given to other values later.
+
+    file_ids = InternTable(conn, "files", "file_id", "file")
+    with conn.transaction() as t:
+        file_ids.add(t, ["dom/base/Document.cpp"])  # {path: id}
+    """
+
+    def __init__(self, conn, table, id_column, value_column):
+        """
+        :param conn: Sql connection, used when no transaction is given
+        :param table: Name of the dictionary table
+        :param id_column: Its INTEGER PRIMARY KEY column
+        :param value_column: Its UNIQUE column holding the values
+        """
+        self.conn = conn
+        self.locker = Lock()
+        self.ids = {}  # value -> id
+        self.select = "SELECT " + value_column + ", " + id_column + " FROM " + table + " WHERE " + value_column + " IN "
+        self.insert = "INSERT OR IGNORE INTO " + table + " (" + value_column + ") VALUES (?)"
+
+    def __len__(self):
+        return len(self.ids)
+
+    def get(self, transaction, values):
+        """
+        :param transaction: Transaction to read the uncached ids with, or None
+        :param values: Values to look up
+        :return: {value: id} for the values that are in the table
+        """
+        found = {}
+        missing = []
+        with self.locker:
+            for value in set(values):
+                id = self.ids.get(value)
+                if id is None:
+                    missing.append(value)
+                else:
+                    found[value] = id
+        if not missing:
+            return found
+
+        db = self.conn if transaction is None else transaction
+        read = {}
+        for _, values_chunk in jx.groupby(missing, size=LOOKUP_BATCH_SIZE):
+            read.update({value: id for value, id in db.get(self.select + quote_set(values_chunk))})
+        self._cache(transaction, read)
+        found.update(read)
+        return found
+
+    def add(self, transaction, values):
+        """
+        Inserts the values that are not in the table yet.
+
+        :param transaction: Transaction the rows using the ids are written with
+        :param values: Values to get the ids of
+        :return: {value: id} for all the values
+        """
+        found = self.get(transaction, values)
+        missing = [value for value in set(values) if value not in found]
+        if missing:
+            transaction.executemany(self.insert, [(value,) for value in missing])
+            found.update(self.get(transaction, missing))
+        return found
+
+    def _cache(self, transaction, ids):
+        if not ids:
+            return
+
+        def cache():
+            with self.locker:
+                self.ids.update(ids)
+
+        if transaction is None:
+            # Read outside of any transaction, so it is committed
+            cache()
+        else:
+            transaction.on_commit(cache)
@@ -0,0 +1,151 @@
+# encoding: utf-8
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+
+from __future__ import division
+from __future__ import unicode_literals
+
+from jx_python import jx
+from mo_logs import Log
+from mo_math.randoms import Random
+from mo_threads import Lock, Thread
+from mo_times.dates import Date
+from mo_times.durations import MINUTE
+
+JOB_EXPIRY = 10 * MINUTE  # Time the results of a finished job are kept.
+JOB_ID_LENGTH = 16
+
+
+class Job(object):
+    """
+    Files of one revision that are being processed in the background.
+    The work for some files may be done by an earlier job that was
+    already processing them; this job waits on it instead.
+    """
+
+    def __init__(self, revision, files):
+        self.id = Random.hex(JOB_ID_LENGTH)
+        self.revision = revision
+        self.files = files
+        self.owners = {}  # file -> Job doing the work for that file
+        self.results = {}  # file -> tuids, for the files done by this job
+        self.pending = 0  # Batches of work still running
+        self.failed = 0
+        self.created = Date.now()
+        self.finished = None
+
+    @property
+    def done(self):
+        return all(owner.finished is not None for owner in set(self.owners.values()))
+
+    def get_results(self):
+        """
+        :return: list of (file, tuids) tuples, in the order the files were given
+        """
+        return [(file, self.owners[file].results.get(file, [])) for file in self.files]
+
+    def status(self):
+        complete = sum(1 for file in self.files if file in self.owners[file].results)
+        done = self.done
+        return {
+            "id": self.id,
+            "revision": self.revision,
+            "status": "done" if done else "running",
+            "files": len(self.files),
+            "complete": complete,
+            "failed": sum(owner.failed for owner in set(self.owners.values())),
+            "created": self.created.unix,
+            "finished": max(owner.finished for owner in set(self.owners.values())).unix if done and self.files else None
+        }
+
+
+class JobRegistry(object):
+    """
+    Keeps the jobs started for incomplete requests, so the
+    results can be collected later, and so files that are
+    already being processed are not processed again.
+
+    jobs = JobRegistry()
+    job = jobs.submit(revision, files, work)
+    jobs.get(job.id).status()
+    """
+
+    def __init__(self):
+        self.locker = Lock()
+        self.jobs = {}  # id -> Job
+        self.in_flight = {}  # (revision, file) -> Job doing the work
+
+    def submit(self, revision, files, work, batch_size):
+        """
+        Starts the work for the given files, except those already being
+        processed by another job.
+        :param revision: revision the files are requested at
+        :param files: list of files
+        :param work: function(files, please_stop) returning a list of (file, tuids) tuples
+        :param batch_size: number of files given to each thread
+        :return: the Job; an existing job if it is doing the same files
+        """
+        with self.locker:
+            self._expire()
+            job = Job(revision, files)
+            owned = []
+            for file in files:
+                owner = self.in_flight.get((revision, file))
+                if owner is None:
+                    owner = self.in_flight[(revision, file)] = job
+                    owned.append(file)
+                job.owners[file] = owner
+
+            if not owned:
+                others = set(job.owners.values())
+                if len(others) == 1:
+                    other = others.pop()
+                    if set(other.files) == set(files):
+                        return other
+                job.finished = Date.now()
+
+            batches = [list(batch) for _, batch in jx.groupby(owned, size=batch_size) if batch]
+            job.pending = len(batches)
+            self.jobs[job.id] = job
+
+        for batch in batches:
+            Thread.run("tuid job " + job.id, self._run_batch, job, batch, work)
+        return job
+
+    def get(self, job_id):
+        """
+        :return: the job, or None if it is unknown or expired
+        """
+        with self.locker:
+            self._expire()
+            return self.jobs.get(job_id)
+
+    def _run_batch(self, job, files, work, please_stop=None):
+        results = []
+        try:
+            results = work(files, please_stop=please_stop)
+        except Exception as e:
+            Log.warning("Job {{job}} failed on {{num}} files", job=job.id, num=len(files), cause=e)
+
+        with self.locker:
+            for file, tuids in results:
+                job.results[file] = tuids
+            for file in files:
+                if file not in job.results:
+                    job.results[file] = []
+                    job.failed += 1
+                if self.in_flight.get((job.revision, file)) is job:
+                    del self.in_flight[(job.revision, file)]
+            job.pending -= 1
+            if not job.pending:
+                job.finished = Date.now()
+
+    def _expire(self):
+        # Must be called with the lock held
+        expired = Date.now() - JOB_EXPIRY
+        for job_id, job in list(self.jobs.items()):
+            if job.done and job.finished is not None and job.finished < expired:
+                del self.jobs[job_id]
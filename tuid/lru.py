@@ -0,0 +1,90 @@
+# encoding: utf-8
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+
+from __future__ import division
+from __future__ import unicode_literals
+
+from collections import OrderedDict
+
+from mo_threads import Lock
+
+
+class LRUCache(object):
+    """
+    Least-recently-used cache, bounded by the number of bytes
+    it holds rather than the number of entries.
+
+    my_cache = LRUCache(10 * 1000 * 1000, sizeof=lambda key, value: len(value))
+    my_cache.set(key, value)
+    my_cache.get(key)  # value, or None if it was evicted
+    """
+
+    def __init__(self, max_bytes, sizeof):
+        """
+        :param max_bytes: Maximum total size of the entries
+        :param sizeof: function(key, value) returning the size of an entry in bytes
+        """
+        self.locker = Lock()
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.bytes = 0
+        self.entries = OrderedDict()  # key -> (value, size), oldest first
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        """
+        :return: the cached value, or None if it is not cached
+        """
+        with self.locker:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                return None
+            # Re-insert to mark as most recently used
+            self.entries[key] = entry
+            return entry[0]
+
+    def set(self, key, value):
+        """
+        :return: number of entries evicted to make room for this one
+        """
+        size = self.sizeof(key, value)
+        if size > self.max_bytes:
+            # Would evict everything, don't bother
+            return 0
+
+        evicted = 0
+        with self.locker:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.bytes -= old[1]
+            while self.entries and self.bytes + size > self.max_bytes:
+                _, (_, old_size) = self.entries.popitem(last=False)
+                self.bytes -= old_size
+                evicted += 1
+            self.entries[key] = (value, size)
+            self.bytes += size
+        return evicted
+
+    def remove(self, where):
+        """
+        Removes the entries whose key passes the given filter
+        :param where: function(key) returning True for entries to remove
+        :return: number of entries removed
+        """
+        with self.locker:
+            keys = [key for key in self.entries if where(key)]
+            for key in keys:
+                _, size = self.entries.pop(key)
+                self.bytes -= size
+        return len(keys)
+
+    def clear(self):
+        with self.locker:
+            self.entries.clear()
+            self.bytes = 0
@@ -0,0 +1,114 @@
+# encoding: utf-8
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+
+from __future__ import division
+from __future__ import unicode_literals
+
+from mo_logs import Log, Except
+from mo_threads import Queue, Signal, Thread, THREAD_STOP
+
+
+class WorkerPool(object):
+    """
+    A fixed number of threads that run the functions given to them.
+    Idle workers block on the queue, so they start as soon as there
+    is work, and no thread is created for each piece of work.
+
+    pool = WorkerPool("annotate", 10)
+    future = pool.submit(my_function, arg1, arg2)
+    future.result()  # value returned by my_function(arg1, arg2)
+    """
+
+    def __init__(self, name, num_workers, max_pending=None):
+        """
+        :param name: Name of the pool, for the threads
+        :param num_workers: Number of threads running the work
+        :param max_pending: Number of pieces of work waiting for a worker
+                            before `submit()` blocks
+        """
+        self.name = name
+        self.queue = Queue("work for " + name, max=max_pending, silent=True)
+        self.workers = [
+            Thread.run(name + " worker " + str(i), self._worker)
+            for i in range(num_workers)
+        ]
+
+    def __len__(self):
+        """
+        :return: Number of pieces of work waiting for a worker
+        """
+        return len(self.queue)
+
+    def submit(self, func, *args, **kwargs):
+        """
+        :param func: Function to run, it is given `please_stop` too
+        :return: Future for the value returned by `func`
+        """
+        future = Future()
+        self.queue.add((future, func, args, kwargs))
+        return future
+
+    def stop(self):
+        # All workers see the closed queue, once it is empty
+        self.queue.add(THREAD_STOP)
+        for worker in self.workers:
+            worker.join()
+
+    def _worker(self, please_stop):
+        while not please_stop:
+            work = self.queue.pop(till=please_stop)
+            if work is THREAD_STOP:
+                break
+            if work is None:
+                continue
+
+            future, func, args, kwargs = work
+            try:
+                future._set_value(func(*args, please_stop=please_stop, **kwargs))
+            except Exception as e:
+                future._set_exception(Except.wrap(e))
+
+
+class Future(object):
+    """
+    Value that will be given by a worker
+    """
+
+    def __init__(self):
+        self.done = Signal()
+        self.value = None
+        self.exception = None
+
+    def wait(self, till=None):
+        """
+        :param till: Signal to stop waiting
+        :return: True if the work is done, False if `till` was reached first
+        """
+        if till is None:
+            self.done.wait()
+        else:
+            (self.done | till).wait()
+        return bool(self.done)
+
+    def result(self, till=None):
+        """
+        :param till: Signal to stop waiting
+        :return: The value returned by the work, raises its exception if it failed
+        """
+        if not self.wait(till=till):
+            Log.error("Timeout waiting for work to finish")
+        if self.exception:
+            Log.error("Work failed", cause=self.exception)
+        return self.value
+
+    def _set_value(self, value):
+        self.value = value
+        self.done.go()
+
+    def _set_exception(self, exception):
+        self.exception = exception
+        self.done.go()
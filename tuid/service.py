@@ -8,28 +8,36 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import unicode_literals
 
-import gc
-import copy
+import sys
+from array import array
 
 from jx_python import jx
 from mo_dots import Null, coalesce, wrap
 from mo_future import text_type
 from mo_hg.hg_mozilla_org import HgMozillaOrg
-from mo_hg.apply import apply_diff, apply_diff_backwards
+from mo_hg.apply import splice_lines
 from mo_files.url import URL
 from mo_kwargs import override
 from mo_logs import Log
-from mo_math.randoms import Random
-from mo_threads import Till, Thread, Lock
+from mo_threads import Till, Lock
 from mo_times.durations import SECOND, HOUR, MINUTE, DAY
 from pyLibrary.env import http
 from pyLibrary.meta import cache
-from pyLibrary.sql import sql_list, sql_iso
-from pyLibrary.sql.sqlite import quote_value, quote_list
+from pyLibrary.sql import quote_set
+from pyLibrary.sql.sqlite import quote_value
 from tuid import sql
 from tuid.statslogger import StatsLogger
-from tuid.counter import Counter
-from tuid.util import MISSING, TuidMap, TuidLine, AnnotateFile, HG_URL
+from tuid.counter import Semaphore, SingleFlight
+from tuid.lru import LRUCache
+from tuid.compactor import Compactor
+from tuid.encoding import TUID_TYPECODE, annotation_hash, encode_tuids, decode_tuids, encode_diff, decode_diff
+from tuid.intern import InternTable
+from tuid.jobs import JobRegistry
+from tuid.pool import WorkerPool
+from tuid.shards import Shards
+from tuid.snapshot import Snapshots
+from tuid.util import MISSING, TuidMap, TuidArray, TuidLine, AnnotateFile, HG_URL
+from tuid.warmer import Warmer
 
 import tuid.clogger
 
@@ -38,50 +46,105 @@ ANNOTATE_DEBUG = False
 VERIFY_TUIDS = True
 RETRY = {"times": 3, "sleep": 5, "http": True}
 ANN_WAIT_TIME = 5 * HOUR
-MEMORY_LOG_INTERVAL = 15
 MAX_CONCURRENT_ANN_REQUESTS = 5
-MAX_ANN_REQUESTS_WAIT_TIME = 5 * SECOND
-MAX_THREAD_WAIT_TIME = 5 * SECOND
+ANNOTATION_WORKERS = 10 # Threads getting annotations, at most MAX_CONCURRENT_ANN_REQUESTS of them request hg at once.
+DIFF_WORKERS = 5 # Threads getting the diffs that are not stored yet.
 WORK_OVERFLOW_BATCH_SIZE = 250
 SQL_ANN_BATCH_SIZE = 5
 SQL_BATCH_SIZE = 500
 FILES_TO_PROCESS_THRESH = 5
 ENABLE_TRY = False
 DAEMON_WAIT_AT_NEWEST = 30 * SECOND # Time to wait at the newest revision before polling again.
-
-GET_TUID_QUERY = "SELECT tuid FROM temporal WHERE file=? and revision=? and line=?"
-GET_ANNOTATION_QUERY = "SELECT annotation FROM annotations WHERE revision=? and file=?"
-GET_LATEST_MODIFICATION = "SELECT revision FROM latestFileMod WHERE file=?"
+DB_VERSION = 6 # Schema version of the database, kept in `PRAGMA user_version`.
+ANNOTATION_CACHE_BYTES = 256 * 1000 * 1000 # Memory used by decoded annotations kept in the cache.
+ANNOTATION_CACHE_ENTRY_BYTES = 200 # Estimated overhead of each cache entry (key tuple, TuidArray, links).
+
+GET_TUID_QUERY = (
+    "SELECT t.tuid FROM temporal t"
+    " JOIN files f ON f.file_id=t.file_id"
+    " JOIN revisions r ON r.revision_id=t.revision_id"
+    " WHERE f.file=? and r.revision=? and t.line=?"
+)
+GET_ANNOTATION_QUERY = (
+    "SELECT b.annotation FROM annotations a"
+    " JOIN annotationBlobs b ON b.hash=a.hash"
+    " WHERE a.revision_id=? and a.file_id=?"
+)
+GET_LATEST_MODIFICATION = (
+    "SELECT r.revision FROM latestFileMod l"
+    " JOIN files f ON f.file_id=l.file_id"
+    " JOIN revisions r ON r.revision_id=l.revision_id"
+    " WHERE f.file=?"
+)
+INSERT_TUID_QUERY = "INSERT INTO temporal (tuid, revision_id, file_id, line) VALUES (?, ?, ?, ?)"
+INSERT_ANNOTATION_QUERY = "INSERT INTO annotations (revision_id, file_id, hash) VALUES (?, ?, ?)"
+INSERT_ANNOTATION_BLOB = "INSERT OR IGNORE INTO annotationBlobs (hash, annotation, refs) VALUES (?, ?, 0)"
+INSERT_LATEST_MODIFICATION = "INSERT OR REPLACE INTO latestFileMod (file_id, revision_id) VALUES (?, ?)"
+INSERT_DIFF = "INSERT OR REPLACE INTO diffs (revision, diff) VALUES (?, ?)"
+INSERT_CSET_FILE = "INSERT OR IGNORE INTO csetFiles (revision, file, change) VALUES (?, ?, ?)"
+UNCHANGED_DIFF = {'merge': False, 'diffs': []} # Diff of a changeset that does not change the file.
+RESERVE_TUIDS = "UPDATE sequences SET next=next+? WHERE name='tuid'"
+CREATE_WANTED_LINES = (
+    "CREATE TEMP TABLE IF NOT EXISTS wanted_lines ("
+    "file_id INTEGER, revision_id INTEGER, line INTEGER)"
+)
+INSERT_WANTED_LINE = "INSERT INTO wanted_lines (file_id, revision_id, line) VALUES (?, ?, ?)"
+GET_WANTED_TUIDS = (
+    "SELECT t.tuid, t.file_id, t.revision_id, t.line"
+    " FROM wanted_lines w"
+    " JOIN temporal t ON t.revision_id=w.revision_id AND t.file_id=w.file_id AND t.line=w.line"
+)
+GET_NEXT_TUID = "SELECT next FROM sequences WHERE name='tuid'"
+GET_FRONTIER_FILES = (
+    "SELECT f.file FROM latestFileMod l"
+    " JOIN files f ON f.file_id=l.file_id"
+    " JOIN revisions r ON r.revision_id=l.revision_id"
+    " WHERE r.revision=?"
+)
+REVISION_IDS = "(SELECT revision_id FROM revisions WHERE revision IN " # Closed after the quoted revisions.
 
 
 class TUIDService:
 
     @override
-    def __init__(self, database, hg, hg_cache=None, conn=None, clogger=None, start_workers=True, kwargs=None):
+    def __init__(self, database, hg, hg_cache=None, snapshots=None, conn=None, clogger=None, start_workers=True, kwargs=None):
         try:
             self.config = kwargs
 
-            self.conn = conn if conn else sql.Sql(self.config.database.name)
+            self.conn = conn if conn else sql.Sql(self.config.database)
             self.hg_cache = HgMozillaOrg(kwargs=self.config.hg_cache, use_cache=True) if self.config.hg_cache else Null
             self.hg_url = URL(hg.url)
 
             if not self.conn.get_one("SELECT name FROM sqlite_master WHERE type='table';"):
                 self.init_db()
+            self.upgrade_db()
+
+            # Ids of the file paths and revisions used in the tables
+            self.file_ids = InternTable(self.conn, "files", "file_id", "file")
+            self.revision_ids = InternTable(self.conn, "revisions", "revision_id", "revision")
+
+            # Databases of the annotations and frontiers, by file
+            self.shards = Shards(self, self.config.database)
+            if self.shards.sharded:
+                self._drop_unsharded_annotations()
 
-            self.locker = Lock()
-            self.request_locker = Lock()
-            self.ann_thread_locker = Lock()
+            self.ann_requests = Semaphore(MAX_CONCURRENT_ANN_REQUESTS)
             self.service_thread_locker = Lock()
-            self.count_locker = Counter()
-            self.num_requests = 0
-            self.ann_threads_running = 0
             self.service_threads_running = 0
-            self.next_tuid = coalesce(self.conn.get_one("SELECT max(tuid)+1 FROM temporal")[0], 1)
             self.total_locker = Lock()
             self.total_files_requested = 0
             self.total_tuids_mapped = 0
 
             self.statsdaemon = StatsLogger()
+            self.statsdaemon.set_database(self.conn)
+            self.annotation_cache = LRUCache(ANNOTATION_CACHE_BYTES, _annotation_size)
+            self.snapshots = Snapshots(self, self.config.snapshots) if self.config.snapshots else Null
+            self.jobs = JobRegistry()
+            self.annotations_in_flight = SingleFlight()  # (repo, revision, file) being annotated
+            self.annotation_pool = WorkerPool("annotate", ANNOTATION_WORKERS)
+            self.diff_pool = WorkerPool("diffs", DIFF_WORKERS)
+            self.warmer = Warmer(self, start_workers=start_workers)
+            self.compactor = Compactor(self, start_workers=start_workers)
             self.clogger = clogger if clogger else tuid.clogger.Clogger(
                 conn=self.conn,
                 tuid_service=self,
@@ -92,15 +155,21 @@ class TUIDService:
             Log.error("can not setup service", cause=e)
 
 
-    def tuid(self):
-        """
-        :return: next tuid
-        """
-        with self.locker:
-            try:
-                return self.next_tuid
-            finally:
-                self.next_tuid += 1
+    def reserve_tuids(self, transaction, num):
+        '''
+        Reserves a contiguous range of new tuids. The range is taken from
+        the `sequences` table in the given transaction, so it is
+        not handed out again, by any process, unless the transaction
+        is rolled back (along with the tuids that were inserted).
+
+        :param transaction: transaction the new tuids are inserted with
+        :param num: number of tuids needed
+        :return: first tuid of the range, the others follow it
+        '''
+        if num <= 0:
+            return None
+        transaction.execute(RESERVE_TUIDS, (num,))
+        return transaction.get_one(GET_NEXT_TUID)[0] - num
 
 
     def init_db(self):
@@ -109,114 +178,581 @@ class TUIDService:
 
         :return: None
         '''
+        # Pages freed by the compactor can be given back to the file
+        # system, this has to be set before the first table is created
+        self.conn.get("PRAGMA auto_vacuum = INCREMENTAL")
+        self.conn.get("VACUUM")
         with self.conn.transaction() as t:
+            self._create_id_tables(t)
+            self._create_temporal_table(t)
+            self._create_frontier_table(t)
+            self._create_annotation_tables(t)
+
+            # Next value of each id, like the next tuid to hand out
             t.execute('''
-            CREATE TABLE temporal (
-                tuid     INTEGER,
-                revision CHAR(12) NOT NULL,
-                file     TEXT,
-                line     INTEGER
+            CREATE TABLE sequences (
+                name           TEXT,
+                next           INTEGER NOT NULL,
+                PRIMARY KEY(name)
             );''')
+            t.execute("INSERT INTO sequences (name, next) VALUES ('tuid', 1)")
 
+            # Parsed diffs (moves) of changesets, in the format of `tuid.encoding`
             t.execute('''
-            CREATE TABLE annotations (
+            CREATE TABLE diffs (
+                revision       CHAR(12) NOT NULL,
+                diff           BLOB,
+                PRIMARY KEY(revision)
+            );''')
+
+            # Files changed by each changeset in `diffs`: 'A'dded, 'M'odified,
+            # 'D'eleted, renamed 'F'rom, or renamed 'T'o
+            t.execute('''
+            CREATE TABLE csetFiles (
                 revision       CHAR(12) NOT NULL,
                 file           TEXT,
-                annotation     TEXT,
+                change         CHAR(1),
                 PRIMARY KEY(revision, file)
             );''')
 
-            # Used in frontier updating
+            t.execute("CREATE INDEX csetFiles_file ON csetFiles(file)")
+            t.execute("PRAGMA user_version = " + str(DB_VERSION))
+        Log.note("Tables created successfully")
+
+
+    def init_shard(self, conn):
+        '''
+        Creates the tables of a shard, the annotations and frontiers
+        of its files. Shards start at DB_VERSION, so there is
+        nothing to upgrade.
+
+        :param conn: Sql connection to the shard's empty database
+        :return: None
+        '''
+        conn.get("PRAGMA auto_vacuum = INCREMENTAL")
+        conn.get("VACUUM")
+        with conn.transaction() as t:
+            self._create_id_tables(t)
+            self._create_frontier_table(t)
+            self._create_annotation_tables(t)
+            t.execute("PRAGMA user_version = " + str(DB_VERSION))
+
+
+    def _drop_unsharded_annotations(self):
+        '''
+        Once sharding is turned on, the annotations and frontiers left
+        in the main database are never read, nor deleted by the clogger,
+        and the compactor would keep their tuids forever. They are
+        deleted the first time the service starts with shards; this
+        is a one-time cost, of one transaction on the main database.
+        The files are annotated again, in their shard, when requested,
+        and reuse the tuids of their lines.
+
+        :return: None
+        '''
+        if not self.conn.get("SELECT 1 FROM latestFileMod LIMIT 1") and not self.conn.get("SELECT 1 FROM annotations LIMIT 1"):
+            return
+        Log.note("Deleting the annotations and frontiers of the main database, they are in the shards now")
+        with self.conn.transaction() as t:
+            t.execute("DELETE FROM latestFileMod")
+            # The blobs go first, so the delete trigger of `annotations` has no refs to count
+            t.execute("DELETE FROM annotationBlobs")
+            t.execute("DELETE FROM annotations")
+
+
+    def upgrade_db(self):
+        '''
+        Brings an existing database up to DB_VERSION.
+
+        Version 1 stores annotations in the binary format of
+        `tuid.encoding`. Old text annotations are converted when
+        they are moved to the `annotationBlobs` table.
+
+        Version 2 adds the `sequences` table, used to reserve tuids.
+
+        Version 3 adds the `diffs` table, where parsed diffs are kept.
+
+        Version 4 adds the `csetFiles` table, the files changed by
+        each changeset with a stored diff.
+
+        Version 5 keys `temporal`, `annotations` and `latestFileMod`
+        by the integer ids of the `files` and `revisions` tables.
+
+        Version 6 keeps each distinct annotation once, in the
+        `annotationBlobs` table, and `annotations` points at them.
+
+        :return: None
+        '''
+        version = self.conn.get_one("PRAGMA user_version")[0]
+        if version < 2:
+            self._upgrade_sequences()
+        if version < 3:
+            with self.conn.transaction() as t:
+                t.execute('''
+                CREATE TABLE IF NOT EXISTS diffs (
+                    revision       CHAR(12) NOT NULL,
+                    diff           BLOB,
+                    PRIMARY KEY(revision)
+                );''')
+        if version < 4:
+            self._upgrade_cset_files()
+        if version < 5:
+            self._upgrade_ids()
+        if version < 6:
+            self._upgrade_annotation_blobs()
+        if version < DB_VERSION:
+            with self.conn.transaction() as t:
+                t.execute("PRAGMA user_version = " + str(DB_VERSION))
+
+
+    def _upgrade_sequences(self):
+        # Version 2 keeps the next tuid in the `sequences` table, this is
+        # the last time the largest tuid is looked for in `temporal`
+        Log.note("Adding the sequences table...")
+        with self.conn.transaction() as t:
             t.execute('''
-            CREATE TABLE latestFileMod (
-                file           TEXT,
+            CREATE TABLE IF NOT EXISTS sequences (
+                name           TEXT,
+                next           INTEGER NOT NULL,
+                PRIMARY KEY(name)
+            );''')
+            t.execute(
+                "INSERT OR IGNORE INTO sequences (name, next) "
+                "SELECT 'tuid', coalesce(max(tuid)+1, 1) FROM temporal"
+            )
+
+
+    def _upgrade_cset_files(self):
+        # The changesets in `diffs` are expected to be in `csetFiles`,
+        # so the stored diffs are indexed now
+        Log.note("Adding the csetFiles table...")
+        with self.conn.transaction() as t:
+            t.execute('''
+            CREATE TABLE IF NOT EXISTS csetFiles (
                 revision       CHAR(12) NOT NULL,
-                PRIMARY KEY(file)
+                file           TEXT,
+                change         CHAR(1),
+                PRIMARY KEY(revision, file)
             );''')
+            t.execute("CREATE INDEX IF NOT EXISTS csetFiles_file ON csetFiles(file)")
+            for revision, diff in t.get("SELECT revision, diff FROM diffs"):
+                t.executemany(
+                    INSERT_CSET_FILE,
+                    [(revision, file, change) for file, change in _changed_files(decode_diff(diff))]
+                )
 
-            t.execute("CREATE UNIQUE INDEX temporal_rev_file ON temporal(revision, file, line)")
-        Log.note("Tables created successfully")
+
+    def _create_id_tables(self, t):
+        # The `files` and `revisions` tables give an id to each
+        # file path and revision, the other tables hold the ids
+        t.execute('''
+        CREATE TABLE files (
+            file_id        INTEGER PRIMARY KEY,
+            file           TEXT NOT NULL UNIQUE
+        );''')
+
+        t.execute('''
+        CREATE TABLE revisions (
+            revision_id    INTEGER PRIMARY KEY,
+            revision       CHAR(12) NOT NULL UNIQUE
+        );''')
+
+
+    def _create_temporal_table(self, t):
+        t.execute('''
+        CREATE TABLE temporal (
+            tuid           INTEGER,
+            revision_id    INTEGER NOT NULL,
+            file_id        INTEGER NOT NULL,
+            line           INTEGER
+        );''')
+
+        t.execute("CREATE UNIQUE INDEX temporal_rev_file ON temporal(revision_id, file_id, line)")
+
+
+    def _create_frontier_table(self, t):
+        # Used in frontier updating
+        t.execute('''
+        CREATE TABLE latestFileMod (
+            file_id        INTEGER NOT NULL,
+            revision_id    INTEGER NOT NULL,
+            PRIMARY KEY(file_id)
+        );''')
+
+
+    def _create_annotation_tables(self, t):
+        # Each distinct annotation is kept once, under the hash of its
+        # content, with the number of `annotations` rows using it. The
+        # triggers keep the count, and delete the blobs no longer used,
+        # so deleting from `annotations` is enough to reclaim them.
+        t.execute('''
+        CREATE TABLE annotationBlobs (
+            hash           CHAR(40) NOT NULL,
+            annotation     BLOB,
+            refs           INTEGER NOT NULL,
+            PRIMARY KEY(hash)
+        );''')
+
+        t.execute('''
+        CREATE TABLE annotations (
+            revision_id    INTEGER NOT NULL,
+            file_id        INTEGER NOT NULL,
+            hash           CHAR(40) NOT NULL,
+            PRIMARY KEY(revision_id, file_id)
+        );''')
+
+        t.execute('''
+        CREATE TRIGGER annotations_insert AFTER INSERT ON annotations
+        BEGIN
+            UPDATE annotationBlobs SET refs=refs+1 WHERE hash=NEW.hash;
+        END;''')
+
+        t.execute('''
+        CREATE TRIGGER annotations_delete AFTER DELETE ON annotations
+        BEGIN
+            UPDATE annotationBlobs SET refs=refs-1 WHERE hash=OLD.hash;
+            DELETE FROM annotationBlobs WHERE hash=OLD.hash AND refs<=0;
+        END;''')
+
+        t.execute('''
+        CREATE TRIGGER annotations_update AFTER UPDATE OF hash ON annotations
+        BEGIN
+            UPDATE annotationBlobs SET refs=refs+1 WHERE hash=NEW.hash;
+            UPDATE annotationBlobs SET refs=refs-1 WHERE hash=OLD.hash;
+            DELETE FROM annotationBlobs WHERE hash=OLD.hash AND refs<=0;
+        END;''')
+
+
+    def _upgrade_ids(self):
+        # Copies the tables keyed by file paths and revisions into
+        # tables keyed by their ids. It is done in one transaction,
+        # the space of the old tables is reused by the database, or
+        # given back to the file system with a VACUUM.
+        Log.note("Moving temporal, annotations and latestFileMod to file and revision ids...")
+        with self.conn.transaction() as t:
+            for table in ["temporal", "annotations", "latestFileMod"]:
+                t.execute("ALTER TABLE " + table + " RENAME TO old_" + table)
+            t.execute("DROP INDEX IF EXISTS temporal_rev_file")
+            self._create_id_tables(t)
+            self._create_temporal_table(t)
+            self._create_frontier_table(t)
+            t.execute('''
+            CREATE TABLE annotations (
+                revision_id    INTEGER NOT NULL,
+                file_id        INTEGER NOT NULL,
+                annotation     BLOB,
+                PRIMARY KEY(revision_id, file_id)
+            );''')
+
+            for table in ["old_temporal", "old_annotations", "old_latestFileMod"]:
+                t.execute(
+                    "INSERT OR IGNORE INTO files (file) "
+                    "SELECT DISTINCT file FROM " + table + " WHERE file IS NOT NULL"
+                )
+                t.execute(
+                    "INSERT OR IGNORE INTO revisions (revision) "
+                    "SELECT DISTINCT revision FROM " + table
+                )
+
+            t.execute(
+                "INSERT INTO temporal (tuid, revision_id, file_id, line) "
+                "SELECT o.tuid, r.revision_id, f.file_id, o.line FROM old_temporal o"
+                " JOIN files f ON f.file=o.file"
+                " JOIN revisions r ON r.revision=o.revision"
+            )
+            t.execute(
+                "INSERT INTO annotations (revision_id, file_id, annotation) "
+                "SELECT r.revision_id, f.file_id, o.annotation FROM old_annotations o"
+                " JOIN files f ON f.file=o.file"
+                " JOIN revisions r ON r.revision=o.revision"
+            )
+            t.execute(
+                "INSERT INTO latestFileMod (file_id, revision_id) "
+                "SELECT f.file_id, r.revision_id FROM old_latestFileMod o"
+                " JOIN files f ON f.file=o.file"
+                " JOIN revisions r ON r.revision=o.revision"
+            )
+
+            for table in ["temporal", "annotations", "latestFileMod"]:
+                t.execute("DROP TABLE old_" + table)
+        Log.note("Finished moving to file and revision ids")
+
+
+    def _upgrade_annotation_blobs(self):
+        # Moves the annotations to the `annotationBlobs` table, a copy
+        # of each distinct content. Text annotations, from before
+        # version 1, are converted to the binary format on the way.
+        Log.note("Moving annotations to the annotationBlobs table...")
+        total = 0
+        with self.conn.transaction() as t:
+            t.execute("ALTER TABLE annotations RENAME TO old_annotations")
+            self._create_annotation_tables(t)
+
+            last_rowid = -1
+            while True:
+                batch = t.get(
+                    "SELECT rowid, revision_id, file_id, annotation FROM old_annotations"
+                    " WHERE rowid > ? ORDER BY rowid LIMIT ?",
+                    (last_rowid, SQL_BATCH_SIZE)
+                )
+                if not batch:
+                    break
+                last_rowid = batch[-1][0]
+
+                blobs = {}
+                rows = []
+                for _, revision_id, file_id, annotation in batch:
+                    annotation = encode_tuids(decode_tuids(annotation))
+                    hash = annotation_hash(annotation)
+                    blobs[hash] = annotation
+                    rows.append((revision_id, file_id, hash))
+                t.executemany(INSERT_ANNOTATION_BLOB, list(blobs.items()))
+                t.executemany(INSERT_ANNOTATION_QUERY, rows)
+                total += len(rows)
+
+            t.execute("DROP TABLE old_annotations")
+            blobs = t.get_one("SELECT count(1) FROM annotationBlobs")[0]
+        Log.note("Moved {{num}} annotations, {{blobs}} are distinct", num=total, blobs=blobs)
 
 
     def _dummy_tuid_exists(self, transaction, file_name, rev):
         # True if dummy, false if not.
         # None means there is no entry.
-        return None != transaction.get_one("select 1 from temporal where file=? and revision=? and line=?",
-                                         (file_name, rev, 0))
+        return None != transaction.get_one(GET_TUID_QUERY, (file_name, rev, 0))
 
 
     def _dummy_annotate_exists(self, transaction, file_name, rev):
         # True if dummy, false if not.
         # None means there is no entry.
-        return None != transaction.get_one("select annotation from annotations where file=? and revision=?",
-                                         (file_name, rev))
+        return None != self._get_annotation(rev, file_name, transaction)
 
 
     def insert_tuid_dummy(self, transaction, rev, file_name, commit=True):
-        # Inserts a dummy tuid: (-1,rev,file_name,0)
+        # Inserts a dummy tuid: (-1,rev,file_name,0), with a
+        # transaction on the main database
         if not self._dummy_tuid_exists(transaction, file_name, rev):
-            transaction.execute(
-                "INSERT INTO temporal (tuid, revision, file, line) VALUES (?, ?, ?, ?)",
-                (-1, rev[:12], file_name, 0)
-            )
+            self.insert_tuids(transaction, [(-1, rev[:12], file_name, 0)])
         return MISSING
 
 
     def insert_annotate_dummy(self, transaction, rev, file_name, commit=True):
         # Inserts annotation dummy: (rev, file, '')
         if not self._dummy_annotate_exists(transaction, file_name, rev):
-            self.insert_annotations(transaction, [(rev[:12], file_name, '')])
+            self.insert_annotations(transaction, [(rev[:12], file_name, encode_tuids([]))])
 
 
     def insert_annotations(self, transaction, data):
+        # Inserts (revision, file, annotation) rows, with a transaction
+        # on the shard of the files. The annotation is only stored if
+        # no other row of the shard has the same content.
+        if not data:
+            return
         if VERIFY_TUIDS:
-            for _, _, tuids_string in data:
-                self.destringify_tuids(tuids_string)
+            for _, _, annotation in data:
+                decode_tuids(annotation)
+
+        shard = self.shards.of_all([file for _, file, _ in data])
+        revision_ids = shard.revision_ids.add(transaction, [rev for rev, _, _ in data])
+        file_ids = shard.file_ids.add(transaction, [file for _, file, _ in data])
+        blobs = {}
+        rows = []
+        for rev, file, annotation in data:
+            hash = annotation_hash(annotation)
+            blobs[hash] = annotation
+            rows.append((revision_ids[rev], file_ids[file], hash))
+        self.compactor.keep(blobs.values())
+        transaction.executemany(INSERT_ANNOTATION_BLOB, list(blobs.items()))
+        transaction.executemany(INSERT_ANNOTATION_QUERY, rows)
+
+
+    def insert_tuids(self, transaction, data):
+        # Inserts (tuid, revision, file, line) rows, with a
+        # transaction on the main database
+        revision_ids = self.revision_ids.add(transaction, [rev for _, rev, _, _ in data])
+        file_ids = self.file_ids.add(transaction, [file for _, _, file, _ in data])
+        transaction.executemany(
+            INSERT_TUID_QUERY,
+            [(tuid, revision_ids[rev], file_ids[file], line) for tuid, rev, file, line in data]
+        )
+
 
-        transaction.execute(
-            "INSERT INTO annotations (revision, file, annotation) VALUES " +
-            sql_list(quote_list(row) for row in data)
+    def insert_latest_revisions(self, transaction, data):
+        # Inserts, or replaces, (file, revision) frontiers, with
+        # a transaction on the shard of the files
+        if not data:
+            return
+        shard = self.shards.of_all([file for file, _ in data])
+        file_ids = shard.file_ids.add(transaction, [file for file, _ in data])
+        revision_ids = shard.revision_ids.add(transaction, [rev for _, rev in data])
+        transaction.executemany(
+            INSERT_LATEST_MODIFICATION,
+            [(file_ids[file], revision_ids[rev]) for file, rev in data]
         )
 
 
     def _get_annotation(self, rev, file, transaction=None):
-        return coalesce(transaction, self.conn).get_one(GET_ANNOTATION_QUERY, (rev, file))[0]
+        # Returns the TuidArray of the file at the given revision, or
+        # None if it was never annotated. An empty TuidArray means
+        # the file does not exist at this revision.
+        tuids = self.annotation_cache.get((rev, file))
+        if tuids is not None:
+            self.statsdaemon.update_cache(hits=1)
+            return tuids
+
+        shard = self.shards.of(file)
+        revision_id = shard.revision_ids.get(transaction, [rev]).get(rev)
+        file_id = shard.file_ids.get(transaction, [file]).get(file)
+        tuids = None
+        if revision_id is not None and file_id is not None:
+            tuids = decode_tuids(coalesce(transaction, shard.conn).get_one(GET_ANNOTATION_QUERY, (revision_id, file_id))[0])
+        if tuids is None:
+            self.statsdaemon.update_cache(misses=1)
+            return None
+        tuids = TuidArray(tuids)
+        self._cache_annotations(rev, {file: tuids}, misses=1)
+        return tuids
+
+
+    def _get_annotations(self, rev, files, transaction=None):
+        # Bulk version of `_get_annotation`. Returns a {file: TuidArray}
+        # dict holding only the files that were annotated at the given
+        # revision. The files are looked up in chunks of SQL_BATCH_SIZE,
+        # a given transaction must be on the shard of the files.
+        annotations = {}
+        missing = []
+        for file in set(files):
+            tuids = self.annotation_cache.get((rev, file))
+            if tuids is None:
+                missing.append(file)
+            else:
+                annotations[file] = tuids
+        if not missing:
+            self.statsdaemon.update_cache(hits=len(annotations))
+            return annotations
+
+        found = {}
+        groups = [(self.shards.of_all(missing), missing)] if transaction else self.shards.group(missing)
+        for shard, shard_files in groups:
+            revision_id = shard.revision_ids.get(transaction, [rev]).get(rev)
+            file_ids = shard.file_ids.get(transaction, shard_files) if revision_id is not None else {}
+            files_by_id = {file_id: file for file, file_id in file_ids.items()}
+            db = coalesce(transaction, shard.conn)
+            for _, ids_chunk in jx.groupby(list(files_by_id), size=SQL_BATCH_SIZE):
+                for file_id, annotation in db.get(
+                    "SELECT a.file_id, b.annotation FROM annotations a"
+                    " JOIN annotationBlobs b ON b.hash=a.hash"
+                    " WHERE a.revision_id = " + quote_value(revision_id) +
+                    " AND a.file_id IN " + quote_set(ids_chunk)
+                ):
+                    found[files_by_id[file_id]] = TuidArray(decode_tuids(annotation))
+        self._cache_annotations(rev, found, hits=len(annotations), misses=len(missing))
+        annotations.update(found)
+        return annotations
+
+
+    def _cache_annotations(self, rev, annotations, hits=0, misses=0):
+        # Adds the {file: TuidArray} annotations read from the
+        # database to the cache, and records the cache stats.
+        evictions = 0
+        for file, tuids in annotations.items():
+            evictions += self.annotation_cache.set((rev, file), tuids)
+        self.statsdaemon.update_cache(
+            hits=hits,
+            misses=misses,
+            evictions=evictions,
+            cache_bytes=self.annotation_cache.bytes
+        )
+
+
+    def remove_cached_annotations(self, revisions):
+        '''
+        Drops the cached annotations of the given revisions. Must be
+        called after their rows are deleted from the `annotations` table.
+
+        :param revisions: List of revisions
+        :return: None
+        '''
+        revisions = set(revisions)
+        self.annotation_cache.remove(lambda key: key[0] in revisions)
+        self.snapshots.remove(revisions)
+        self.statsdaemon.update_cache(cache_bytes=self.annotation_cache.bytes)
 
 
     def _get_one_tuid(self, transaction, cset, path, line):
         # Returns a single TUID if it exists
-        return transaction.get_one(
-            "select tuid from temporal where revision=? and file=? and line=?",
-            (cset, path, int(line))
-        )
+        return transaction.get_one(GET_TUID_QUERY, (path, cset, int(line)))
 
     def _get_latest_revision(self, file, transaction):
         # Returns the latest revision that we
         # have information on the requested file.
-        return coalesce(transaction, self.conn).get_one(GET_LATEST_MODIFICATION, (file,))
+        return coalesce(transaction, self.shards.of(file).conn).get_one(GET_LATEST_MODIFICATION, (file,))
+
+    def _get_latest_revisions(self, files, transaction=None):
+        # Bulk version of `_get_latest_revision`. Returns a {file: revision}
+        # dict holding only the files that have a frontier. A given
+        # transaction must be on the shard of the files.
+        if not files:
+            return {}
+        latest_revs = {}
+        groups = [(self.shards.of_all(files), files)] if transaction else self.shards.group(files)
+        for shard, shard_files in groups:
+            files_by_id = {file_id: file for file, file_id in shard.file_ids.get(transaction, shard_files).items()}
+            db = coalesce(transaction, shard.conn)
+            for _, ids_chunk in jx.groupby(list(files_by_id), size=SQL_BATCH_SIZE):
+                latest_revs.update({
+                    files_by_id[file_id]: revision
+                    for file_id, revision in db.get(
+                        "SELECT l.file_id, r.revision FROM latestFileMod l"
+                        " JOIN revisions r ON r.revision_id=l.revision_id"
+                        " WHERE l.file_id IN " + quote_set(ids_chunk)
+                    )
+                })
+        return latest_revs
 
 
-    def stringify_tuids(self, tuid_list):
-        # Turns the TuidMap list to a string for storage in
-        # the annotations table.
-        return "\n".join([','.join([str(x.tuid), str(x.line)]) for x in tuid_list])
+    def _get_frontiers(self, revision, files):
+        # Returns the frontiers, and the annotations at the revision,
+        # of the files: ({file: revision}, {file: TuidArray}). Each
+        # shard is read in its own snapshot, all at the same time.
+        def read(shard, shard_files):
+            with shard.conn.read_transaction() as t:
+                return self._get_latest_revisions(shard_files, t), self._get_annotations(revision, shard_files, t)
 
+        latest_revs = {}
+        annotations = {}
+        for shard_revs, shard_annotations in self.shards.map(read, files):
+            latest_revs.update(shard_revs)
+            annotations.update(shard_annotations)
+        return latest_revs, annotations
 
-    def destringify_tuids(self, tuids_string):
-        # Builds up TuidMap list from annotation cache entry.
-        try:
-            lines = tuids_string.splitlines()
-            line_origins = []
-            for line in lines:
-                if not line:
-                    continue
-                tuid, linenum = line.split(',')
-                line_origins.append(
-                    TuidMap(int(tuid), int(linenum))
-                )
-            return line_origins
-        except Exception as e:
-            Log.error("Invalid entry in tuids list:\n{{list}}", list=tuids_string, cause=e)
+
+    def get_frontier_files(self, revision):
+        '''
+        :param revision: 12-char revision
+        :return: Files whose frontier is at the revision
+        '''
+        files = []
+        for shard in self.shards:
+            files.extend(file for file, in shard.conn.get(GET_FRONTIER_FILES, (revision,)))
+        return files
+
+
+    def delete_annotations(self, revisions):
+        '''
+        Deletes the frontiers and annotations at the given revisions, from
+        every shard, then drops them from the cache. Each shard is done
+        in its own transaction, so it must not be called with a
+        transaction open on the main database.
+
+        :param revisions: List of 12-char revisions
+        :return: None
+        '''
+        for _, revisions_chunk in jx.groupby(list(set(revisions)), size=SQL_BATCH_SIZE):
+            for shard in self.shards:
+                with shard.conn.transaction() as t:
+                    t.execute("DELETE FROM latestFileMod WHERE revision_id IN " + REVISION_IDS + quote_set(revisions_chunk) + ")")
+                    t.execute("DELETE FROM annotations WHERE revision_id IN " + REVISION_IDS + quote_set(revisions_chunk) + ")")
+        self.remove_cached_annotations(revisions)
 
 
     # Gets a diff from a particular revision from https://hg.mozilla.org/
@@ -248,56 +784,135 @@ class TUIDService:
 
     # Gets an annotated file from a particular revision from https://hg.mozilla.org/
     def _get_hg_annotate(self, cset, file, annotated_files, thread_num, repo, please_stop=None):
-        with self.ann_thread_locker:
-            self.ann_threads_running += 1
         url = str(HG_URL) +"/" + repo + "/json-annotate/" + cset + "/" + file
         if DEBUG:
             Log.note("HG: {{url}}", url=url)
 
+        annotated_files[thread_num] = []
+        if ANNOTATE_DEBUG:
+            Log.note("Waiting to request annotation at {{rev}} for file: {{file}}", rev=cset, file=file)
+
         # Wait until there is room to request
         self.statsdaemon.update_anns_waiting(1)
-        num_requests = MAX_CONCURRENT_ANN_REQUESTS
-        timeout = Till(seconds=ANN_WAIT_TIME.seconds)
-        while num_requests >= MAX_CONCURRENT_ANN_REQUESTS and not timeout:
-            with self.request_locker:
-                num_requests = self.num_requests
-                if num_requests < MAX_CONCURRENT_ANN_REQUESTS:
-                    self.num_requests += 1
-                    break
-            if ANNOTATE_DEBUG:
-                Log.note("Waiting to request annotation at {{rev}} for file: {{file}}", rev=cset, file=file)
-            Till(seconds=MAX_ANN_REQUESTS_WAIT_TIME.seconds).wait()
-        self.statsdaemon.update_anns_waiting(-1)
-
-        annotated_files[thread_num] = []
-        if not timeout:
-            try:
-                annotated_files[thread_num] = http.get_json(url, retry=RETRY)
-            except Exception as e:
-                Log.warning("Unexpected error while trying to get annotate for {{url}}", url=url, cause=e)
-            finally:
-                with self.request_locker:
-                    self.num_requests -= 1
-        else:
+        try:
+            with self.ann_requests(ANN_WAIT_TIME.seconds):
+                self.statsdaemon.update_anns_waiting(-1)
+                try:
+                    annotated_files[thread_num] = http.get_json(url, retry=RETRY)
+                except Exception as e:
+                    Log.warning("Unexpected error while trying to get annotate for {{url}}", url=url, cause=e)
+        except Exception as e:
+            self.statsdaemon.update_anns_waiting(-1)
             Log.warning(
                 "Timeout {{timeout}} exceeded waiting for annotation: {{url}}",
                 timeout=ANN_WAIT_TIME,
-                url=url
+                url=url,
+                cause=e
             )
-        with self.ann_thread_locker:
-            self.ann_threads_running -= 1
         return
 
 
     def get_diffs(self, csets, repo=None):
-        # Get all the diffs
+        '''
+        Gets the diffs of the given changesets. Parsed diffs are kept in
+        the `diffs` table; the ones that are not there yet are requested
+        in parallel, then stored.
+
+        :param csets: List of changesets
+        :param repo: Branch the changesets are in
+        :return: List of {'cset': cset, 'diff': diff} in the order of `csets`
+        '''
         if repo is None:
             repo = self.config.hg.branch
 
-        list_diffs = []
+        diffs = self._get_stored_diffs(csets)
+        futures = {}
         for cset in csets:
-            list_diffs.append({'cset': cset, 'diff': self._get_hg_diff(cset,repo=repo)})
-        return list_diffs
+            if cset[:12] not in diffs and cset[:12] not in futures:
+                futures[cset[:12]] = self.diff_pool.submit(self._fetch_hg_diff, cset, repo)
+
+        if futures:
+            Log.note("Requesting {{num}} diffs that are not stored", num=len(futures))
+            fetched = {}
+            try:
+                for cset, future in futures.items():
+                    fetched[cset] = future.result()
+            finally:
+                # Keep the ones we got, even if others failed
+                if fetched:
+                    with self.conn.transaction() as t:
+                        t.executemany(
+                            INSERT_DIFF,
+                            [(cset, encode_diff(diff)) for cset, diff in fetched.items()]
+                        )
+                        t.executemany(
+                            INSERT_CSET_FILE,
+                            [
+                                (cset, file, change)
+                                for cset, diff in fetched.items()
+                                for file, change in _changed_files(diff)
+                            ]
+                        )
+            diffs.update(fetched)
+
+        return [{'cset': cset, 'diff': diffs[cset[:12]]} for cset in csets]
+
+
+    def prefetch_diffs(self, csets, repo=None, please_stop=None):
+        '''
+        Stores the diffs of the given changesets, so they are not
+        requested later, when they are needed to update files.
+
+        :param csets: List of changesets
+        :param repo: Branch the changesets are in
+        :return: None
+        '''
+        try:
+            self.get_diffs(csets, repo=repo)
+        except Exception as e:
+            Log.warning("Could not prefetch diffs for {{csets}}", csets=csets, cause=e)
+
+
+    def _get_stored_diffs(self, csets):
+        # Returns the diffs found in the `diffs` table, by 12-char revision
+        diffs = {}
+        revisions = list(set(cset[:12] for cset in csets))
+        with self.conn.read_transaction() as t:
+            for _, batch in jx.groupby(revisions, size=SQL_BATCH_SIZE):
+                for revision, diff in t.get("SELECT revision, diff FROM diffs WHERE revision IN " + quote_set(batch)):
+                    diffs[revision] = decode_diff(diff)
+        return diffs
+
+
+    def _get_changed_files(self, revisions, files):
+        '''
+        Uses the `csetFiles` table to find which of the files are
+        changed by the revisions, without getting their diffs.
+
+        :param revisions: List of 12-char revisions
+        :param files: List of files
+        :return: (indexed, changes) - the set of revisions found in the index,
+                 and a list of (revision, file, change) for the given files
+        '''
+        indexed = set()
+        changes = []
+        with self.conn.read_transaction() as t:
+            for _, revisions_chunk in jx.groupby(revisions, size=SQL_BATCH_SIZE):
+                indexed.update(
+                    revision
+                    for revision, in t.get("SELECT revision FROM diffs WHERE revision IN " + quote_set(revisions_chunk))
+                )
+                for _, files_chunk in jx.groupby(files, size=SQL_BATCH_SIZE):
+                    changes.extend(t.get(
+                        "SELECT revision, file, change FROM csetFiles"
+                        " WHERE revision IN " + quote_set(revisions_chunk) +
+                        " AND file IN " + quote_set(files_chunk)
+                    ))
+        return indexed, changes
+
+
+    def _fetch_hg_diff(self, cset, repo, please_stop=None):
+        return self._get_hg_diff(cset, repo=repo)
 
 
     def get_tuids_from_revision(self, revision):
@@ -429,6 +1044,35 @@ class TUIDService:
         :return: The following tuple which contains:
                     ([list of (file, list(tuids)) tuples], True/False if completed or not)
         """
+        result, completed, _ = self.get_tuids_and_job(
+            files,
+            revision,
+            going_forward=going_forward,
+            repo=repo,
+            use_thread=use_thread,
+            max_csets_proc=max_csets_proc
+        )
+        return result, completed
+
+
+    def get_tuids_and_job(
+            self,
+            files,
+            revision,
+            going_forward=False,
+            repo=None,
+            use_thread=True,
+            max_csets_proc=30
+        ):
+        """
+        Same as `get_tuids_from_files`, but also returns the job that is
+        processing the files missing from an incomplete result.
+
+        Files already being processed by another job, for this revision,
+        are not processed again; the new job waits for them instead.
+        :return: The following tuple which contains:
+                    ([list of (file, list(tuids)) tuples], True/False if completed or not, Job or None)
+        """
         self._add_thread()
         completed = True
 
@@ -438,7 +1082,7 @@ class TUIDService:
             if not check:
                 # Error was already output by _check_branch
                 self._remove_thread()
-                return [(file, []) for file in files], completed
+                return [(file, []) for file in files], completed, None
 
         if repo in ('try',):
             # We don't need to keep latest file revisions
@@ -451,18 +1095,40 @@ class TUIDService:
                 result = [(file, []) for file in files], completed
 
             self._remove_thread()
-            return result
+            return result + (None,)
 
-        result = []
         revision = revision[:12]
         files = [file.lstrip('/') for file in files]
+
+        # Files in the snapshot of the revision are read from
+        # its file, without waiting for the database. Their
+        # frontier moves to the revision, like the files whose
+        # annotation is found in the database.
+        result = self.snapshots.get_tuids(revision, files) if self.snapshots else []
+        num_requested = len(files)
+        latestFileMod_inserts = {}
+        if result:
+            in_snapshot = set(file for file, _ in result)
+            files = [file for file in files if file not in in_snapshot]
+            latestFileMod_inserts = {file: (file, revision) for file in in_snapshot}
+            if not files:
+                self._update_latest_revisions(latestFileMod_inserts)
+                self.statsdaemon.update_totals(num_requested, len(result))
+                self._remove_thread()
+                return result, completed, None
+
         frontier_update_list = []
 
         total = len(files)
-        latestFileMod_inserts = {}
         new_files = []
 
         log_existing_files = []
+        readded_files = []
+
+        # Get the frontiers and existing annotations of
+        # all the files at once.
+        latest_revs, existing_anns = self._get_frontiers(revision, files)
+
         for count, file in enumerate(files):
             # Go through all requested files and
             # either update their frontier or add
@@ -471,31 +1137,24 @@ class TUIDService:
             if DEBUG:
                 Log.note(" {{percent|percent(decimal=0)}}|{{file}}", file=file, percent=count / total)
 
-            with self.conn.transaction() as t:
-                latest_rev = self._get_latest_revision(file, t)
-                already_ann = self._get_annotation(revision, file, t)
+            latest_rev = latest_revs.get(file)
+            already_ann = existing_anns.get(file)
 
             # Check if the file has already been collected at
             # this revision and get the result if so
-            if already_ann:
-                result.append((file,self.destringify_tuids(already_ann)))
+            if already_ann is not None:
+                result.append((file, already_ann))
                 latestFileMod_inserts[file] = (file, revision)
-                log_existing_files.append('exists|' + file)
-                continue
-            elif already_ann == '':
-                result.append((file,[]))
-                latestFileMod_inserts[file] = (file, revision)
-                log_existing_files.append('removed|' + file)
+                log_existing_files.append(('exists|' if already_ann else 'removed|') + file)
                 continue
 
-            if (latest_rev and latest_rev[0] != revision):
+            if latest_rev and latest_rev != revision:
                 # File has a frontier, let's update it
                 if DEBUG:
                     Log.note("Will update frontier for file {{file}}.", file=file)
-                frontier_update_list.append((file, latest_rev[0]))
+                frontier_update_list.append((file, latest_rev))
             elif latest_rev == revision:
-                with self.conn.transaction() as t:
-                    t.execute("DELETE FROM latestFileMod WHERE file = " + quote_value(file))
+                readded_files.append(file)
                 new_files.append(file)
                 Log.note(
                     "Missing annotation for existing frontier - readding: "
@@ -524,13 +1183,7 @@ class TUIDService:
                 rev=revision, percent=len(log_existing_files)/len(files)
             )
 
-        if len(latestFileMod_inserts) > 0:
-            with self.conn.transaction() as transaction:
-                for _, inserts_list in jx.groupby(latestFileMod_inserts.values(), size=SQL_BATCH_SIZE):
-                    transaction.execute(
-                        "INSERT OR REPLACE INTO latestFileMod (file, revision) VALUES " +
-                        sql_list(quote_list(i) for i in inserts_list)
-                    )
+        self._update_latest_revisions(latestFileMod_inserts, readded_files)
 
         def update_tuids_in_thread(
                 new_files,
@@ -562,27 +1215,27 @@ class TUIDService:
                         latestFileMod_inserts[file] = (file, revision)
 
                 Log.note("Finished updating frontiers. Updating DB table `latestFileMod`...")
-                if len(latestFileMod_inserts) > 0:
-                    with self.conn.transaction() as transaction:
-                        for _, inserts_list in jx.groupby(latestFileMod_inserts.values(), size=SQL_BATCH_SIZE):
-                            transaction.execute(
-                                "INSERT OR REPLACE INTO latestFileMod (file, revision) VALUES " +
-                                sql_list(quote_list(i) for i in inserts_list)
-                            )
-
-                # If we have files that need to have their frontier updated, do that now
-                if len(frontier_update_list) > 0:
-                    tmp = self._update_file_frontiers(
-                        frontier_update_list,
+                for shard, inserts in self.shards.group(list(latestFileMod_inserts.values()), key=lambda row: row[0]):
+                    with shard.conn.transaction() as transaction:
+                        self.insert_latest_revisions(transaction, inserts)
+
+                # If we have files that need to have their frontier updated, do that now,
+                # each shard at the same time
+                for tmp in self.shards.map(
+                    lambda shard, shard_frontiers: self._update_file_frontiers(
+                        shard_frontiers,
                         revision,
                         going_forward=going_forward,
                         max_csets_proc=max_csets_proc
-                    )
+                    ),
+                    frontier_update_list,
+                    key=lambda frontier: frontier[0]
+                ):
                     result.extend(tmp)
 
             except Exception as e:
                 Log.warning("Thread dead becasue of problem", cause=e)
-                result = [[] for _ in range(len(new_files) + len(frontier_update_list))]
+                result = [(file, []) for file in new_files + [file for file, _ in frontier_update_list]]
             finally:
                 self._remove_thread()
 
@@ -599,45 +1252,69 @@ class TUIDService:
             if (len(new_files) + len(frontier_update_list) > FILES_TO_PROCESS_THRESH):
                 threaded = True
 
+        job = None
         if threaded:
             completed = False
             Log.note("Incomplete response given")
 
-            thread_count = 0
-            prev_ind = 0
-            curr_ind = 0
-
-            while curr_ind <= len(frontier_update_list) or curr_ind <= len(new_files):
-                thread_count += 1
-                prev_ind = curr_ind
-                curr_ind += WORK_OVERFLOW_BATCH_SIZE
-                recomputed_new = new_files[prev_ind:curr_ind]
-                recomputed_frontier_updates = frontier_update_list[prev_ind:curr_ind]
-                Thread.run(
-                    'get_tuids_from_files (' + Random.base64(9) + ")",
-                    update_tuids_in_thread, recomputed_new, recomputed_frontier_updates, revision, threaded
-                )
-            for _ in range(1, thread_count): # Skip the first thread
+            frontier_revs = dict(frontier_update_list)
+
+            def process_job_files(job_files, please_stop=None):
+                # Runs in a job thread, which update_tuids_in_thread removes from the count
                 self._add_thread()
+                return update_tuids_in_thread(
+                    [file for file in job_files if file not in frontier_revs],
+                    [(file, frontier_revs[file]) for file in job_files if file in frontier_revs],
+                    revision,
+                    threaded,
+                    please_stop=please_stop
+                )
+
+            job = self.jobs.submit(
+                revision,
+                new_files + [file for file, _ in frontier_update_list],
+                process_job_files,
+                WORK_OVERFLOW_BATCH_SIZE
+            )
+            Log.note(
+                "Job {{job}} is processing {{num}} files for revision {{cset}}",
+                job=job.id,
+                num=len(job.files),
+                cset=revision
+            )
+            self._remove_thread()
         else:
+            # Removes this thread from the count when done
             result.extend(
                 update_tuids_in_thread(new_files, frontier_update_list, revision, threaded)
             )
-            self._remove_thread()
 
-        self.statsdaemon.update_totals(len(files), len(result))
-
-        # Log memory growth periodically
-        with self.count_locker:
-            if self.count_locker.value >= MEMORY_LOG_INTERVAL:
-                Log.note("Forcing Garbage collection to help with memory.")
-                gc.collect()
-                self.count_locker.value = 0
-
-        return result, completed
+        self.statsdaemon.update_totals(num_requested, len(result))
+        return result, completed, job
+
+
+    def _update_latest_revisions(self, latestFileMod_inserts, readded_files=()):
+        # Sets the frontiers of {file: (file, revision)}, and deletes
+        # those of the readded files, one transaction per shard
+        if len(latestFileMod_inserts) <= 0 and len(readded_files) <= 0:
+            return
+        readded_files = set(readded_files)
+        for shard, shard_files in self.shards.group(list(set(latestFileMod_inserts) | readded_files)):
+            with shard.conn.transaction() as transaction:
+                self.insert_latest_revisions(
+                    transaction,
+                    [latestFileMod_inserts[file] for file in shard_files if file in latestFileMod_inserts]
+                )
+                readded_ids = list(shard.file_ids.get(
+                    transaction, [file for file in shard_files if file in readded_files]
+                ).values())
+                for _, deletes_list in jx.groupby(readded_ids, size=SQL_BATCH_SIZE):
+                    transaction.execute(
+                        "DELETE FROM latestFileMod WHERE file_id IN " + quote_set(deletes_list)
+                    )
 
 
-    def _apply_diff(self, transaction, annotation, diff, cset, file):
+    def _apply_diff(self, annotation, diff, cset, file):
         '''
         Using an annotation ([(tuid,line)] - array
         of TuidMap objects), we change the line numbers to
@@ -657,17 +1334,9 @@ class TUIDService:
         if file.lstrip('/') == 'dev/null':
             return [], file
 
-        list_to_insert = []
         new_ann = [x for x in annotation]
         new_ann.sort(key=lambda x: x.line)
 
-        def add_one(tl_tuple, lines):
-            start = tl_tuple.line
-            return lines[:start-1] + [tl_tuple] + [TuidMap(tmap.tuid, int(tmap.line) + 1) for tmap in lines[start-1:]]
-
-        def remove_one(start, lines):
-            return lines[:start-1] + [TuidMap(tmap.tuid, int(tmap.line) - 1) for tmap in lines[start:]]
-
         for f_proc in diff['diffs']:
             new_fname = f_proc['new'].name.lstrip('/')
             old_fname = f_proc['old'].name.lstrip('/')
@@ -680,29 +1349,50 @@ class TUIDService:
                 # are correctly created.
                 file = new_fname
 
-            f_diff = f_proc['changes']
-            for change in f_diff:
-                if change.action == '+':
-                    tuid_tmp = self._get_one_tuid(transaction, cset, file, change.line+1)
-                    if not tuid_tmp:
-                        new_tuid = self.tuid()
-                        list_to_insert.append((new_tuid, cset, file, change.line+1))
-                    else:
-                        new_tuid = tuid_tmp[0]
-                    new_ann = add_one(TuidMap(new_tuid, change.line+1), new_ann)
-                elif change.action == '-':
-                    new_ann = remove_one(change.line+1, new_ann)
+            # Splice in all the changes in one pass, new lines
+            # have no tuid until we find or create one below.
+            new_ann = splice_lines(new_ann, f_proc['changes'], lambda linenum: TuidMap(None, linenum))
+            new_ann = [TuidMap(tmap.tuid, linenum + 1) for linenum, tmap in enumerate(new_ann)]
             break # Found the file, exit searching
 
-        if len(list_to_insert) > 0:
-            count = 0
-            for _, inserts_list in jx.groupby(list_to_insert, size=SQL_BATCH_SIZE):
-                transaction.execute(
-                    "INSERT INTO temporal (tuid, revision, file, line)"
-                    " VALUES " +
-                    sql_list(quote_list(tp) for tp in inserts_list)
-                )
+        new_lines = [tmap.line for tmap in new_ann if tmap.tuid is None]
+        if not new_lines:
+            return new_ann, file
 
+        # The tuids are in the main database, the lines found and
+        # the ones created are in the same transaction so no other
+        # thread creates them in between
+        existing_tuids = {}
+        with self.conn.transaction() as t:
+            file_id = self.file_ids.get(t, [file]).get(file)
+            revision_id = self.revision_ids.get(t, [cset]).get(cset)
+            if file_id is not None and revision_id is not None:
+                for _, lines in jx.groupby(new_lines, size=SQL_BATCH_SIZE):
+                    existing_tuids.update({
+                        line: tuid
+                        for line, tuid in t.query(
+                            "SELECT line, tuid FROM temporal"
+                            " WHERE file_id = " + quote_value(file_id) +
+                            " AND revision_id = " + quote_value(revision_id) +
+                            " AND line IN " + quote_set(lines)
+                        ).data
+                    })
+
+            list_to_insert = []
+            missing_lines = [linenum for linenum in new_lines if linenum not in existing_tuids]
+            first_tuid = self.reserve_tuids(t, len(missing_lines))
+            for offset, linenum in enumerate(missing_lines):
+                existing_tuids[linenum] = first_tuid + offset
+                list_to_insert.append((existing_tuids[linenum], cset, file, linenum))
+
+            if len(list_to_insert) > 0:
+                self.insert_tuids(t, list_to_insert)
+            self.compactor.keep_tuids(existing_tuids.values())
+
+        new_ann = [
+            tmap if tmap.tuid is not None else TuidMap(existing_tuids[tmap.line], tmap.line)
+            for tmap in new_ann
+        ]
         return new_ann, file
 
 
@@ -725,16 +1415,12 @@ class TUIDService:
         files_to_update = []
 
         # Check if the files were already annotated.
+        existing_anns = self._get_annotations(revision, files)
         for file in files:
-            with self.conn.transaction() as t:
-                already_ann = self._get_annotation(revision, file, transaction=t)
-            if already_ann and already_ann[0] == '':
-                result.append((file, []))
-                log_existing_files.append('removed|' + file)
-                continue
-            elif already_ann:
-                result.append((file, self.destringify_tuids(already_ann)))
-                log_existing_files.append('exists|' + file)
+            already_ann = existing_anns.get(file)
+            if already_ann is not None:
+                result.append((file, already_ann))
+                log_existing_files.append(('exists|' if already_ann else 'removed|') + file)
                 continue
             else:
                 files_to_update.append(file)
@@ -828,66 +1514,62 @@ class TUIDService:
         curr_annots_dict = {file: mc_annot for file, mc_annot in curr_annotations}
 
         anns_to_get = []
-        ann_inserts = []
         tmp_results = {}
 
-        with self.conn.transaction() as transaction:
-            for file in files_to_update:
-                if file not in curr_annots_dict:
-                    Log.note(
-                        "WARNING: Missing annotation entry in mozilla-central branch revision {{cset}} "
-                        "for {{file}}",
-                        file=file, cset=mc_revision
-                    )
-                    # Try getting it from the try revision
-                    anns_to_get.append(file)
-                    continue
+        # Each shard is read first, so other threads, and a compaction
+        # starting, wait for the annotations of its files to be inserted
+        anns_added_by_other_thread = {}
+        for shard, shard_files in self.shards.group(files_to_update):
+            with shard.conn.transaction() as transaction:
+                # Check if any were added in the mean time by another thread
+                anns_added_by_other_thread.update(self._get_annotations(revision, shard_files, transaction))
+                ann_inserts = []
+                for file in shard_files:
+                    if file in anns_added_by_other_thread:
+                        tmp_results[file] = anns_added_by_other_thread[file]
+                        continue
 
-                if file in added_files:
-                    Log.note("Try revision run - added: {{file}}", file=file)
-                    anns_to_get.append(file)
-                elif file in removed_files:
-                    Log.note("Try revision run - removed: {{file}}", file=file)
-                    ann_inserts.append((revision, file, ''))
-                    tmp_results[file] = []
-                elif file in files_to_process:
-                    Log.note("Try revision run - modified: {{file}}", file=file)
-                    csets_to_proc = files_to_process[file]
-                    old_ann = curr_annots_dict[file]
-
-                    # Apply all the diffs
-                    tmp_res = old_ann
-                    new_fname = file
-                    for i in csets_to_proc:
-                        tmp_res, new_fname = self._apply_diff(transaction, tmp_res, parsed_diffs[i], i, new_fname)
-
-                    ann_inserts.append((revision, file, self.stringify_tuids(tmp_res)))
-                    tmp_results[file] = tmp_res
-                else:
-                    # Nothing changed with the file, use it's current annotation
-                    Log.note("Try revision run - not modified: {{file}}", file=file)
-                    ann_inserts.append((revision, file, self.stringify_tuids(curr_annots_dict[file])))
-                    tmp_results[file] = curr_annots_dict[file]
+                    if file not in curr_annots_dict:
+                        Log.note(
+                            "WARNING: Missing annotation entry in mozilla-central branch revision {{cset}} "
+                            "for {{file}}",
+                            file=file, cset=mc_revision
+                        )
+                        # Try getting it from the try revision
+                        anns_to_get.append(file)
+                        continue
 
-            # Insert and check annotations, get all that were
-            # added by another thread.
-            anns_added_by_other_thread = {}
-            if len(ann_inserts) > 0:
-                ann_inserts = list(set(ann_inserts))
-                for _, tmp_inserts in jx.groupby(ann_inserts, size=SQL_ANN_BATCH_SIZE):
-                    # Check if any were added in the mean time by another thread
-                    recomputed_inserts = []
-                    for rev, filename, tuids in tmp_inserts:
-                        tmp_ann = self._get_annotation(rev, filename, transaction=transaction)
-                        if not tmp_ann and tmp_ann != '':
-                            recomputed_inserts.append((rev, filename, tuids))
-                        else:
-                            anns_added_by_other_thread[filename] = self.destringify_tuids(tmp_ann)
+                    if file in added_files:
+                        Log.note("Try revision run - added: {{file}}", file=file)
+                        anns_to_get.append(file)
+                    elif file in removed_files:
+                        Log.note("Try revision run - removed: {{file}}", file=file)
+                        ann_inserts.append((revision, file, encode_tuids([])))
+                        tmp_results[file] = []
+                    elif file in files_to_process:
+                        Log.note("Try revision run - modified: {{file}}", file=file)
+                        csets_to_proc = files_to_process[file]
+                        old_ann = curr_annots_dict[file]
+
+                        # Apply all the diffs
+                        tmp_res = old_ann
+                        new_fname = file
+                        for i in csets_to_proc:
+                            tmp_res, new_fname = self._apply_diff(tmp_res, parsed_diffs[i], i, new_fname)
+
+                        ann_inserts.append((revision, file, encode_tuids(tmp_res)))
+                        tmp_results[file] = tmp_res
+                    else:
+                        # Nothing changed with the file, use it's current annotation
+                        Log.note("Try revision run - not modified: {{file}}", file=file)
+                        ann_inserts.append((revision, file, encode_tuids(curr_annots_dict[file])))
+                        tmp_results[file] = curr_annots_dict[file]
 
-                    try:
-                        self.insert_annotations(transaction, recomputed_inserts)
-                    except Exception as e:
-                        Log.error("Error inserting into annotations table.", cause=e)
+                try:
+                    for _, tmp_inserts in jx.groupby(list(set(ann_inserts)), size=SQL_ANN_BATCH_SIZE):
+                        self.insert_annotations(transaction, tmp_inserts)
+                except Exception as e:
+                    Log.error("Error inserting into annotations table.", cause=e)
 
         if len(anns_to_get) > 0:
             result.extend(self.get_tuids(anns_to_get, revision, repo=repo))
@@ -917,7 +1599,7 @@ class TUIDService:
         stop looking after max_csets_proc and update all files at the given
         revision.
 
-        :param frontier_list: list of files to update
+        :param frontier_list: list of (file, frontier) to update, the files all in one shard
         :param revision: revision to update files to
         :param max_csets_proc: maximum number of changeset logs to look through
                                to find past frontiers.
@@ -976,6 +1658,17 @@ class TUIDService:
         for cset in diffs_to_frontier:
             diffs_cache.extend([rev for revnum, rev in diffs_to_frontier[cset]])
 
+        # Only get the diffs of changesets that change the files. Those
+        # that are not indexed yet, or that rename the files, need
+        # their diffs to be looked at.
+        diffs_cache = list(set(diffs_cache))
+        indexed, changes = self._get_changed_files(diffs_cache, list(file_to_frontier.keys()))
+        if not any(change in ('F', 'T') for _, _, change in changes):
+            diffs_cache = list(
+                set(rev for rev, _, _ in changes) |
+                set(rev for rev in diffs_cache if rev not in indexed)
+            )
+
         Log.note("Gathering diffs for: {{csets}}", csets=str(diffs_cache))
         all_diffs = self.get_diffs(diffs_cache)
 
@@ -1004,7 +1697,9 @@ class TUIDService:
         total = len(file_to_frontier)
         tmp_results = {}
 
-        with self.conn.transaction() as transaction:
+        # All the files are in one shard, the tuids of new lines are
+        # inserted in the main database by `insert_new_tuids`
+        with self.shards.of_all([file for file, _ in frontier_list]).conn.transaction() as transaction:
             for count, (file, old_frontier) in enumerate(frontier_list):
                 # If the file was modified, get it's newest
                 # annotation and update the file.
@@ -1012,7 +1707,7 @@ class TUIDService:
                 if file in files_to_process:
                     # Process this file using the diffs found
                     tmp_ann = self._get_annotation(old_frontier, file, transaction)
-                    if tmp_ann is None or tmp_ann == '' or self.destringify_tuids(tmp_ann) is None:
+                    if not tmp_ann:
                         Log.warning(
                             "{{file}} has frontier but can't find old annotation for it in {{rev}}, "
                             "restarting it's frontier.",
@@ -1023,7 +1718,7 @@ class TUIDService:
                     else:
                         # File was modified, apply it's diffs
                         csets_to_proc = diffs_to_frontier[file_to_frontier[file]]
-                        tmp_res = self.destringify_tuids(tmp_ann)
+                        tmp_res = tmp_ann
                         file_to_modify = AnnotateFile(
                             file,
                             [TuidLine(tuidmap, filename=file) for tuidmap in tmp_res],
@@ -1046,7 +1741,9 @@ class TUIDService:
                         # going forward.
                         csets_to_proc = csets_to_proc[1:]
 
-                        # Apply the diffs
+                        # Apply all the diffs, then get the tuids of
+                        # the new lines that are left in one pass
+                        diffs = []
                         for diff_count, (_, rev) in enumerate(csets_to_proc):
 
                             # Use next revision when going backwards
@@ -1055,28 +1752,26 @@ class TUIDService:
                             if diff_count + 1 < len(csets_to_proc):
                                 _, next_rev = csets_to_proc[diff_count + 1]
 
-                            rev_to_proc = next_rev
-                            if backwards:
-                                file_to_modify = apply_diff_backwards(file_to_modify, parsed_diffs[rev])
-                            else:
-                                file_to_modify = apply_diff(file_to_modify, parsed_diffs[rev])
-                                rev_to_proc = rev
-
-                            try:
-                                file_to_modify.create_and_insert_tuids(rev_to_proc)
-                            except Exception as e:
-                                file_to_modify.failed_file = True
-                                Log.warning(
-                                    "Failed to create and insert tuids - likely due to merge conflict.",
-                                    cause=e
-                                )
-                                break
-                            file_to_modify.reset_new_lines()
+                            rev_to_proc = next_rev if backwards else rev
+                            diffs.append((rev_to_proc, parsed_diffs.get(rev, UNCHANGED_DIFF)))
+
+                        try:
+                            file_to_modify.apply_diffs(diffs, backwards=backwards)
+                            file_to_modify.insert_new_tuids()
+                        except Exception as e:
+                            file_to_modify.failed_file = True
+                            Log.warning(
+                                "Failed to create and insert tuids - likely due to merge conflict.",
+                                cause=e
+                            )
 
                         if not file_to_modify.failed_file:
-                            tmp_res = file_to_modify.lines_to_annotation()
+                            tmp_res = TuidArray(array(
+                                TUID_TYPECODE,
+                                [line_obj.tuid for line_obj in file_to_modify.lines]
+                            ))
 
-                        ann_inserts.append((revision, file, self.stringify_tuids(tmp_res)))
+                        ann_inserts.append((revision, file, encode_tuids(tmp_res)))
                         Log.note(
                             "Frontier update - modified: {{count}}/{{total}} - {{percent|percent(decimal=0)}} "
                             "| {{rev}}|{{file}} ",
@@ -1088,7 +1783,7 @@ class TUIDService:
                         )
                 else:
                     old_ann = self._get_annotation(old_frontier, file, transaction)
-                    if old_ann is None or (old_ann == '' and file in added_files):
+                    if old_ann is None or (not old_ann and file in added_files):
                         # File is new (likely from an error), or re-added - we need to create
                         # a new initial entry for this file.
                         anns_to_get.append(file)
@@ -1104,8 +1799,8 @@ class TUIDService:
                     else:
                         # File was not modified since last
                         # known revision
-                        tmp_res = self.destringify_tuids(old_ann) if old_ann != '' else []
-                        ann_inserts.append((revision, file, old_ann))
+                        tmp_res = old_ann
+                        ann_inserts.append((revision, file, encode_tuids(old_ann)))
                         Log.note(
                             "Frontier update - not modified: {{count}}/{{total}} - {{percent|percent(decimal=0)}} "
                             "| {{rev}}|{{file}} ",
@@ -1138,11 +1833,7 @@ class TUIDService:
             # No need to double-check if latesteFileMods has been updated before,
             # we perform an insert or replace any way.
             if len(latestFileMod_inserts) > 0:
-                for _, inserts_list in jx.groupby(latestFileMod_inserts.values(), size=SQL_BATCH_SIZE):
-                    transaction.execute(
-                        "INSERT OR REPLACE INTO latestFileMod (file, revision) VALUES " +
-                        sql_list(quote_list(i) for i in inserts_list)
-                    )
+                self.insert_latest_revisions(transaction, list(latestFileMod_inserts.values()))
 
             anns_added_by_other_thread = {}
             if len(ann_inserts) > 0:
@@ -1150,12 +1841,13 @@ class TUIDService:
                 for _, tmp_inserts in jx.groupby(ann_inserts, size=SQL_ANN_BATCH_SIZE):
                     # Check if any were added in the mean time by another thread
                     recomputed_inserts = []
-                    for rev, filename, string_tuids in tmp_inserts:
-                        tmp_ann = self._get_annotation(rev, filename, transaction)
-                        if not tmp_ann and tmp_ann != '':
-                            recomputed_inserts.append((rev, filename, string_tuids))
+                    existing_anns = self._get_annotations(revision, [filename for _, filename, _ in tmp_inserts], transaction)
+                    for rev, filename, annotation in tmp_inserts:
+                        tmp_ann = existing_anns.get(filename)
+                        if tmp_ann is None:
+                            recomputed_inserts.append((rev, filename, annotation))
                         else:
-                            anns_added_by_other_thread[filename] = self.destringify_tuids(tmp_ann)
+                            anns_added_by_other_thread[filename] = tmp_ann
 
                     if len(recomputed_inserts) <= 0:
                         continue
@@ -1172,7 +1864,7 @@ class TUIDService:
             tuids = tmp_results[f]
             if f in anns_added_by_other_thread:
                 tuids = anns_added_by_other_thread[f]
-            result.append((copy.deepcopy(f), copy.deepcopy(tuids)))
+            result.append((f, tuids))
         return result
 
 
@@ -1203,13 +1895,11 @@ class TUIDService:
                 new_files[count] = file.lstrip('/')
 
             annotations_to_get = []
+            existing_anns = self._get_annotations(revision, new_files)
             for file in new_files:
-                with self.conn.transaction() as t:
-                    already_ann = self._get_annotation(revision, file, transaction=t)
-                if already_ann:
-                    results.append((file, self.destringify_tuids(already_ann)))
-                elif already_ann == '':
-                    results.append((file, []))
+                already_ann = existing_anns.get(file)
+                if already_ann is not None:
+                    results.append((file, already_ann))
                 else:
                     annotations_to_get.append(file)
 
@@ -1217,77 +1907,95 @@ class TUIDService:
                 # No new annotations to get, so get next set
                 continue
 
-            # Get all the annotations in parallel and
-            # store in annotated_files and
-            # prevent too many threads from starting up here.
-            self.statsdaemon.update_threads_waiting(len(annotations_to_get))
-            num_threads = chunk
-            timeout = Till(seconds=ANN_WAIT_TIME.seconds)
-            while num_threads >= chunk and not timeout:
-                with self.ann_thread_locker:
-                    num_threads = self.ann_threads_running
-                    if num_threads <= chunk:
-                        break
-                Till(seconds=MAX_THREAD_WAIT_TIME.seconds).wait()
-            self.statsdaemon.update_threads_waiting(-len(annotations_to_get))
-
-            if timeout:
-                Log.warning(
-                    "Timeout {{timeout}} exceeded waiting to start annotation threads.",
-                    timeout=MAX_ANN_REQUESTS_WAIT_TIME
-                )
-                annotated_files = [[] for _ in annotations_to_get]
-            else:
-                # Recompute annotations to get here, in case we've waited
-                # a while.
-                old_annotations_len = len(annotations_to_get)
-                new_annotations_to_get = []
-                for file in annotations_to_get:
-                    with self.conn.transaction() as t:
-                        already_ann = self._get_annotation(revision, file, transaction=t)
-                    if already_ann:
-                        results.append((file, self.destringify_tuids(already_ann)))
-                    elif already_ann == '':
-                        results.append((file, []))
-                    else:
-                        new_annotations_to_get.append(file)
-                annotations_to_get = new_annotations_to_get
+            # Only one thread gets and inserts each annotation, the
+            # others asking for it at the same time wait for the result.
+            led, followed = self.annotations_in_flight.claim(
+                [(repo, revision, file) for file in annotations_to_get]
+            )
+            annotations_to_get = [file for _, _, file in led]
+            annotated_files = [None] * len(annotations_to_get)
+            self.statsdaemon.update_annotations_in_flight(fetched=len(led), coalesced=len(followed))
 
-                if not annotations_to_get:
-                    continue
+            new_results = []
+            try:
+                if annotations_to_get:
+                    # Get all the annotations in parallel, with
+                    # the annotation workers, into annotated_files
+                    futures = []
+                    self.statsdaemon.update_threads_waiting(len(annotations_to_get))
+                    try:
+                        futures = [
+                            self.annotation_pool.submit(
+                                self._get_hg_annotate,
+                                revision,
+                                file,
+                                annotated_files,
+                                thread_num,
+                                repo
+                            )
+                            for thread_num, file in enumerate(annotations_to_get)
+                        ]
+                        timeout = Till(seconds=ANN_WAIT_TIME.seconds)
+                        for future in futures:
+                            if not future.wait(till=timeout):
+                                Log.warning(
+                                    "Timeout {{timeout}} exceeded waiting for annotations at {{cset}}.",
+                                    timeout=ANN_WAIT_TIME,
+                                    cset=revision
+                                )
+                                break
+                    finally:
+                        self.statsdaemon.update_threads_waiting(-len(annotations_to_get))
+
+                    # Files whose annotation is late are left out of this
+                    # round, rather than stored as missing. Their late
+                    # annotations are ignored.
+                    finished = [
+                        (annotations_to_get[thread_num], annotated_files[thread_num])
+                        for thread_num, future in enumerate(futures)
+                        if future.done
+                    ]
+                    if len(finished) < len(annotations_to_get):
+                        Log.note(
+                            "Left {{num}} files with late annotations at {{cset}} for a later request",
+                            num=len(annotations_to_get) - len(finished),
+                            cset=revision
+                        )
+                    del futures
+
+                    # Each shard inserts its files at the same time
+                    def insert_shard_tuids(shard, shard_annotations):
+                        with shard.conn.transaction() as transaction:
+                            return self._get_tuids(
+                                transaction,
+                                [file for file, _ in shard_annotations],
+                                revision,
+                                [annotated for _, annotated in shard_annotations],
+                                commit=commit,
+                                repo=repo
+                            )
 
-                annotated_files = [None] * len(annotations_to_get)
-                threads = [
-                    Thread.run(
-                        str(thread_count),
-                        self._get_hg_annotate,
-                        revision,
-                        annotations_to_get[thread_count],
-                        annotated_files,
-                        thread_count,
-                        repo
-                    )
-                    for thread_count, _ in enumerate(annotations_to_get)
-                ]
-                for t in threads:
-                    t.join()
-
-                # Help for memory, because `chunk` (or a lot of)
-                # threads are started at once.
-                del threads
-
-            with self.conn.transaction() as transaction:
-                results.extend(
-                    self._get_tuids(
-                        transaction, annotations_to_get, revision, annotated_files, commit=commit, repo=repo
-                    )
+                    for shard_results in self.shards.map(insert_shard_tuids, finished, key=lambda pair: pair[0]):
+                        new_results.extend(shard_results)
+            finally:
+                self.annotations_in_flight.finish(
+                    led,
+                    {(repo, revision, file): tuids for file, tuids in new_results}
                 )
-
+            results.extend(new_results)
+
+            # Collect the annotations other threads were getting
+            for (_, _, file), flight in followed:
+                tuids = flight.wait()
+                if tuids is None:
+                    # Their work failed, it may have been done since
+                    tuids = self._get_annotations(revision, [file]).get(file)
+                if tuids is not None:
+                    results.append((file, tuids))
+
+            # Late annotation workers still write into annotated_files
             del annotations_to_get[:]
-            del annotated_files[:]
 
-        # Help for memory
-        gc.collect()
         return results
 
 
@@ -1308,16 +2016,26 @@ class TUIDService:
             requests, the tuid will be duplicated in _get_tuids.
         '''
 
-        new_line_origins = {
-            line_num: (self.tuid(),) + line_origins[line_num - 1]
-            for line_num in new_lines
-        }
+        # A line whose origin is found in the database is not new, and
+        # neither are its duplicates, so the duplicates of new lines are
+        # all new too. Going through them in order, the first line with
+        # an origin is inserted, the later ones are duplicates.
+        first_tuid = self.reserve_tuids(transaction, len(new_lines))
+        new_line_origins = {}
+        duplicate_lines = {}
+        lines_to_insert = []
+        seen = set()
+        for offset, line_num in enumerate(sorted(new_lines)):
+            origin = line_origins[line_num - 1]
+            tuid = first_tuid + offset
+            new_line_origins[line_num] = (tuid,) + origin
+            if origin in seen:
+                duplicate_lines[line_num] = origin
+            else:
+                seen.add(origin)
+                origin_file, origin_rev, origin_line = origin
+                lines_to_insert.append((tuid, origin_rev, origin_file, origin_line))
 
-        duplicate_lines = {
-            line_num + 1: line
-            for line_num, line in enumerate(line_origins)
-            if line in line_origins[:line_num]
-        }
         if len(duplicate_lines) > 0:
             Log.note(
                 "Duplicates found in {{file}} at {{cset}}: {{dupes}}",
@@ -1325,24 +2043,8 @@ class TUIDService:
                 cset=revision,
                 dupes=str(duplicate_lines)
             )
-            lines_to_insert = [
-                line
-                for line_num, line in new_line_origins.items()
-                if line_num not in duplicate_lines
-            ]
-        else:
-            lines_to_insert = new_line_origins.values()
-
-        for _, part_of_insert in jx.groupby(lines_to_insert, size=SQL_BATCH_SIZE):
-            transaction.execute(
-                "INSERT INTO temporal (tuid, file, revision, line)"
-                " VALUES " +
-                sql_list(
-                    sql_iso(
-                        sql_list(map(quote_value, (tuid, f, rev, line_num)))
-                    ) for tuid, f, rev, line_num in list(part_of_insert)
-                )
-            )
+
+        self.insert_tuids(transaction, lines_to_insert)
 
         return new_line_origins
 
@@ -1354,23 +2056,30 @@ class TUIDService:
         :param line_origins:
         :return:
         '''
-        file_names = list(set([f for f, _, _ in line_origins]))
-        revs_to_find = list(set([rev for _, rev, _ in line_origins]))
-        lines_to_find = list(set([line for _, _, line in line_origins]))
-        existing_tuids_tmp = {
-            str((file, revision, line)): tuid
-            for tuid, file, revision, line in transaction.query(
-                "SELECT tuid, file, revision, line FROM temporal"
-                " WHERE file IN " + sql_iso(sql_list(map(quote_value, file_names))) +
-                " AND revision IN " + sql_iso(sql_list(map(quote_value, revs_to_find))) +
-                " AND line IN " + sql_iso(sql_list(map(quote_value, lines_to_find)))
-            ).data
-        }
-
-        # Explicitly remove reference cycle
-        del file_names
-        del revs_to_find
-        del lines_to_find
+        # Look up exactly the (file, revision, line) tuples wanted,
+        # joining on the `temporal_rev_file` index. The temporary
+        # table only lives in this connection, and is emptied
+        # before the transaction ends. Origins whose file or revision
+        # has no id have no tuid yet.
+        file_ids = self.file_ids.get(transaction, [file for file, _, _ in line_origins])
+        revision_ids = self.revision_ids.get(transaction, [rev for _, rev, _ in line_origins])
+        wanted = set(
+            (file_ids[file], revision_ids[rev], line)
+            for file, rev, line in line_origins
+            if file in file_ids and rev in revision_ids
+        )
+        existing_tuids_tmp = {}
+        if wanted:
+            files_by_id = {file_id: file for file, file_id in file_ids.items()}
+            revisions_by_id = {revision_id: rev for rev, revision_id in revision_ids.items()}
+            transaction.execute(CREATE_WANTED_LINES)
+            transaction.executemany(INSERT_WANTED_LINE, wanted)
+            found = transaction.query(GET_WANTED_TUIDS).data
+            transaction.execute("DELETE FROM wanted_lines")
+            existing_tuids_tmp = {
+                (files_by_id[file_id], revisions_by_id[revision_id], line): tuid
+                for tuid, file_id, revision_id, line in found
+            }
 
         # Recompute existing tuids based on line_origins
         # entry ordering because we can't order them any other way
@@ -1378,11 +2087,13 @@ class TUIDService:
         # to it's creation date, not the currently requested
         # annotation.
         existing_tuids = {}
+        new_lines = set()
         for line_num, ann_entry in enumerate(line_origins):
-            if str(ann_entry) in existing_tuids_tmp:
-                existing_tuids[line_num + 1] = copy.deepcopy(existing_tuids_tmp[str(ann_entry)])
-
-        new_lines = set([line_num + 1 for line_num, _ in enumerate(line_origins)]) - set(existing_tuids.keys())
+            tuid = existing_tuids_tmp.get(ann_entry)
+            if tuid is None:
+                new_lines.add(line_num + 1)
+            else:
+                existing_tuids[line_num + 1] = tuid
         return new_lines, existing_tuids
 
 
@@ -1412,15 +2123,16 @@ class TUIDService:
         :return: List of TuidMap objects
         '''
         results = []
+        # Make sure we are not adding the same thing another thread
+        # added.
+        existing_anns = self._get_annotations(revision, files, transaction)
         for fcount, annotated_object in enumerate(annotated_files):
             file = files[fcount]
             # TODO: Replace old empty annotation if a new one is found
             # TODO: at the same revision and if it is not empty as well.
-            # Make sure we are not adding the same thing another thread
-            # added.
-            tmp_ann = self._get_annotation(revision, file, transaction=transaction)
-            if tmp_ann != None:
-                results.append((file, self.destringify_tuids(tmp_ann)))
+            tmp_ann = existing_anns.get(file)
+            if tmp_ann is not None:
+                results.append((file, tmp_ann))
                 continue
 
             # If it's not defined at this revision, we need to add it in
@@ -1451,67 +2163,69 @@ class TUIDService:
 
             if errored:
                 Log.note("Inserting dummy entry...")
-                self.insert_tuid_dummy(transaction, revision, file, commit=commit)
+                with self.conn.transaction() as t:
+                    self.insert_tuid_dummy(t, revision, file, commit=commit)
                 self.insert_annotate_dummy(transaction, revision, file, commit=commit)
+                existing_anns[file] = []
                 results.append((file, []))
                 continue
 
-            # Gather all missing csets and the
-            # corresponding lines.
-            line_origins = []
-            for node in annotated_object['annotate']:
-                cset_len12 = node['node'][:12]
-
-                # If the line added by `cset_len12` is not known
-                # add it. Use the 'abspath' field to determine the
-                # name of the file it was created in (in case it was
-                # changed). Copy to make sure we don't create a reference
-                # here.
-                line_origins.append(copy.deepcopy((node['abspath'], cset_len12, int(node['targetline']))))
+            # Gather all missing csets and the corresponding lines.
+            # Use the 'abspath' field to determine the name of the
+            # file it was created in (in case it was changed).
+            line_origins = [
+                (node['abspath'], node['node'][:12], int(node['targetline']))
+                for node in annotated_object['annotate']
+            ]
 
             # Update DB with any revisions found in annotated
-            # object that are not in the DB.
+            # object that are not in the DB. The tuids are in the
+            # main database, the lines are looked up and inserted in
+            # one transaction so no other thread inserts them between.
             new_line_origins = {}
-            new_lines, existing_tuids = self.get_new_lines(transaction, line_origins)
-            if len(new_lines) > 0:
-                try:
-                    new_line_origins = self.insert_tuids_with_duplicates(
-                        transaction,
-                        file,
-                        revision,
-                        new_lines,
-                        line_origins
-                    )
+            with self.conn.transaction() as t:
+                new_lines, existing_tuids = self.get_new_lines(t, line_origins)
+                if len(new_lines) > 0:
+                    try:
+                        new_line_origins = self.insert_tuids_with_duplicates(
+                            t,
+                            file,
+                            revision,
+                            new_lines,
+                            line_origins
+                        )
 
-                    # Format so we don't have to use [0] to get at the tuids
-                    for linenum in new_line_origins:
-                        new_line_origins[linenum] = new_line_origins[linenum][0]
-                except Exception as e:
-                    # Something broke for this file, ignore it and go to the
-                    # next one.
-                    Log.note("Failed to insert new tuids {{cause}}", cause=e)
-                    continue
+                        # Format so we don't have to use [0] to get at the tuids
+                        for linenum in new_line_origins:
+                            new_line_origins[linenum] = new_line_origins[linenum][0]
+                    except Exception as e:
+                        # Something broke for this file, ignore it and go to the
+                        # next one.
+                        Log.note("Failed to insert new tuids {{cause}}", cause=e)
+                        new_line_origins = None
+                if new_line_origins is not None:
+                    self.compactor.keep_tuids(list(existing_tuids.values()) + list(new_line_origins.values()))
+            if new_line_origins is None:
+                continue
 
-            tuids = []
-            for line_ind, line_origin in enumerate(line_origins):
-                line_num = line_ind + 1
-                if line_num in existing_tuids:
-                    tuids.append(TuidMap(existing_tuids[line_num], line_num))
-                else:
-                    tuids.append(TuidMap(new_line_origins[line_num], line_num))
+            tuids = array(TUID_TYPECODE)
+            for line_num in range(1, len(line_origins) + 1):
+                tuid = existing_tuids.get(line_num)
+                tuids.append(new_line_origins[line_num] if tuid is None else tuid)
+            tuids = TuidArray(tuids)
 
-            str_tuids = self.stringify_tuids(tuids)
             entry = [(
                 revision,
                 file,
-                str_tuids
+                encode_tuids(tuids)
             )]
 
             self.insert_annotations(
                 transaction,
                 entry
             )
-            results.append((copy.deepcopy(file), copy.deepcopy(tuids)))
+            existing_anns[file] = tuids
+            results.append((file, tuids))
 
         return results
 
@@ -1529,7 +2243,13 @@ class TUIDService:
         '''
         while not please_stop:
             # Get all known files and their latest revisions on the frontier
-            files_n_revs = self.conn.get("SELECT file, revision FROM latestFileMod")
+            files_n_revs = []
+            for shard in self.shards:
+                files_n_revs.extend(shard.conn.get(
+                    "SELECT f.file, r.revision FROM latestFileMod l"
+                    " JOIN files f ON f.file_id=l.file_id"
+                    " JOIN revisions r ON r.revision_id=l.revision_id"
+                ))
 
             # Split these files into groups of revisions to make it
             # easier to update them. If we group them together, we
@@ -1624,3 +2344,27 @@ class TUIDService:
 
             if not ran_changesets:
                 (please_stop | Till(seconds=DAEMON_WAIT_AT_NEWEST.seconds)).wait()
+
+
+def _changed_files(diff):
+    # (file, change) pairs of the files changed by a diff, for `csetFiles`
+    output = []
+    for f_diff in diff['diffs']:
+        new_name = f_diff['new'].name.lstrip('/')
+        old_name = f_diff['old'].name.lstrip('/')
+        if old_name == 'dev/null':
+            output.append((new_name, 'A'))
+        elif new_name == 'dev/null':
+            output.append((old_name, 'D'))
+        elif old_name != new_name:
+            output.append((old_name, 'F'))
+            output.append((new_name, 'T'))
+        else:
+            output.append((new_name, 'M'))
+    return output
+
+
+def _annotation_size(key, tuids):
+    # Approximate memory held by a cached (revision, file) annotation
+    _, file = key
+    return ANNOTATION_CACHE_ENTRY_BYTES + sys.getsizeof(file) + sys.getsizeof(tuids.tuids)
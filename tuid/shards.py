@@ -0,0 +1,174 @@
+# encoding: utf-8
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+
+from __future__ import division
+from __future__ import unicode_literals
+
+import os
+import zlib
+
+from mo_dots import coalesce, wrap
+from mo_future import string_types
+from mo_logs import Log
+from mo_threads import Thread
+from tuid import sql
+from tuid.intern import InternTable
+
+
+class Shard(object):
+    """
+    A database holding the `annotations` and `latestFileMod` of the
+    files hashed to it, with its own `files` and `revisions` ids.
+    """
+
+    def __init__(self, number, conn, file_ids=None, revision_ids=None):
+        """
+        :param number: Index of the shard
+        :param conn: Sql connection to its database
+        :param file_ids: InternTable of its `files`, when it is shared
+        :param revision_ids: InternTable of its `revisions`, when it is shared
+        """
+        self.number = number
+        self.conn = conn
+        self.file_ids = file_ids if file_ids is not None else InternTable(conn, "files", "file_id", "file")
+        self.revision_ids = revision_ids if revision_ids is not None else InternTable(conn, "revisions", "revision_id", "revision")
+
+
+class Shards(object):
+    """
+    The shards the files are partitioned in, by a hash of their path.
+    Each shard is a separate SQLite file, with its own worker thread,
+    so the transactions of files in different shards run at the same
+    time. Without `database.shards`, there is one shard: the main
+    database.
+
+    The `temporal` table, and the `sequences` the tuids are reserved
+    from, stay in the main database. A line's tuid is found by the
+    file it was created in, which is often not the requested file.
+
+    Transactions are always opened on a shard before the main
+    database, never the other way around, so they can not wait on
+    each other.
+    """
+
+    def __init__(self, tuid_service, database):
+        """
+        :param tuid_service: TUIDService, whose main database is the only shard
+                             when the database is not sharded
+        :param database: The database settings, `database.shards` is the number
+                         of shard files, named after `database.name`
+        """
+        self.conn = tuid_service.conn
+        if isinstance(database, string_types):
+            database = {"name": database}
+        database = wrap(database)
+        num_shards = coalesce(database.shards, 0)
+        if num_shards <= 1:
+            self.sharded = False
+            self.shards = [Shard(0, tuid_service.conn, tuid_service.file_ids, tuid_service.revision_ids)]
+            return
+
+        self.sharded = True
+        self.shards = []
+        root, extension = os.path.splitext(database.name)
+        for number in range(num_shards):
+            conn = sql.Sql(wrap({
+                "name": root + ".shard" + str(number) + extension,
+                "wal": database.wal,
+                "readers": database.readers
+            }))
+            if not conn.get_one("SELECT name FROM sqlite_master WHERE type='table';"):
+                tuid_service.init_shard(conn)
+            self.shards.append(Shard(number, conn))
+        Log.note("Annotations and frontiers are in {{num}} shards", num=num_shards)
+
+    def __iter__(self):
+        return iter(self.shards)
+
+    def __len__(self):
+        return len(self.shards)
+
+    @property
+    def conns(self):
+        """
+        :return: Connections of all the databases, the main one first
+        """
+        return [self.conn] + [shard.conn for shard in self.shards if shard.conn is not self.conn]
+
+    @property
+    def pending_transactions(self):
+        """
+        :return: Most transactions waiting on any one of the databases
+        """
+        return max(conn.pending_transactions for conn in self.conns)
+
+    def of(self, file):
+        """
+        :return: Shard holding the file
+        """
+        if not self.sharded:
+            return self.shards[0]
+        # Masked, so Python 2 and 3 give the same, unsigned, hash
+        return self.shards[(zlib.crc32(file.encode('utf8')) & 0xffffffff) % len(self.shards)]
+
+    def of_all(self, files):
+        """
+        For work done with a transaction on one shard
+        :param files: Non-empty list of files
+        :return: Shard holding all the files, an error if they are not in one shard
+        """
+        shard = self.of(files[0])
+        if self.sharded:
+            others = [file for file in files if self.of(file) is not shard]
+            if others:
+                Log.error(
+                    "Files {{files|json}} are not in shard {{num}} with {{file}}",
+                    files=others[:10],
+                    num=shard.number,
+                    file=files[0]
+                )
+        return shard
+
+    def group(self, items, key=None):
+        """
+        :param items: Files, or items holding a file
+        :param key: Function giving the file of an item
+        :return: list of (shard, items) pairs, the items in their given order
+        """
+        if not self.sharded:
+            return [(self.shards[0], list(items))] if items else []
+        groups = {}
+        for item in items:
+            groups.setdefault(self.of(key(item) if key else item).number, []).append(item)
+        return [(self.shards[number], groups[number]) for number in sorted(groups)]
+
+    def map(self, function, items, key=None):
+        """
+        Runs `function(shard, items)` for the items of each shard, all
+        shards at the same time. Must be called without an open
+        transaction, each shard's work opens its own.
+        :param function: Function of a shard and its items
+        :param items: Files, or items holding a file
+        :param key: Function giving the file of an item
+        :return: list of what `function` returned for each shard
+        """
+        groups = self.group(items, key)
+        if len(groups) <= 1:
+            return [function(shard, shard_items) for shard, shard_items in groups]
+
+        threads = [
+            Thread.run("shard " + str(shard.number), _run_on_shard, function, shard, shard_items)
+            for shard, shard_items in groups[1:]
+        ]
+        shard, shard_items = groups[0]
+        output = [function(shard, shard_items)]
+        output.extend(thread.join() for thread in threads)
+        return output
+
+
+def _run_on_shard(function, shard, items, please_stop=None):
+    return function(shard, items)
@@ -0,0 +1,250 @@
+# encoding: utf-8
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+
+from __future__ import division
+from __future__ import unicode_literals
+
+import mmap
+import os
+import struct
+
+from jx_python import jx
+from mo_logs import Log
+from mo_threads import Lock
+from pyLibrary.sql import quote_set
+from tuid.encoding import decode_tuids
+from tuid.util import TuidArray
+
+# Snapshot file format, all the annotations of one revision:
+#
+#   8 bytes         SNAPSHOT_MAGIC
+#   1 byte          SNAPSHOT_VERSION
+#   12 bytes        ascii revision
+#   then the annotations, each distinct one stored once, as packed by `encode_tuids`
+#   then the index, for each file:
+#   4 bytes         little-endian uint32 length of the utf8 path
+#   n bytes         utf8 path
+#   8 bytes         little-endian uint64 offset of its annotation
+#   4 bytes         little-endian uint32 length of its annotation
+#   and last, the trailer:
+#   8 bytes         little-endian uint64 offset of the index
+#   4 bytes         little-endian uint32 number of files
+#
+# The index is at the end, so the annotations are written as they
+# are read from the database, without keeping them in memory.
+SNAPSHOT_MAGIC = b'TUIDSNAP'
+SNAPSHOT_VERSION = 1
+SNAPSHOT_EXTENSION = ".snapshot"
+HEADER = struct.Struct(str('<8sB12s'))
+INDEX_ENTRY = struct.Struct(str('<QI'))
+TRAILER = struct.Struct(str('<QI'))
+
+MAX_SNAPSHOTS = 3  # Newest revisions kept as snapshot files.
+SNAPSHOT_BATCH_SIZE = 500  # Annotations read from the database at a time.
+
+
+class Snapshot(object):
+    """
+    Read-only annotations of one revision, served from a memory
+    mapped snapshot file. Reading them needs no database query.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, 'rb') as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, revision = HEADER.unpack_from(self.data, 0)
+        if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+            Log.error("{{file}} is not a version {{version}} snapshot", file=filename, version=SNAPSHOT_VERSION)
+        self.revision = revision.decode('ascii')
+
+        position, num_files = TRAILER.unpack_from(self.data, len(self.data) - TRAILER.size)
+        self.index = {}  # file -> (offset, length) of its annotation
+        for _ in range(num_files):
+            path_length, = struct.unpack_from(str('<I'), self.data, position)
+            position += 4
+            path = self.data[position:position + path_length].decode('utf8')
+            position += path_length
+            self.index[path] = INDEX_ENTRY.unpack_from(self.data, position)
+            position += INDEX_ENTRY.size
+
+    def __len__(self):
+        return len(self.index)
+
+    def get(self, file):
+        """
+        :return: TuidArray of the file, empty if it does not exist
+                 at the revision, or None if it is not in the snapshot
+        """
+        found = self.index.get(file)
+        if found is None:
+            return None
+        offset, length = found
+        return TuidArray(decode_tuids(self.data[offset:offset + length]))
+
+
+def write_snapshot(filename, revision, annotations):
+    """
+    :param filename: snapshot file to write
+    :param revision: 12 character revision the annotations are at
+    :param annotations: generator of (files, annotation) pairs, the
+                        annotation packed by `encode_tuids` is the
+                        same for all the files
+    :return: number of files in the snapshot
+    """
+    index = []
+    with open(filename, 'wb') as f:
+        f.write(HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, revision.encode('ascii')))
+        offset = HEADER.size
+        for files, annotation in annotations:
+            annotation = bytes(annotation)
+            f.write(annotation)
+            for file in files:
+                index.append((file, offset, len(annotation)))
+            offset += len(annotation)
+
+        for file, file_offset, length in index:
+            path = file.encode('utf8')
+            f.write(struct.pack(str('<I'), len(path)) + path + INDEX_ENTRY.pack(file_offset, length))
+        f.write(TRAILER.pack(offset, len(index)))
+    return len(index)
+
+
+class Snapshots(object):
+    """
+    Snapshot files of the newest revisions, kept in a directory. The
+    requests at these revisions are served from the snapshot, and only
+    the files missing from it go to the database.
+
+    snapshots = Snapshots(tuid_service, "resources/snapshots")
+    snapshots.build("d63ed14ed622")
+    snapshots.get_tuids("d63ed14ed622", ["dom/base/Document.cpp"])
+    """
+
+    def __init__(self, tuid_service, directory, max_snapshots=MAX_SNAPSHOTS):
+        """
+        :param tuid_service: TUIDService whose annotations are exported
+        :param directory: Where the snapshot files are kept
+        :param max_snapshots: Number of the newest revisions kept
+        """
+        self.tuid_service = tuid_service
+        self.directory = directory
+        self.max_snapshots = max_snapshots
+        self.locker = Lock()
+        self.snapshots = []  # Snapshot of each revision, oldest first
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        # Snapshots of the last run are served until they are rebuilt
+        names = [name for name in os.listdir(directory) if name.endswith(SNAPSHOT_EXTENSION)]
+        names.sort(key=lambda name: os.path.getmtime(os.path.join(directory, name)))
+        for name in names:
+            try:
+                self._add(Snapshot(os.path.join(directory, name)))
+            except Exception as e:
+                Log.warning("Could not open snapshot {{file}}", file=name, cause=e)
+                self._delete(os.path.join(directory, name))
+
+    def get_tuids(self, revision, files):
+        """
+        :param revision: 12 character revision
+        :param files: files to get the tuids of
+        :return: list of (file, TuidArray) for the files in the snapshot of the revision
+        """
+        snapshot = self._find(revision)
+        if snapshot is None:
+            return []
+        output = []
+        for file in files:
+            tuids = snapshot.get(file)
+            if tuids is not None:
+                output.append((file, tuids))
+        return output
+
+    def build(self, revision):
+        """
+        Exports all the annotations at the revision to a new snapshot
+        file, that replaces any older snapshot of the revision.
+        :param revision: 12 character revision
+        """
+        revision = revision[:12]
+        filename = os.path.join(self.directory, revision + SNAPSHOT_EXTENSION)
+        temp = filename + ".tmp"
+        num_files = write_snapshot(temp, revision, self._annotations(revision))
+        if not num_files:
+            self._delete(temp)
+            return
+
+        with self.locker:
+            old = [s for s in self.snapshots if s.revision == revision]
+            self.snapshots = [s for s in self.snapshots if s.revision != revision]
+        for snapshot in old:
+            # Readers still holding it keep the mapping of the old file
+            self._delete(snapshot.filename)
+        os.rename(temp, filename)
+        self._add(Snapshot(filename))
+        Log.note("Snapshot of {{num}} files at {{rev}}", num=num_files, rev=revision)
+
+    def remove(self, revisions):
+        """
+        Drops the snapshots of the given revisions, once their
+        annotations are deleted from the database.
+        """
+        revisions = set(revisions)
+        with self.locker:
+            removed = [s for s in self.snapshots if s.revision in revisions]
+            self.snapshots = [s for s in self.snapshots if s.revision not in revisions]
+        for snapshot in removed:
+            self._delete(snapshot.filename)
+
+    def _find(self, revision):
+        with self.locker:
+            for snapshot in self.snapshots:
+                if snapshot.revision == revision:
+                    return snapshot
+        return None
+
+    def _add(self, snapshot):
+        with self.locker:
+            self.snapshots.append(snapshot)
+            removed = self.snapshots[:-self.max_snapshots]
+            self.snapshots = self.snapshots[-self.max_snapshots:]
+        for old in removed:
+            self._delete(old.filename)
+
+    def _delete(self, filename):
+        try:
+            os.remove(filename)
+        except Exception as e:
+            # Windows does not delete a file that is still mapped
+            Log.warning("Could not delete snapshot {{file}}", file=filename, cause=e)
+
+    def _annotations(self, revision):
+        # Generates (files, annotation) pairs of all the annotations at the revision
+        for shard in self.tuid_service.shards:
+            revision_id = shard.revision_ids.get(None, [revision]).get(revision)
+            if revision_id is None:
+                continue
+
+            with shard.conn.read_transaction() as t:
+                rows = t.get(
+                    "SELECT f.file, a.hash FROM annotations a"
+                    " JOIN files f ON f.file_id=a.file_id"
+                    " WHERE a.revision_id=?",
+                    (revision_id,)
+                )
+            files_by_hash = {}
+            for file, hash in rows:
+                files_by_hash.setdefault(hash, []).append(file)
+
+            for _, hashes in jx.groupby(sorted(files_by_hash), size=SNAPSHOT_BATCH_SIZE):
+                with shard.conn.read_transaction() as t:
+                    blobs = t.get("SELECT hash, annotation FROM annotationBlobs WHERE hash IN " + quote_set(hashes))
+                for hash, annotation in blobs:
+                    yield files_by_hash[hash], annotation
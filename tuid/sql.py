@@ -10,8 +10,10 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import unicode_literals
 
+from mo_dots import coalesce
+from mo_future import string_types
 from mo_logs import Log
-from pyLibrary.sql.sqlite import quote_value, Sqlite
+from pyLibrary.sql.sqlite import Sqlite
 
 DEBUG = False
 TRACE = True
@@ -19,7 +21,18 @@ TRACE = True
 
 class Sql:
     def __init__(self, config):
-        self.db = Sqlite(config)
+        """
+        :param config: The database filename, or the database settings:
+                       {"name": filename, "wal": use WAL mode, "readers": number of read-only connections}
+        """
+        if isinstance(config, string_types):
+            self.db = Sqlite(config)
+        else:
+            self.db = Sqlite(
+                filename=config.name,
+                wal=coalesce(config.wal, False),
+                readers=coalesce(config.readers, 0)
+            )
 
     def execute(self, sql, params=None):
         Log.error("Use a transaction")
@@ -31,10 +44,7 @@ class Sql:
         Log.error("Use a transaction")
 
     def get(self, sql, params=None):
-        if params:
-            for p in params:
-                sql = sql.replace('?', quote_value(p), 1)
-        return self.db.query(sql).data
+        return self.db.query(sql, params).data
 
     def get_one(self, sql, params=None):
         return self.get(sql, params)[0]
@@ -42,6 +52,13 @@ class Sql:
     def transaction(self):
         return Transaction(self.db.transaction())
 
+    def read_transaction(self):
+        """
+        For queries only. Runs on a reader connection, when there are any,
+        so it does not wait for the transactions in the queue.
+        """
+        return Transaction(self.db.read_transaction())
+
     @property
     def pending_transactions(self):
         """
@@ -49,6 +66,13 @@ class Sql:
         """
         return len(self.db.available_transactions)
 
+    @property
+    def wait_stats(self):
+        """
+        :return: TIME SPENT WAITING FOR THE DATABASE
+        """
+        return self.db.wait_stats
+
 
 class Transaction():
     def __init__(self, transaction):
@@ -63,16 +87,19 @@ class Transaction():
         self.transaction = None
 
     def execute(self, sql, params=None):
-        if params:
-            for p in params:
-                sql = sql.replace('?', quote_value(p), 1)
-        return self.transaction.execute(sql)
+        return self.transaction.execute(sql, params)
+
+    def executemany(self, sql, rows):
+        """
+        Runs `sql` once for each row of parameters, the statement
+        is only prepared once.
+        :param sql: Statement with a ? for each value
+        :param rows: List of parameter tuples
+        """
+        return self.transaction.executemany(sql, rows)
 
     def get(self, sql, params=None):
-        if params:
-            for p in params:
-                sql = sql.replace('?', quote_value(p), 1)
-        return self.transaction.query(sql).data
+        return self.transaction.query(sql, params).data
 
     def get_one(self, sql, params=None):
         return self.get(sql, params)[0]
@@ -80,6 +107,13 @@ class Transaction():
     def query(self, query):
         return self.transaction.query(query)
 
+    def on_commit(self, callback):
+        """
+        Runs `callback` once the outermost transaction is committed,
+        so nothing is kept from a transaction that is rolled back.
+        """
+        self.transaction.on_commit(callback)
+
     def commit(self):
         Log.error("do not know how to handle")
 
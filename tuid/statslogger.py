@@ -12,6 +12,7 @@ from mo_logs import Log
 from mo_threads import Till, Lock, Thread
 from mo_threads.threads import ALL
 from mo_times.durations import MINUTE
+from pyLibrary.env import http
 
 import gc
 import os
@@ -21,6 +22,8 @@ DAEMON_WAIT_FOR_PC = 1 * MINUTE # Time until a percent complete log message is e
 DAEMON_WAIT_FOR_THREADS = 1 * MINUTE # Time until a thread count log message is emitted.
 DAEMON_MEMORY_LOG_INTERVAL = 2 * MINUTE # Time until the memory is logged.
 DAEMON_REQUESTS_LOG_INTERVAL = 2 * MINUTE # Time until requests data is logged.
+DAEMON_CACHE_LOG_INTERVAL = 2 * MINUTE # Time until annotation cache data is logged.
+DAEMON_DATABASE_LOG_INTERVAL = 2 * MINUTE # Time until database wait times are logged.
 
 class StatsLogger:
 
@@ -42,6 +45,24 @@ class StatsLogger:
         self.requests_passed = 0
         self.requests_failed = 0
 
+        self.in_flight_locker = Lock()
+        self.annotations_fetched = 0
+        self.annotations_coalesced = 0
+
+        self.cache_locker = Lock()
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.cache_evictions = 0
+        self.cache_bytes = 0
+
+        self.compaction_locker = Lock()
+        self.compactions = 0
+        self.compaction_rows = 0
+        self.compaction_pages = 0
+        self.compaction_seconds = 0
+
+        self.conn = None
+
         self.prev_mem = 0
         self.curr_mem = 0
         self.initial_growth = {}
@@ -50,6 +71,8 @@ class StatsLogger:
         Thread.run("threads-daemon", self.run_threads_daemon)
         Thread.run("memory-daemon", self.run_memory_daemon)
         Thread.run("requests-daemon", self.run_requests_daemon)
+        Thread.run("cache-daemon", self.run_cache_daemon)
+        Thread.run("database-daemon", self.run_database_daemon)
 
 
     def get_percent_complete(self):
@@ -106,7 +129,7 @@ class StatsLogger:
             try:
                 with self.threads_locker:
                     Log.note(
-                        "Currently {{waiting}} waiting to get annotation, and {{threads}} waiting to be created.",
+                        "Currently {{waiting}} waiting to get annotation, and {{threads}} waiting for an annotation worker.",
                         waiting=self.waiting,
                         threads=self.threads_waiting
                     )
@@ -115,6 +138,10 @@ class StatsLogger:
                 Log.warning("Unexpected error in pc-daemon: {{cause}}", cause=e)
 
 
+    def set_database(self, conn):
+        self.conn = conn
+
+
     def set_process(self, pid):
         self.processtolog = psutil.Process(os.getpid())
 
@@ -205,6 +232,26 @@ class StatsLogger:
         }
 
 
+    def update_annotations_in_flight(self, fetched=0, coalesced=0):
+        '''
+        Updates the counts of annotations requested from hg.
+        :param fetched: Annotations this thread will get from hg
+        :param coalesced: Annotations another thread was already getting, so were not requested again
+        :return:
+        '''
+        with self.in_flight_locker:
+            self.annotations_fetched += fetched
+            self.annotations_coalesced += coalesced
+
+
+    def get_annotations_in_flight(self):
+        with self.in_flight_locker:
+            return {
+                'fetched': self.annotations_fetched,
+                'coalesced': self.annotations_coalesced,
+            }
+
+
     def run_requests_daemon(self, please_stop):
         while not please_stop:
             try:
@@ -226,5 +273,125 @@ class StatsLogger:
                     passed=request_stats['passed'],
                     failed=request_stats['failed']
                 )
+                in_flight = self.get_annotations_in_flight()
+                Log.note(
+                    "Annotations from hg: {{fetched}} fetched, {{coalesced}} coalesced with another request",
+                    fetched=in_flight['fetched'],
+                    coalesced=in_flight['coalesced']
+                )
+                for host, connections in sorted(http.connection_stats().items()):
+                    Log.note(
+                        "Connections to {{host}}: {{requests}} requests, {{new}} new, {{reused}} reused",
+                        host=host,
+                        requests=connections['requests'],
+                        new=connections['new'],
+                        reused=connections['reused']
+                    )
+            except Exception as e:
+                Log.warning("Error encountered while trying to log requests: {{cause}}", cause=e)
+
+    def update_cache(self, hits=0, misses=0, evictions=0, cache_bytes=None):
+        '''
+        Updates the annotation cache totals.
+        :param hits: Annotations found in the cache
+        :param misses: Annotations that had to be read from the database
+        :param evictions: Annotations dropped to make room for new ones
+        :param cache_bytes: Current size of the cache, if known
+        :return:
+        '''
+        with self.cache_locker:
+            self.cache_hits += hits
+            self.cache_misses += misses
+            self.cache_evictions += evictions
+            if cache_bytes is not None:
+                self.cache_bytes = cache_bytes
+
+
+    def get_cache(self):
+        with self.cache_locker:
+            return {
+                'hits': self.cache_hits,
+                'misses': self.cache_misses,
+                'evictions': self.cache_evictions,
+                'bytes': self.cache_bytes,
+            }
+
+
+    def update_compaction(self, rows=0, pages=0, seconds=0):
+        '''
+        Adds a compaction of the temporal table to the totals.
+        :param rows: Temporal rows deleted
+        :param pages: Database pages given back to the file system
+        :param seconds: Time the compaction took
+        :return:
+        '''
+        with self.compaction_locker:
+            self.compactions += 1
+            self.compaction_rows += rows
+            self.compaction_pages += pages
+            self.compaction_seconds += seconds
+
+
+    def get_compaction(self):
+        with self.compaction_locker:
+            return {
+                'runs': self.compactions,
+                'rows': self.compaction_rows,
+                'pages': self.compaction_pages,
+                'seconds': self.compaction_seconds,
+            }
+
+
+    def run_cache_daemon(self, please_stop):
+        while not please_stop:
+            try:
+                (Till(seconds=DAEMON_CACHE_LOG_INTERVAL.seconds) | please_stop).wait()
+                cache_stats = self.get_cache()
+                lookups = cache_stats['hits'] + cache_stats['misses']
+                if lookups == 0:
+                    continue
+                Log.note(
+                    "\nAnnotation cache stats \n"
+                    "----------------------\n"
+                    "Hit ratio: {{hits}}/{{lookups}} = {{ratio|percent}}\n"
+                    "Evictions: {{evictions}}\n"
+                    "Size: {{bytes}} bytes\n",
+                    hits=cache_stats['hits'],
+                    lookups=lookups,
+                    ratio=cache_stats['hits'] / lookups,
+                    evictions=cache_stats['evictions'],
+                    bytes=cache_stats['bytes']
+                )
+            except Exception as e:
+                Log.warning("Error encountered while trying to log cache stats: {{cause}}", cause=e)
+
+
+    def run_database_daemon(self, please_stop):
+        while not please_stop:
+            try:
+                (Till(seconds=DAEMON_DATABASE_LOG_INTERVAL.seconds) | please_stop).wait()
+                if self.conn is None:
+                    continue
+                wait_stats = self.conn.wait_stats
+                Log.note(
+                    "\nDatabase wait times \n"
+                    "-------------------\n"
+                    "Worker queue: {{worker.count}} commands, mean {{worker.mean|round(places=3)}}s, "
+                    "max {{worker.max|round(places=3)}}s\n"
+                    "Reader pool: {{readers.count}} queries, mean {{readers.mean|round(places=3)}}s, "
+                    "max {{readers.max|round(places=3)}}s\n",
+                    worker=wait_stats['worker'],
+                    readers=wait_stats['readers']
+                )
+                compaction = self.get_compaction()
+                if compaction['runs']:
+                    Log.note(
+                        "Compactions: {{runs}} runs, {{rows}} temporal rows deleted, "
+                        "{{pages}} pages freed, {{seconds|round(places=1)}}s spent",
+                        runs=compaction['runs'],
+                        rows=compaction['rows'],
+                        pages=compaction['pages'],
+                        seconds=compaction['seconds']
+                    )
             except Exception as e:
-                Log.warning("Error encountered while trying to log requests: {{cause}}", cause=e)
\ No newline at end of file
+                Log.warning("Error encountered while trying to log database wait times: {{cause}}", cause=e)
@@ -12,10 +12,8 @@ from collections import namedtuple
 
 from jx_python import jx
 from mo_files.url import URL
-from mo_hg.apply import Line, SourceFile
+from mo_hg.apply import Line, SourceFile, apply_diff, apply_diff_backwards, splice_lines
 from mo_logs import Log
-from pyLibrary.sql import quote_set, sql_list
-from pyLibrary.sql.sqlite import quote_value
 
 HG_URL = URL('https://hg.mozilla.org/')
 
@@ -36,6 +34,7 @@ class AnnotateFile(SourceFile, object):
         super(AnnotateFile, self).__init__(filename, lines)
         self.tuid_service = tuid_service
         self.failed_file = False
+        self.added_lines = []
 
     def annotation_to_lines(self, annotation):
         self.lines = [TuidLine(tuidmap) for tuidmap in annotation]
@@ -61,88 +60,112 @@ class AnnotateFile(SourceFile, object):
         self.lines = new_lines
         return self.lines
 
-    def create_and_insert_tuids(self, revision):
-        self.replace_line_with_tuidline()
-
-        line_origins = []
-        all_new_lines = []
-        for line_obj in self.lines:
-            line_entry = (line_obj.filename, revision, line_obj.line)
-            if not line_obj.tuid or line_obj.is_new_line:
-                all_new_lines.append(line_obj.line)
-            line_origins.append(line_entry)
-
+    def apply_changes(self, changes, backwards=False):
+        # Same as SourceFile.apply_changes, but keeps
+        # the lines it adds in `added_lines`
+        filename = self.filename
+        added_lines = self.added_lines
+
+        def new_line(linenum):
+            line_obj = Line(linenum, is_new_line=True, filename=filename)
+            added_lines.append(line_obj)
+            return line_obj
+
+        self.lines = splice_lines(self.lines, changes, new_line, backwards=backwards)
+        for linenum, line_obj in enumerate(self.lines):
+            line_obj.line = linenum + 1
+
+    def apply_diffs(self, diffs, backwards=False):
+        '''
+        Applies the diffs of a range of changesets one after the
+        other, in memory. Each line added on the way keeps its
+        origin: the file, the revision and its line number at that
+        revision. `insert_new_tuids` then gets the tuids of the
+        lines that are left, all at once.
+
+        :param diffs: list of (revision, diff) in the order they are applied,
+                      the lines added by `diff` get their origin at `revision`
+        :param backwards: True to undo the diffs
+        :return: None
+        '''
+        for count, (revision, diff) in enumerate(diffs):
+            self.added_lines = []
+            if backwards:
+                apply_diff_backwards(self, diff)
+            else:
+                apply_diff(self, diff)
+            if count == 0:
+                # Lines without a tuid get one at the first revision too
+                self.added_lines.extend(
+                    line_obj
+                    for line_obj in self.lines
+                    if not line_obj.is_new_line and not getattr(line_obj, 'tuid', None)
+                )
+            for line_obj in self.added_lines:
+                line_obj.origin = (line_obj.filename, revision, line_obj.line)
+                line_obj.is_new_line = False
+        self.added_lines = []
+
+    def insert_new_tuids(self):
+        '''
+        Gets the tuids of the lines added by `apply_diffs`. Origins
+        that already have a tuid use it, the others get new tuids,
+        inserted with a single range of tuids. They are looked up and
+        inserted in one transaction on the main database.
+
+        :return: None
+        '''
+        new_lines = [line_obj for line_obj in self.lines if getattr(line_obj, 'origin', None)]
+        if not new_lines:
+            return
+
+        line_origins = [line_obj.origin for line_obj in new_lines]
         with self.tuid_service.conn.transaction() as t:
-            # Get the new lines, excluding those that have existing tuids
-            existing_tuids = {}
-            if len(all_new_lines) > 0:
-                try:
-                    existing_tuids = {
-                        line: tuid
-                        for tuid, file, revision, line in t.query(
-                            "SELECT tuid, file, revision, line FROM temporal"
-                            " WHERE file = " + quote_value(self.filename)+
-                            " AND revision = " + quote_value(revision) +
-                            " AND line IN " + quote_set(all_new_lines)
-                        ).data
-                    }
-                except Exception as e:
-                    # Log takes out important output, use print instead
-                    self.failed_file = True
-                    print("Trying to find new lines: " + str(all_new_lines))
-                    Log.error("Error encountered:", cause=e)
-
-            insert_entries = []
-            insert_lines = set(all_new_lines) - set(existing_tuids.keys())
-            if len(insert_lines) > 0:
-                try:
-                    insert_entries = [
-                        (self.tuid_service.tuid(),) + line_origins[linenum-1]
-                        for linenum in insert_lines
-                    ]
-                    insert_into_db_chunked(
-                        t,
-                        insert_entries,
-                        "INSERT INTO temporal (tuid, file, revision, line) VALUES "
-                    )
-                except Exception as e:
-                    Log.note(
-                        "Failed to insert new tuids (likely due to merge conflict) on {{file}}: {{cause}}",
-                        file=self.filename,
-                        cause=e
-                    )
-                    self.failed_file = True
-                    return
-
-            fmt_inserted_lines = {line: tuid for tuid, _, _, line in insert_entries}
-            for line_obj in self.lines:
-                # If a tuid already exists for this line,
-                # replace, otherwise, use the newly created one.
-                if line_obj.line in existing_tuids:
-                    line_obj.tuid = existing_tuids[line_obj.line]
-                elif line_obj.line in fmt_inserted_lines:
-                    line_obj.tuid = fmt_inserted_lines[line_obj.line]
-
-                if not line_obj.tuid:
-                    Log.warning(
-                        "Cannot find TUID at {{file}} and {{rev}}for: {{line}}",
-                        file=self.filename,
-                        rev=revision,
-                        line=str(line_obj)
-                    )
-                    self.failed_file = True
-                    return
+            try:
+                missing, existing_tuids = self.tuid_service.get_new_lines(t, line_origins)
+                inserted = self.tuid_service.insert_tuids_with_duplicates(
+                    t, self.filename, line_origins[-1][1], missing, line_origins
+                )
+                # A running compaction keeps them until the annotation is inserted
+                self.tuid_service.compactor.keep_tuids(
+                    list(existing_tuids.values()) + [origin[0] for origin in inserted.values()]
+                )
+            except Exception as e:
+                Log.note(
+                    "Failed to insert new tuids (likely due to merge conflict) on {{file}}: {{cause}}",
+                    file=self.filename,
+                    cause=e
+                )
+                self.failed_file = True
+                return
+
+        tuids = {}
+        for line_obj, line_num in zip(new_lines, range(1, len(new_lines) + 1)):
+            tuid = existing_tuids.get(line_num)
+            if tuid is None:
+                tuid = inserted[line_num][0]
+            tuids[id(line_obj)] = tuid
+
+        self.lines = [
+            TuidLine(TuidMap(tuids[id(line_obj)], line_obj.line), filename=line_obj.filename)
+            if id(line_obj) in tuids else line_obj
+            for line_obj in self.lines
+        ]
 
 
 def insert_into_db_chunked(transaction, data, cmd, sql_chunk_size=500):
     # For the `cmd` object, we expect something like (don't forget the whitespace at the end):
-    #   "INSERT INTO temporal (tuid, file, revision, line) VALUES "
+    #   "INSERT OR REPLACE INTO csetLog (revnum, revision, timestamp) VALUES "
     #
-    # `data` must be a list of tuples.
+    # `data` must be a list of tuples, all of the same length. Each
+    # chunk is inserted with one prepared statement and bound values.
     for _, inserts_list in jx.groupby(data, size=sql_chunk_size):
-        transaction.execute(
-            cmd +
-            sql_list(quote_set(entry) for entry in inserts_list)
+        inserts_list = [tuple(entry) for entry in inserts_list]
+        if not inserts_list:
+            continue
+        transaction.executemany(
+            cmd + "(" + ", ".join(["?"] * len(inserts_list[0])) + ")",
+            inserts_list
         )
 
 
@@ -152,6 +175,8 @@ def map_to_array(pairs):
     :param pairs:
     :return:
     """
+    if isinstance(pairs, TuidArray):
+        return pairs.tuids.tolist() if pairs else None
     if pairs:
         pairs = [TuidMap(*p) for p in pairs]
         max_line = max(p.line for p in pairs)
@@ -164,6 +189,52 @@ def map_to_array(pairs):
         return None
 
 
+class TuidArray(object):
+    """
+    Immutable list of TuidMap objects, backed by an array of
+    tuids (line numbers are implicit). Items are only created
+    when they are asked for.
+    """
+
+    __slots__ = ["tuids"]
+
+    def __init__(self, tuids):
+        """
+        :param tuids: array of tuids, one for each line, in order
+        """
+        self.tuids = tuids
+
+    def __len__(self):
+        return len(self.tuids)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self.tuids)))]
+        if index < 0:
+            index += len(self.tuids)
+        return TuidMap(self.tuids[index], index + 1)
+
+    def __iter__(self):
+        for linenum, tuid in enumerate(self.tuids):
+            yield TuidMap(tuid, linenum + 1)
+
+    def __eq__(self, other):
+        if isinstance(other, TuidArray):
+            return self.tuids == other.tuids
+        try:
+            return len(self) == len(other) and all(a == b for a, b in zip(self, other))
+        except Exception:
+            return False
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    __hash__ = None
+
+    def __str__(self):
+        return "TuidArray" + str(self.tuids.tolist())
+
+
 # Used for increasing readability
 # Can be accessed with tmap_obj.line, tmap_obj.tuid
 TuidMap = namedtuple(str("TuidMap"), [str("tuid"), str("line")])
@@ -0,0 +1,134 @@
+# encoding: utf-8
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+
+from __future__ import division
+from __future__ import unicode_literals
+
+from jx_python import jx
+from mo_logs import Log
+from mo_threads import Lock, Queue, Thread, Till
+from mo_times.durations import SECOND
+
+WARM_FILES = 1000  # Most requested files moved to each new tip.
+WARM_BATCH_SIZE = 50  # Files moved at a time.
+WARM_BATCH_PAUSE = 1 * SECOND  # Pause between batches, leaving the CPU to requests.
+WARM_BUSY_THREADS = 2  # Requests running that make the warmer wait.
+MAX_TRACKED_FILES = 10 * WARM_FILES  # Files counted before older counts are decayed.
+
+
+class FileRequests(object):
+    """
+    Counts how often each file is requested. When too many files are
+    tracked, all the counts are halved, so recent requests weigh more
+    and files that are not requested anymore are dropped.
+
+    requests = FileRequests(1000)
+    requests.add(["dom/base/Document.cpp"])
+    requests.most_requested(10)
+    """
+
+    def __init__(self, max_files=MAX_TRACKED_FILES):
+        self.locker = Lock()
+        self.max_files = max_files
+        self.counts = {}  # file -> number of requests
+
+    def __len__(self):
+        return len(self.counts)
+
+    def add(self, files):
+        with self.locker:
+            for file in files:
+                self.counts[file] = self.counts.get(file, 0) + 1
+            if len(self.counts) > self.max_files:
+                self.counts = {
+                    file: count // 2
+                    for file, count in self.counts.items()
+                    if count // 2
+                }
+
+    def most_requested(self, num):
+        """
+        :return: the `num` files requested the most, most requested first
+        """
+        with self.locker:
+            counts = list(self.counts.items())
+        counts.sort(key=lambda fc: (-fc[1], fc[0]))
+        return [file for file, _ in counts[:num]]
+
+
+class Warmer(object):
+    """
+    Moves the frontiers of the most requested files to the new tip
+    changesets found by the clogger, so the first requests at a new
+    revision find the annotations already made. The work is done by a
+    single thread, a batch at a time, and waits while the service is
+    busy with requests. Once warmed, the annotations of the tip are
+    exported to a snapshot.
+    """
+
+    def __init__(self, tuid_service, start_workers=True, num_files=WARM_FILES):
+        """
+        :param tuid_service: TUIDService that gets the tuids
+        :param start_workers: False to only count requests, and never warm
+        :param num_files: Number of the most requested files to keep warm
+        """
+        self.tuid_service = tuid_service
+        self.num_files = num_files
+        self.requests = FileRequests()
+        self.todo = Queue("warmer", silent=True)
+        self.thread = Thread.run("tuid warmer", self._worker) if start_workers else None
+
+    def add_requests(self, files):
+        self.requests.add([file.lstrip('/') for file in files])
+
+    def add_tip(self, csets):
+        """
+        :param csets: New changesets, newest first, as added to the csetLog
+        """
+        if csets and self.thread:
+            self.todo.add(list(csets))
+
+    def _worker(self, please_stop):
+        while not please_stop:
+            csets = self.todo.pop(till=please_stop)
+            if please_stop:
+                break
+            # Only the newest tip is warmed, older ones are passed
+            for more in self.todo.pop_all():
+                csets = more + csets
+
+            try:
+                # Getting the diffs first means the frontier
+                # updates do not request them one at a time
+                self.tuid_service.prefetch_diffs(csets)
+                if self._warm(csets[0], please_stop):
+                    # The warmed annotations are served from a snapshot
+                    self.tuid_service.snapshots.build(csets[0])
+            except Exception as e:
+                Log.warning("Could not warm files at {{rev}}", rev=csets[0], cause=e)
+
+    def _warm(self, revision, please_stop):
+        # Returns True if all the files were warmed
+        files = self.requests.most_requested(self.num_files)
+        if not files:
+            return False
+
+        Log.note("Warming {{num}} files at {{rev}}", num=len(files), rev=revision)
+        branch = self.tuid_service.config.hg.branch
+        for _, batch in jx.groupby(files, size=WARM_BATCH_SIZE):
+            while not please_stop and self.tuid_service.get_thread_count() > WARM_BUSY_THREADS:
+                (please_stop | Till(seconds=WARM_BATCH_PAUSE.seconds)).wait()
+            if please_stop or len(self.todo):
+                # Stopping, or there is a newer tip to warm
+                return False
+
+            self.tuid_service.get_tuids_from_files(
+                list(batch), revision, going_forward=True, repo=branch, use_thread=False
+            )
+            (please_stop | Till(seconds=WARM_BATCH_PAUSE.seconds)).wait()
+        Log.note("Warmed {{num}} files at {{rev}}", num=len(files), rev=revision)
+        return True